@@ -0,0 +1,200 @@
+import hashlib
+import threading
+import time
+from collections import OrderedDict
+from django.contrib.auth import get_user_model
+from django.core.cache import cache
+from django.db import DEFAULT_DB_ALIAS
+from django.utils.translation import gettext_lazy as _
+from rest_framework.authentication import TokenAuthentication, get_authorization_header
+from rest_framework.authtoken.models import Token
+from rest_framework.exceptions import AuthenticationFailed
+from videoflix.cache import acache_get, acache_set
+from videoflix.metrics import record_cache_lookup
+
+# Seconds a token is cached in process. Other processes can not invalidate it,
+# so this bounds how long a deleted token or deactivated user stays accepted.
+LOCAL_TOKEN_CACHE_TTL = 30
+
+# Maximum number of tokens cached in process
+LOCAL_TOKEN_CACHE_SIZE = 10000
+
+# Seconds a token is cached in the shared cache (Redis)
+SHARED_TOKEN_CACHE_TTL = 5 * 60
+
+# User fields kept in the token caches, never the password. Other fields are loaded when accessed.
+CACHED_USER_FIELDS = ['id', 'username', 'email', 'first_name', 'last_name', 'is_active', 'is_staff', 'is_superuser']
+
+
+class LRUCache:
+    """
+    Thread safe, bounded LRU cache whose entries expire after ttl seconds.
+    """
+
+    def __init__(self, maxsize, ttl):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return None
+            value, expires = entry
+            if expires < time.monotonic():
+                del self.entries[key]
+                return None
+            self.entries.move_to_end(key)
+            return value
+
+    def set(self, key, value):
+        with self.lock:
+            self.entries[key] = (value, time.monotonic() + self.ttl)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.maxsize:
+                self.entries.popitem(last=False)
+
+    def delete(self, key):
+        with self.lock:
+            self.entries.pop(key, None)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+
+def token_cache_key(key):
+    # Do not use the token itself as cache key
+    return f'auth:token:{hashlib.sha256(key.encode()).hexdigest()}'
+
+
+def token_cache_entry(token):
+    """
+    Cached part of a token: its creation and the fields of its user in CACHED_USER_FIELDS.
+    """
+    return {'created': token.created, 'user': {field: getattr(token.user, field) for field in CACHED_USER_FIELDS}}
+
+
+def token_from_cache_entry(key, entry):
+    """
+    Build a token and its user from a cache entry, new instances for every request,
+    so requests and threads never share (and modify) the same user.
+    """
+    user_model = get_user_model()
+    user_fields = [field.attname for field in user_model._meta.concrete_fields if field.attname in entry['user']]
+    user = user_model.from_db(DEFAULT_DB_ALIAS, user_fields, [entry['user'][field] for field in user_fields])
+    token = Token.from_db(DEFAULT_DB_ALIAS, ['key', 'user_id', 'created'], [key, user.pk, entry['created']])
+    token.user = user
+    return token
+
+
+class CachedTokenAuthentication(TokenAuthentication):
+    """
+    Drop-in replacement for TokenAuthentication, which caches the token and
+    a few fields of its user (CACHED_USER_FIELDS) in process and in the shared
+    cache (Redis), so most requests skip the Token / CustomUser query.
+
+    Cached tokens are invalidated when they are deleted or their user is
+    saved (e.g. deactivated), see users/signals.py.
+    """
+
+    local_cache = LRUCache(LOCAL_TOKEN_CACHE_SIZE, LOCAL_TOKEN_CACHE_TTL)
+    stats = {'local_hits': 0, 'shared_hits': 0, 'misses': 0}
+    stats_lock = threading.Lock()
+
+    @classmethod
+    def count(cls, stat):
+        with cls.stats_lock:
+            cls.stats[stat] += 1
+        record_cache_lookup('token', stat != 'misses')
+
+    @classmethod
+    def get_stats(cls):
+        with cls.stats_lock:
+            return dict(cls.stats)
+
+    @classmethod
+    def invalidate(cls, key):
+        cache_key = token_cache_key(key)
+        cls.local_cache.delete(cache_key)
+        cache.delete(cache_key)
+
+    def authenticate_credentials(self, key):
+        cache_key = token_cache_key(key)
+
+        entry = self.local_cache.get(cache_key)
+        if entry is not None:
+            self.count('local_hits')
+            token = token_from_cache_entry(key, entry)
+            return (token.user, token)
+
+        entry = cache.get(cache_key)
+        if entry is not None:
+            self.count('shared_hits')
+            token = token_from_cache_entry(key, entry)
+        else:
+            self.count('misses')
+            # Raises AuthenticationFailed for unknown tokens and inactive users
+            user, token = super().authenticate_credentials(key)
+            entry = token_cache_entry(token)
+            cache.set(cache_key, entry, SHARED_TOKEN_CACHE_TTL)
+        self.local_cache.set(cache_key, entry)
+        return (token.user, token)
+
+    async def aauthenticate(self, request):
+        """ Async variant of authenticate(), for the async views """
+        auth = get_authorization_header(request).split()
+        if not auth or auth[0].lower() != self.keyword.lower().encode():
+            return None
+        if len(auth) != 2:
+            raise AuthenticationFailed(_('Invalid token header.'))
+        try:
+            key = auth[1].decode()
+        except UnicodeError:
+            raise AuthenticationFailed(_('Invalid token header. Token string should not contain invalid characters.'))
+        return await self.aauthenticate_credentials(key)
+
+    async def aauthenticate_credentials(self, key):
+        """ Async variant of authenticate_credentials(), the caches are shared with it """
+        cache_key = token_cache_key(key)
+
+        entry = self.local_cache.get(cache_key)
+        if entry is not None:
+            self.count('local_hits')
+            token = token_from_cache_entry(key, entry)
+            return (token.user, token)
+
+        entry = await acache_get(cache_key)
+        if entry is not None:
+            self.count('shared_hits')
+            token = token_from_cache_entry(key, entry)
+        else:
+            self.count('misses')
+            try:
+                token = await self.get_model().objects.select_related('user').aget(key=key)
+            except self.get_model().DoesNotExist:
+                raise AuthenticationFailed(_('Invalid token.'))
+            if not token.user.is_active:
+                raise AuthenticationFailed(_('User inactive or deleted.'))
+            entry = token_cache_entry(token)
+            await acache_set(cache_key, entry, SHARED_TOKEN_CACHE_TTL)
+        self.local_cache.set(cache_key, entry)
+        return (token.user, token)
+
+
+class QueryTokenAuthentication(CachedTokenAuthentication):
+    """
+    Token authentication via the ?token= query parameter.
+
+    Only meant for media URLs: <video> and <img> elements can not send an
+    Authorization header. The token ends up in access logs, so do not use it
+    for the API.
+    """
+
+    def authenticate(self, request):
+        key = request.query_params.get('token')
+        if not key:
+            return None
+        return self.authenticate_credentials(key)
@@ -9,4 +9,5 @@ class CustomUser(AbstractUser):
     # favorites = models.ManyToManyField(Video, blank=True, related_name='favorited_by')
     
     def __str__(self) -> str:
-        return f'({self.id}) - {self.username} - {self.first_name} {self.last_name}'
\ No newline at end of file
+        return f'({self.id}) - {self.username} - {self.first_name} {self.last_name}'
+
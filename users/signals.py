@@ -0,0 +1,34 @@
+from functools import partial
+from django.db import transaction
+from django.db.models.signals import post_save, post_delete
+from django.dispatch import receiver
+from rest_framework.authtoken.models import Token
+from .authentication import CachedTokenAuthentication
+from .models import CustomUser
+
+
+def invalidate_tokens(keys):
+    for key in keys:
+        CachedTokenAuthentication.invalidate(key)
+
+
+# The cache entries are removed once the change is committed. Removed before, a request
+# in the meantime would cache the old token or user again, for SHARED_TOKEN_CACHE_TTL.
+
+@receiver(post_delete, sender=Token)
+def invalidate_deleted_token(sender, instance, **kwargs):
+    """
+    Removes a deleted token from the token cache.
+    """
+    transaction.on_commit(partial(invalidate_tokens, [instance.key]))
+
+
+@receiver(post_save, sender=CustomUser)
+def invalidate_user_tokens(sender, instance, created, **kwargs):
+    """
+    Removes the tokens of a saved user (e.g. deactivated) from the token cache,
+    so the next request loads the current user.
+    """
+    if not created:
+        keys = list(Token.objects.filter(user=instance).values_list('key', flat=True))
+        transaction.on_commit(partial(invalidate_tokens, keys))
@@ -0,0 +1,22 @@
+from django.core.mail import send_mail
+from videoflix.outbox import enqueue_on_commit
+
+# Failed deliveries are retried with backoff (delays in seconds)
+EMAIL_RETRY_INTERVALS = [30, 120, 600]
+
+
+def queue_email(subject, message, recipient_list, from_email=None):
+    """
+    Send an email from a worker instead of within the request. The delivery is a task of
+    the outbox: it is enqueued once the current transaction is committed, a rollback discards
+    it, and relay_outbox (the command) enqueues it if Redis was not reachable.
+    """
+    return enqueue_on_commit('light', send_email, subject, message, recipient_list, from_email,
+                             retry_intervals=EMAIL_RETRY_INTERVALS)
+
+
+def send_email(subject, message, recipient_list, from_email=None):
+    """
+    Send one email of the outbox. Errors are raised, so RQ retries the delivery.
+    """
+    send_mail(subject, message, from_email, recipient_list)
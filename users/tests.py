@@ -1,9 +1,24 @@
-from django.test import TestCase, Client
+from django.test import TestCase, Client, override_settings
+from django.core.cache import cache
+from rest_framework.authtoken.models import Token
+from users.authentication import CACHED_USER_FIELDS, CachedTokenAuthentication, token_cache_key
 from users.models import CustomUser
 from django.contrib.auth.tokens import default_token_generator
 from django.utils.http import urlsafe_base64_encode
 from django.utils.encoding import force_bytes
 from django.core import mail
+from unittest import mock
+from django.utils.module_loading import import_string
+from users.tasks import EMAIL_RETRY_INTERVALS, send_email
+from videoflix.models import TaskOutbox
+
+
+def send_queued_emails():
+    """ Run the pending email tasks of the outbox, like the worker of the light queue """
+    for task in TaskOutbox.objects.filter(func='users.tasks.send_email', enqueued_at__isnull=True).order_by('id'):
+        import_string(task.func)(*task.args)
+        task.delete()
+
 
 # Create your tests here.
 class LoginTest(TestCase):
@@ -50,6 +65,28 @@ class LoginTest(TestCase):
             '/api/v1/login/', {'username': 'active_user'})
         self.assertEqual(response.status_code, 400)
 
+    def test_async_login(self):
+        # The async variant answers like the sync login view
+        response = self.client.post(
+            '/api/v1/async/login/', {'username': 'active_user', 'password': 'test_password'})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()['token'], Token.objects.get(user=self.active_user).key)
+        self.assertEqual(response.json()['user_id'], self.active_user.pk)
+
+        response = self.client.post(
+            '/api/v1/async/login/', {'username': 'active_user', 'password': 'wrong_password'},
+            content_type='application/json')
+        self.assertEqual(response.status_code, 400)
+        response = self.client.post(
+            '/api/v1/async/login/', {'username': 'inactive_user', 'password': 'test_password'})
+        self.assertEqual(response.status_code, 403)
+        self.assertEqual(self.client.get('/api/v1/async/login/').status_code, 405)
+
+        # Like the sync view, it does not need a CSRF token
+        response = Client(enforce_csrf_checks=True).post(
+            '/api/v1/async/login/', {'username': 'active_user', 'password': 'test_password'})
+        self.assertEqual(response.status_code, 200)
+
     def test_logout_view(self):
         # Assuming you have a logout view that handles token deletion
         response = self.client.get('/logout')
@@ -70,7 +107,9 @@ class RegisterViewTest(TestCase):
         user = CustomUser.objects.get(username='new_user')
         self.assertEqual(user.is_active, False)  # The user should be inactive
 
-        # Check that an email has been sent
+        # Check that an email has been queued and is sent by the worker
+        self.assertEqual(len(mail.outbox), 0)
+        send_queued_emails()
         self.assertEqual(len(mail.outbox), 1)
         self.assertIn('Activate your Videoflix account', mail.outbox[0].subject)
 
@@ -129,6 +168,7 @@ class PasswordResetTest(TestCase):
         self.assertEqual(response.status_code, 200)
         
         # Check if an email has been sent
+        send_queued_emails()
         self.assertEqual(len(mail.outbox), 1)
         self.assertIn('Videoflix Password Reset Request', mail.outbox[0].subject)
         
@@ -238,6 +278,7 @@ class UsernameReminderTest(TestCase):
         self.assertEqual(response.status_code, 200)
         
         # Check if an email has been sent
+        send_queued_emails()
         self.assertEqual(len(mail.outbox), 1)
         self.assertIn('Videoflix Username Reminder', mail.outbox[0].subject)
         
@@ -256,4 +297,142 @@ class UsernameReminderTest(TestCase):
         self.assertEqual(response.status_code, 404)
         
         # Ensure no email is sent
-        self.assertEqual(len(mail.outbox), 0)
\ No newline at end of file
+        send_queued_emails()
+        self.assertEqual(len(mail.outbox), 0)
+
+
+class EmailOutboxTest(TestCase):
+    # Tests for the email outbox and its delivery
+
+    def setUp(self):
+        self.client = Client()
+        self.user = CustomUser.objects.create_user(
+            username='test_user', email='test@example.com', password='test_password'
+        )
+
+    @mock.patch('videoflix.outbox.Job.fetch_many', lambda job_ids, connection: [None] * len(job_ids))
+    @mock.patch('videoflix.outbox.django_rq.get_queue')
+    def test_delivery_enqueued_after_commit(self, get_queue):
+        with self.captureOnCommitCallbacks(execute=True):
+            response = self.client.post('/api/v1/username-reminder/', {'email': 'test@example.com'})
+        self.assertEqual(response.status_code, 200)
+
+        # The view only records the delivery task, it is enqueued after the commit
+        task = TaskOutbox.objects.get()
+        self.assertEqual((task.queue, task.func, task.retry_intervals),
+                         ('light', 'users.tasks.send_email', EMAIL_RETRY_INTERVALS))
+        self.assertEqual(task.args[2:], [['test@example.com'], None])
+        self.assertIsNotNone(task.enqueued_at)
+        get_queue.assert_called_once_with('light', autocommit=True)
+        get_queue.return_value.enqueue_many.assert_called_once()
+        self.assertEqual(len(mail.outbox), 0)
+
+    @mock.patch('videoflix.outbox.django_rq.get_queue')
+    def test_delivery_not_enqueued(self, get_queue):
+        # Redis is down: the request succeeds, the email waits in the outbox for relay_outbox
+        get_queue.side_effect = ConnectionError()
+        with self.assertLogs('videoflix.outbox', 'ERROR'), self.captureOnCommitCallbacks(execute=True):
+            response = self.client.post('/api/v1/username-reminder/', {'email': 'test@example.com'})
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(TaskOutbox.objects.filter(func='users.tasks.send_email', enqueued_at__isnull=True).exists())
+        self.assertEqual(len(mail.outbox), 0)
+
+    def test_failed_delivery_is_retried(self):
+        self.client.post('/api/v1/username-reminder/', {'email': 'test@example.com'})
+        args = TaskOutbox.objects.get().args
+
+        # The error is raised, so RQ retries the task
+        with mock.patch('django.core.mail.backends.locmem.EmailBackend.send_messages', side_effect=OSError('SMTP down')):
+            with self.assertRaises(OSError):
+                send_email(*args)
+        self.assertEqual(len(mail.outbox), 0)
+
+        # The retry sends it
+        send_email(*args)
+        self.assertEqual(len(mail.outbox), 1)
+        self.assertEqual(mail.outbox[0].to, ['test@example.com'])
+
+
+@override_settings(CACHES={'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}})
+class CachedTokenAuthenticationTest(TestCase):
+    # Tests for the cached token authentication
+
+    def setUp(self):
+        cache.clear()
+        CachedTokenAuthentication.local_cache.clear()
+        self.client = Client()
+        self.user = CustomUser.objects.create_user(
+            username='test_user', email='test@example.com', password='test_password')
+        self.token = Token.objects.create(user=self.user)
+        self.auth = {'HTTP_AUTHORIZATION': f'Token {self.token.key}'}
+
+    def test_token_is_cached(self):
+        stats = CachedTokenAuthentication.get_stats()
+
+        # The first request loads the token, later ones only load the users
+        with self.assertNumQueries(2):
+            self.assertEqual(self.client.get('/api/v1/users/', **self.auth).status_code, 200)
+        with self.assertNumQueries(1):
+            self.assertEqual(self.client.get('/api/v1/users/', **self.auth).status_code, 200)
+
+        # Other processes find it in the shared cache
+        CachedTokenAuthentication.local_cache.clear()
+        with self.assertNumQueries(1):
+            self.assertEqual(self.client.get('/api/v1/users/', **self.auth).status_code, 200)
+
+        new_stats = CachedTokenAuthentication.get_stats()
+        self.assertEqual(new_stats['misses'] - stats['misses'], 1)
+        self.assertEqual(new_stats['local_hits'] - stats['local_hits'], 1)
+        self.assertEqual(new_stats['shared_hits'] - stats['shared_hits'], 1)
+
+    def test_cached_user_fields(self):
+        auth = CachedTokenAuthentication()
+        user, token = auth.authenticate_credentials(self.token.key)
+
+        # The password hash is never cached
+        entry = cache.get(token_cache_key(self.token.key))
+        self.assertEqual(set(entry['user']), set(CACHED_USER_FIELDS))
+        self.assertNotIn(self.user.password, str(entry))
+
+        # Every request gets its own user, built from the cache
+        with self.assertNumQueries(0):
+            first, first_token = auth.authenticate_credentials(self.token.key)
+            second, _ = auth.authenticate_credentials(self.token.key)
+        self.assertIsNot(first, second)
+        self.assertEqual((first.pk, first.username, first.is_staff), (self.user.pk, 'test_user', False))
+        self.assertEqual((first_token.key, first_token.user_id), (self.token.key, self.user.pk))
+        # Other fields are loaded on access
+        with self.assertNumQueries(1):
+            self.assertEqual(first.password, self.user.password)
+
+    def test_cached_token_invalidation(self):
+        self.assertEqual(self.client.get('/api/v1/users/', **self.auth).status_code, 200)
+
+        # A deactivated user is rejected right after the commit. Not before, a request
+        # in the meantime would cache the active user again.
+        with self.captureOnCommitCallbacks(execute=True):
+            self.user.is_active = False
+            self.user.save()
+            self.assertIsNotNone(cache.get(token_cache_key(self.token.key)))
+        self.assertIsNone(cache.get(token_cache_key(self.token.key)))
+        self.assertEqual(self.client.get('/api/v1/users/', **self.auth).status_code, 401)
+
+        # As is a deleted token
+        with self.captureOnCommitCallbacks(execute=True):
+            self.user.is_active = True
+            self.user.save()
+        self.assertEqual(self.client.get('/api/v1/users/', **self.auth).status_code, 200)
+        cache_key = token_cache_key(self.token.key)
+        with self.captureOnCommitCallbacks(execute=True):
+            self.token.delete()
+            self.assertIsNotNone(cache.get(cache_key))
+        self.assertEqual(self.client.get('/api/v1/users/', **self.auth).status_code, 401)
+
+    def test_stats_for_admins_only(self):
+        self.assertEqual(self.client.get('/api/v1/auth-cache-stats/', **self.auth).status_code, 403)
+        with self.captureOnCommitCallbacks(execute=True):
+            self.user.is_staff = True
+            self.user.save()
+        response = self.client.get('/api/v1/auth-cache-stats/', **self.auth)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(set(response.data), {'local_hits', 'shared_hits', 'misses'})
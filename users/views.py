@@ -5,13 +5,15 @@ from rest_framework.views import APIView
 from rest_framework import status
 from users.models import CustomUser
 from users.serializers import UserItemSerializer, SetNewPasswordSerializer
-from rest_framework.authentication import TokenAuthentication
-from rest_framework.permissions import IsAuthenticated
+from rest_framework.permissions import IsAuthenticated, IsAdminUser
+from users.authentication import CachedTokenAuthentication
 from django.contrib.auth.tokens import default_token_generator
 from django.utils.http import urlsafe_base64_encode, urlsafe_base64_decode
-from django.core.mail import send_mail, BadHeaderError
 from django.utils.encoding import force_bytes
 from django.contrib.auth import authenticate
+from asgiref.sync import sync_to_async
+from users.tasks import queue_email
+from videoflix.async_views import AsyncAPIView
 
 # Create your views here.
 
@@ -19,7 +21,7 @@ from django.contrib.auth import authenticate
 class ListUsers(APIView):
     """ View to load all users from the database. """
 
-    authentication_classes = [TokenAuthentication]
+    authentication_classes = [CachedTokenAuthentication]
     permission_classes = [IsAuthenticated]
 
     def get(self, request, format=None):
@@ -28,10 +30,20 @@ class ListUsers(APIView):
         return Response(serializer.data)
 
 
+class AuthCacheStatsView(APIView):
+    """ View to load the hit / miss counters of the token cache of this process. """
+
+    authentication_classes = [CachedTokenAuthentication]
+    permission_classes = [IsAdminUser]
+
+    def get(self, request):
+        return Response(CachedTokenAuthentication.get_stats())
+
+
 class CurrentUserView(APIView):
     """ View to load the current logged in user from the database. """
 
-    authentication_classes = [TokenAuthentication]
+    authentication_classes = [CachedTokenAuthentication]
     permission_classes = [IsAuthenticated]
 
     def get(self, request):
@@ -75,6 +87,38 @@ class LoginView(ObtainAuthToken):
             return Response({"error": "Invalid username or password."}, status=status.HTTP_400_BAD_REQUEST)
 
 
+class AsyncLoginView(AsyncAPIView):
+    """ Async variant of LoginView, for ASGI servers """
+
+    authentication_classes = []
+
+    async def post(self, request, *args, **kwargs):
+        username = request.data.get('username')
+        password = request.data.get('password')
+
+        try:
+            user = await CustomUser.objects.aget(username=username)
+        except CustomUser.DoesNotExist:
+            return self.json_response({"error": "Invalid username or password."}, status=status.HTTP_400_BAD_REQUEST)
+
+        if not user.is_active:
+            return self.json_response({"error": "This account is inactive. Please activate your account."},
+                                      status=status.HTTP_403_FORBIDDEN)
+
+        # There is no async authenticate() yet. The password hashing runs in a thread,
+        # so it does not block the event loop.
+        user = await sync_to_async(authenticate)(username=username, password=password)
+        if user is None:
+            return self.json_response({"error": "Invalid username or password."}, status=status.HTTP_400_BAD_REQUEST)
+
+        token, created = await Token.objects.aget_or_create(user=user)
+        return self.json_response({
+            'token': token.key,
+            'user_id': user.pk,
+            'email': user.email
+        })
+
+
 class RegisterView(APIView):
     def post(self, request, *args, **kwargs):
         username = request.data.get('username')
@@ -103,25 +147,20 @@ class RegisterView(APIView):
             activation_link = f"https://videoflix.christian-hansen.dev/activate/{uidb64}/{token}/"
 
             # TODO Update with final content
-            # Send activation email
-            try:
-                send_mail(
-                    subject="Activate your Videoflix account",
-                    message=(
-                        f"Hi {user.first_name} {user.last_name},\n\n"
-                        "Thank you for registering. Please click the link below to activate your account:\n\n"
-                        f"{activation_link}\n\n"
-                        "If you did not request this registration, please ignore this email.\n\n"
-                        "Best regards,\n"
-                        "Your Videoflix Team"
-                    ),
-                    from_email=None,
-                    recipient_list=[email],
-                )
-            except BadHeaderError:
-                return Response({"error": "Invalid header found."}, status=status.HTTP_400_BAD_REQUEST)
-            except Exception as e:
-                return Response({"error": str(e)}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
+            # Queue activation email, it is sent by a worker
+            queue_email(
+                subject="Activate your Videoflix account",
+                message=(
+                    f"Hi {user.first_name} {user.last_name},\n\n"
+                    "Thank you for registering. Please click the link below to activate your account:\n\n"
+                    f"{activation_link}\n\n"
+                    "If you did not request this registration, please ignore this email.\n\n"
+                    "Best regards,\n"
+                    "Your Videoflix Team"
+                ),
+                from_email=None,
+                recipient_list=[email],
+            )
 
             return Response({"message": "User created successfully. Check your email for activation link."}, status=status.HTTP_201_CREATED)
 
@@ -165,8 +204,8 @@ class PasswordResetRequestView(APIView):
         reset_link = f"https://videoflix.christian-hansen.dev/reset-password/{uidb64}/{token}/"
 
         # TODO Update with final content
-        # Send password reset email
-        send_mail(
+        # Queue password reset email, it is sent by a worker
+        queue_email(
             subject="Videoflix Password Reset Request",
             message=f"Hi {user.first_name} {user.last_name},\n\nPlease click the link below to reset your password:\n{reset_link}\n\nIf you didn't request this, please ignore this email.",
             from_email=None,  # Replace with your actual from_email
@@ -185,8 +224,8 @@ class UsernameRequestView(APIView):
             return Response({"error": "Please enter different data."}, status=status.HTTP_404_NOT_FOUND)
 
         # TODO Update with final content
-        # Send username reminder email
-        send_mail(
+        # Queue username reminder email, it is sent by a worker
+        queue_email(
             subject="Videoflix Username Reminder",
             message=f"Hi {user.first_name} {user.last_name},\n\nYour username is {user.username}. If you need additional help please contact the administrator.",
             from_email=None,  # Replace with your actual from_email
@@ -1,16 +1,85 @@
 from django.contrib import admin
+from django.db import transaction
+from django.utils import timezone
 from import_export import resources
 from import_export.admin import ImportExportActionModelAdmin
-from .models import Video, Genre
+from .cache import bump_catalog_version
+from .importing import IMPORT_CHUNK_SIZE, reset_id_sequence, schedule_transcodes
+from .models import Video, Genre, TaskOutbox, TranscodeJob, UploadSession
+from .search import update_search_vectors
 
 
 # Register your models here.
 class VideoResource(resources.ModelResource):
+    """
+    Imports rows in chunks with bulk_create / bulk_update. Bulk writes skip the
+    post_save signal, so the transcodes of the created videos are enqueued in one
+    batch after the import is committed.
+    """
+
     class Meta:
         model = Video
+        exclude = ['search_vector']
+        use_bulk = True
+        batch_size = IMPORT_CHUNK_SIZE
+        skip_diff = True
+
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self.imported_videos = []
+        self.updated_ids = []
+
+    def before_save_instance(self, instance, row, **kwargs):
+        # auto_now is not applied by bulk writes
+        instance.updated_at = timezone.now()
+
+    def bulk_create(self, using_transactions, dry_run, raise_errors, batch_size=None, result=None):
+        # Keep the created videos, the parent clears the pending instances
+        self.imported_videos += self.create_instances
+        super().bulk_create(using_transactions, dry_run, raise_errors, batch_size=batch_size, result=result)
+
+    def bulk_update(self, using_transactions, dry_run, raise_errors, batch_size=None, result=None):
+        self.updated_ids += [video.pk for video in self.update_instances]
+        super().bulk_update(using_transactions, dry_run, raise_errors, batch_size=batch_size, result=result)
+
+    def after_import(self, dataset, result, **kwargs):
+        if kwargs.get('dry_run') or result.has_errors():
+            return
+        created = [video for video in self.imported_videos if video.pk]
+        if created:
+            reset_id_sequence()
+        update_search_vectors(Video.objects.filter(pk__in=self.updated_ids + [video.pk for video in created]))
+        transaction.on_commit(bump_catalog_version)
+        # Videos imported with their renditions (e.g. a restored backup) are not transcoded again
+        schedule_transcodes([video for video in created if not video.renditions])
+
 
 @admin.register(Video)
 class VideoAdmin(ImportExportActionModelAdmin):
-    pass
+    resource_classes = [VideoResource]
+    actions = ['enqueue_transcodes']
+
+    @admin.action(description='Transcode selected videos')
+    def enqueue_transcodes(self, request, queryset):
+        videos = list(queryset.exclude(video_file='').exclude(video_file__isnull=True))
+        schedule_transcodes(videos)
+        self.message_user(request, f'Enqueued {len(videos)} transcode(s).')
+
+admin.site.register(Genre)
+
+
+@admin.register(TranscodeJob)
+class TranscodeJobAdmin(admin.ModelAdmin):
+    list_display = ['id', 'video', 'renditions', 'state', 'progress', 'attempts', 'return_code', 'duration', 'fps',
+                    'updated_at']
+    list_filter = ['state']
+
+
+@admin.register(TaskOutbox)
+class TaskOutboxAdmin(admin.ModelAdmin):
+    list_display = ['id', 'func', 'args', 'queue', 'created_at', 'enqueued_at']
+
 
-admin.site.register(Genre)
\ No newline at end of file
+@admin.register(UploadSession)
+class UploadSessionAdmin(admin.ModelAdmin):
+    list_display = ['id', 'user', 'filename', 'offset', 'length', 'updated_at']
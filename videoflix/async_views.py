@@ -0,0 +1,117 @@
+import asyncio
+from django.http import JsonResponse
+from django.utils.cache import get_conditional_response
+from django.utils.http import http_date, quote_etag
+from django.views import View
+from rest_framework import status
+from rest_framework.exceptions import APIException, NotAuthenticated
+from rest_framework.parsers import FormParser, JSONParser, MultiPartParser
+from rest_framework.request import Request
+from rest_framework.utils.encoders import JSONEncoder
+from videoflix.cache import (CACHE_TTL, acache_get, acache_set, acatalog_etag, aget_catalog_modified,
+                             etag_cache_key)
+from videoflix.metrics import record_cache_lookup
+from videoflix.views import ListGenres, ListGenresWithVideos, ListVideos, SearchVideos
+from users.authentication import CachedTokenAuthentication
+
+# Async (ASGI) variants of the catalog views. They share the queries and serializers
+# of the sync views, see aget_catalog_data() in views.py, and the catalog version, so
+# a catalog change invalidates both. Responses are cached per URL (their next links
+# point to the async URLs), so the async views keep their own cached responses.
+
+
+class AsyncAPIView(View):
+    """
+    Base of the async API views. DRF's APIView can not run coroutines, so this is a
+    plain Django view: the request is wrapped in a DRF Request (for query_params and
+    data), the token is checked with the async lookup and API exceptions become
+    JSON error responses, like in APIView.
+    """
+
+    authentication_classes = [CachedTokenAuthentication]
+    parser_classes = [JSONParser, FormParser, MultiPartParser]
+
+    @classmethod
+    def as_view(cls, **initkwargs):
+        # Token authenticated, no session cookies, so no CSRF check (like APIView)
+        view = super().as_view(**initkwargs)
+        view.csrf_exempt = True
+        return view
+
+    async def dispatch(self, request, *args, **kwargs):
+        request = Request(request, parsers=[parser() for parser in self.parser_classes])
+        try:
+            if self.authentication_classes:
+                await self.authenticate(request)
+            return await super().dispatch(request, *args, **kwargs)
+        except APIException as exc:
+            response = self.json_response(exc.detail if isinstance(exc.detail, (list, dict)) else {'detail': exc.detail},
+                                          status=exc.status_code)
+            if exc.status_code == status.HTTP_401_UNAUTHORIZED:
+                response['WWW-Authenticate'] = CachedTokenAuthentication.keyword
+            return response
+
+    async def authenticate(self, request):
+        # Only authenticated users, like IsAuthenticated
+        for authentication_class in self.authentication_classes:
+            user_auth = await authentication_class().aauthenticate(request)
+            if user_auth is not None:
+                request.user, request.auth = user_auth
+                return
+        raise NotAuthenticated()
+
+    def json_response(self, data, status=status.HTTP_200_OK):
+        return JsonResponse(data, status=status, safe=False, encoder=JSONEncoder,
+                            json_dumps_params={'ensure_ascii': False, 'separators': (',', ':')})
+
+
+class AsyncCatalogView(AsyncAPIView):
+    """
+    Cached and conditional (ETag / Last-Modified) catalog responses, like the
+    sync views with @catalog_condition, built by aget_catalog_data() of view_class.
+    """
+
+    http_method_names = ['get', 'head', 'options']
+    view_class = None
+
+    async def get(self, request, *args, **kwargs):
+        # Both validators are looked up at the same time
+        catalog_etag, modified = await asyncio.gather(acatalog_etag(request), aget_catalog_modified())
+        etag = quote_etag(catalog_etag)
+        last_modified = int(modified.timestamp())
+
+        response = get_conditional_response(request, etag=etag, last_modified=last_modified)
+        if response is None:
+            data = await acache_get(etag_cache_key(catalog_etag))
+            record_cache_lookup('catalog', data is not None)
+            if data is None:
+                data = await self.view_class().aget_catalog_data(request, *args, **kwargs)
+                await acache_set(etag_cache_key(catalog_etag), data, CACHE_TTL)
+            response = self.json_response(data)
+        response.headers.setdefault('ETag', etag)
+        response.headers.setdefault('Last-Modified', http_date(last_modified))
+        return response
+
+
+class AsyncListVideos(AsyncCatalogView):
+    """ Async variant of ListVideos (one page of videos, or a single video) """
+
+    view_class = ListVideos
+
+
+class AsyncSearchVideos(AsyncCatalogView):
+    """ Async variant of SearchVideos """
+
+    view_class = SearchVideos
+
+
+class AsyncListGenres(AsyncCatalogView):
+    """ Async variant of ListGenres """
+
+    view_class = ListGenres
+
+
+class AsyncListGenresWithVideos(AsyncCatalogView):
+    """ Async variant of ListGenresWithVideos """
+
+    view_class = ListGenresWithVideos
@@ -0,0 +1,159 @@
+import asyncio
+import hashlib
+import time
+import weakref
+import redis.asyncio
+from django.conf import settings
+from django.core.cache import cache, caches
+from django.core.cache.backends.base import DEFAULT_TIMEOUT
+from django.db.models import Max
+from django.utils import timezone
+from django_redis.cache import RedisCache
+from videoflix.models import Video, Genre
+
+CACHE_TTL = getattr(settings, 'CACHE_TTL', DEFAULT_TIMEOUT)
+
+CATALOG_VERSION_KEY = 'catalog:version'
+CATALOG_MODIFIED_KEY = 'catalog:modified'
+
+# Async Redis clients, per event loop (their connections can not be shared between loops)
+async_clients = weakref.WeakKeyDictionary()
+
+
+def get_async_redis():
+    """
+    Return an async client of the Redis server of the default cache, or None
+    if the cache is not Redis (e.g. the local memory cache of the tests).
+    """
+    if not isinstance(caches['default'], RedisCache):
+        return None
+    loop = asyncio.get_running_loop()
+    client = async_clients.get(loop)
+    if client is None:
+        # The first (primary) server of the cache settings, LOCATION may list several
+        cache_settings = settings.CACHES['default']
+        location = cache_settings['LOCATION']
+        if isinstance(location, str):
+            location = location.split(',')
+        client = redis.asyncio.Redis.from_url(location[0].strip(),
+                                              password=cache_settings.get('OPTIONS', {}).get('PASSWORD'))
+        async_clients[loop] = client
+    return client
+
+
+async def acache_get(key):
+    """
+    Async cache.get(). Keys and values are encoded like django_redis does,
+    so the sync and async code read the same entries (e.g. the catalog version and the tokens).
+    """
+    client = get_async_redis()
+    if client is None:
+        return await cache.aget(key)
+    value = await client.get(cache.client.make_key(key))
+    return None if value is None else cache.client.decode(value)
+
+
+async def acache_set(key, value, timeout=DEFAULT_TIMEOUT, only_new=False):
+    """
+    Async cache.set() (or cache.add() with only_new=True).
+    """
+    client = get_async_redis()
+    if client is None:
+        return await (cache.aadd if only_new else cache.aset)(key, value, timeout)
+    if timeout is DEFAULT_TIMEOUT:
+        timeout = cache.default_timeout
+    return await client.set(cache.client.make_key(key), cache.client.encode(value),
+                            ex=int(timeout) if timeout is not None else None, nx=only_new)
+
+
+def get_catalog_version():
+    """
+    Return the current catalog version. Every cached catalog response is
+    stored under this version, so bumping it invalidates all of them at once.
+    """
+    version = cache.get(CATALOG_VERSION_KEY)
+    if version is None:
+        # Start from the current time, so a lost version key never reuses old entries
+        cache.add(CATALOG_VERSION_KEY, int(time.time() * 1000), timeout=None)
+        version = cache.get(CATALOG_VERSION_KEY)
+    return version
+
+
+async def aget_catalog_version():
+    version = await acache_get(CATALOG_VERSION_KEY)
+    if version is None:
+        await acache_set(CATALOG_VERSION_KEY, int(time.time() * 1000), timeout=None, only_new=True)
+        version = await acache_get(CATALOG_VERSION_KEY)
+    return version
+
+
+def bump_catalog_version():
+    """
+    Invalidate all cached catalog responses.
+    """
+    cache.set(CATALOG_MODIFIED_KEY, timezone.now(), timeout=None)
+    try:
+        return cache.incr(CATALOG_VERSION_KEY)
+    except ValueError:
+        # The key does not exist (yet), so there is nothing to invalidate
+        return get_catalog_version()
+
+
+def get_catalog_modified():
+    """
+    Return the time of the last catalog change.
+    """
+    modified = cache.get(CATALOG_MODIFIED_KEY)
+    if modified is None:
+        # Fall back to the database, e.g. after the key was evicted
+        candidates = [
+            Video.objects.aggregate(modified=Max('updated_at'))['modified'],
+            Genre.objects.aggregate(modified=Max('updated_at'))['modified'],
+        ]
+        modified = max([candidate for candidate in candidates if candidate], default=timezone.now())
+        cache.add(CATALOG_MODIFIED_KEY, modified, timeout=None)
+    return modified
+
+
+async def aget_catalog_modified():
+    modified = await acache_get(CATALOG_MODIFIED_KEY)
+    if modified is None:
+        candidates = [
+            (await Video.objects.aaggregate(modified=Max('updated_at')))['modified'],
+            (await Genre.objects.aaggregate(modified=Max('updated_at')))['modified'],
+        ]
+        modified = max([candidate for candidate in candidates if candidate], default=timezone.now())
+        await acache_set(CATALOG_MODIFIED_KEY, modified, timeout=None, only_new=True)
+    return modified
+
+
+def catalog_etag(request, *args, **kwargs):
+    """
+    Strong ETag of a catalog response, built from the catalog version and
+    the full request URL (including host and query parameters).
+    It changes with every catalog change, without rendering the response.
+    """
+    return f'{get_catalog_version()}-{request_url_hash(request)}'
+
+
+async def acatalog_etag(request):
+    return f'{await aget_catalog_version()}-{request_url_hash(request)}'
+
+
+def request_url_hash(request):
+    return hashlib.md5(request.build_absolute_uri().encode()).hexdigest()
+
+
+def catalog_last_modified(request, *args, **kwargs):
+    return get_catalog_modified()
+
+
+def catalog_cache_key(request):
+    """
+    Build the cache key of a catalog response.
+    """
+    return etag_cache_key(catalog_etag(request))
+
+
+def etag_cache_key(etag):
+    return f'catalog:{etag}'
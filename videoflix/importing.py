@@ -0,0 +1,142 @@
+import json
+from django.core.management.color import no_style
+from django.db import connection, transaction
+from django.utils import timezone
+from django.utils.dateparse import parse_date
+
+from .cache import bump_catalog_version
+from .models import Video
+from .outbox import enqueue_many_on_commit, outbox_task
+from .search import update_search_vectors
+from .tasks import analyze_video
+
+# Columns written when an existing video is updated by an import
+IMPORT_UPDATE_FIELDS = ['title', 'description', 'created_at', 'video_file', 'thumbnail_file', 'genre', 'updated_at',
+                        'content_hash', 'width', 'height', 'video_codec', 'audio_codec', 'duration', 'bitrate',
+                        'keyframes_aligned', 'renditions', 'hls_manifest', 'preview_vtt']
+
+# Rows written to the database per bulk_create / bulk_update statement
+IMPORT_CHUNK_SIZE = 500
+
+# Imported videos are backfill, so they must not hold up fresh uploads on 'transcode-high'
+IMPORT_TRANSCODE_QUEUE = 'transcode-bulk'
+
+
+def build_video(row):
+    """
+    Build an unsaved video from an exported row (ndjson or csv, see export_videos).
+    Columns missing in exports of older versions get their defaults.
+    """
+    renditions = row.get('renditions') or {}
+    video = Video(
+        id=int(row['id']) if row.get('id') else None,
+        title=row['title'],
+        description=row.get('description') or '',
+        video_file=row.get('video_file') or None,
+        thumbnail_file=row.get('thumbnail_file') or None,
+        genre_id=int(row['genre']) if row.get('genre') else None,
+        content_hash=row.get('content_hash') or '',
+        width=optional(row.get('width'), int),
+        height=optional(row.get('height'), int),
+        video_codec=row.get('video_codec') or '',
+        audio_codec=row.get('audio_codec') or '',
+        duration=optional(row.get('duration'), float),
+        bitrate=optional(row.get('bitrate'), int),
+        # csv holds the text of the values
+        keyframes_aligned=row.get('keyframes_aligned') in (True, 'True', 'true', '1'),
+        renditions=json.loads(renditions) if isinstance(renditions, str) else renditions,
+        hls_manifest=row.get('hls_manifest') or None,
+        preview_vtt=row.get('preview_vtt') or None,
+    )
+    if row.get('created_at'):
+        created_at = row['created_at']
+        video.created_at = parse_date(created_at) if isinstance(created_at, str) else created_at
+    return video
+
+
+def optional(value, cast):
+    # Empty csv cells are None
+    return None if value is None or value == '' else cast(value)
+
+
+def save_chunk(videos):
+    """
+    Write a chunk of videos with one bulk_update and one bulk_create.
+    Returns the created videos and the number of updated ones.
+    """
+    ids = [video.id for video in videos if video.id is not None]
+    existing = set(Video.objects.filter(id__in=ids).values_list('id', flat=True))
+
+    now = timezone.now()
+    to_update = []
+    to_create = []
+    for video in videos:
+        # auto_now is not applied by bulk writes
+        video.updated_at = now
+        (to_update if video.id in existing else to_create).append(video)
+
+    if to_update:
+        Video.objects.bulk_update(to_update, IMPORT_UPDATE_FIELDS)
+    created = Video.objects.bulk_create(to_create) if to_create else []
+    # Bulk writes skip post_save, so update the search vectors of the chunk in one statement
+    update_search_vectors(Video.objects.filter(id__in=[video.id for video in to_update + created]))
+    return created, len(to_update)
+
+
+def import_videos(rows, chunk_size=IMPORT_CHUNK_SIZE, transcode=True):
+    """
+    Create or update videos from rows in chunks with bulk_create / bulk_update,
+    all in one transaction.
+
+    Bulk writes do not fire post_save, so nothing is transcoded mid-import. Once the
+    transaction commits, the catalog cache is invalidated and the transcodes of the
+    created videos are relayed from the outbox in pipelined batches. Videos imported
+    with their renditions (e.g. a restored backup) are not transcoded again.
+    Returns the number of created and updated videos.
+    """
+    created = []
+    updated = 0
+    with transaction.atomic():
+        chunk = []
+        for row in rows:
+            chunk.append(build_video(row))
+            if len(chunk) >= chunk_size:
+                new, count = save_chunk(chunk)
+                created += new
+                updated += count
+                chunk = []
+        if chunk:
+            new, count = save_chunk(chunk)
+            created += new
+            updated += count
+        if created:
+            reset_id_sequence()
+
+        transaction.on_commit(bump_catalog_version)
+        if transcode:
+            schedule_transcodes([video for video in created if not video.renditions])
+    return len(created), updated
+
+
+def reset_id_sequence():
+    """
+    Move the id sequence of the videos past the highest id. Rows inserted with
+    the ids of an export do not advance it (Postgres), so the next upload would
+    get an id that is taken.
+    """
+    statements = connection.ops.sequence_reset_sql(no_style(), [Video])
+    if statements:
+        with connection.cursor() as cursor:
+            for sql in statements:
+                cursor.execute(sql)
+
+
+def schedule_transcodes(videos, queue_name=IMPORT_TRANSCODE_QUEUE):
+    """
+    Record the analysis of every video (which plans and enqueues its transcoding
+    jobs on the same queue) in the outbox, with one insert. They are enqueued once
+    the current transaction commits, so workers never pick up a rolled back video.
+    """
+    return enqueue_many_on_commit([
+        outbox_task(queue_name, analyze_video, video.id, queue_name) for video in videos if video.video_file
+    ])
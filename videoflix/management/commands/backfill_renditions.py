@@ -0,0 +1,26 @@
+from django.core.management.base import BaseCommand
+from videoflix.models import Video
+from videoflix.tasks import RENDITIONS, record_renditions
+
+
+class Command(BaseCommand):
+    help = ('Record the renditions, HLS playlist and seek previews of videos that were converted before '
+            'they were stored on the video (or restored from files), so their URLs are served. Only files '
+            'that exist are recorded, nothing is converted.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--all', action='store_true',
+                            help='Record the files of all videos, not only of those without renditions.')
+
+    def handle(self, *args, **options):
+        videos = Video.objects.exclude(video_file='').exclude(video_file__isnull=True).order_by('id')
+        if not options['all']:
+            videos = videos.filter(renditions={})
+
+        count = 0
+        for video in videos.only('id', 'video_file').iterator():
+            if not video.video_file.storage.exists(video.video_file.name):
+                continue
+            record_renditions(video.id, video.video_file.path, list(RENDITIONS), previews=True)
+            count += 1
+        self.stderr.write(f'Recorded the files of {count} video(s)')
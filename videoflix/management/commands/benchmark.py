@@ -0,0 +1,207 @@
+import json
+import os
+import platform
+import random
+import statistics
+import subprocess
+import tempfile
+import time
+from datetime import date, timedelta
+from django.conf import settings
+from django.core.cache import cache
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, transaction
+from django.test import Client, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+from rest_framework.authtoken.models import Token
+from users.models import CustomUser
+from videoflix.models import Genre, Video
+from videoflix.tasks import RENDITIONS, convert_video, get_ffmpeg_command
+
+# The measured requests use their own cache, so the shared cache (Redis) is neither read nor flushed
+BENCHMARK_CACHES = {'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+                                'LOCATION': 'benchmark'}}
+
+BENCHMARK_USERNAME = 'benchmark_user'
+BENCHMARK_PASSWORD = 'benchmark-password'
+
+
+class Command(BaseCommand):
+    help = ('Benchmark the API and the transcoding. Seeds genres and videos in a transaction (rolled back '
+            'afterwards), measures throughput, latency percentiles and queries per request of the main '
+            'endpoints, with a cold and a warm catalog cache, and times convert_video on sources '
+            'generated by ffmpeg. Writes the results as JSON, to compare them across commits.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--videos', type=int, default=10000, help='Number of videos to seed.')
+        parser.add_argument('--genres', type=int, default=20, help='Number of genres to seed.')
+        parser.add_argument('--requests', type=int, default=200, help='Requests per endpoint and cache state.')
+        parser.add_argument('--login-requests', type=int, default=20,
+                            help='Login requests, each one hashes the password.')
+        parser.add_argument('--seed', type=int, default=0, help='Seed of the generated data and requests.')
+        parser.add_argument('--transcode-duration', type=int, default=10,
+                            help='Seconds of the generated transcoding sources.')
+        parser.add_argument('--transcode-sources', default='1280x720,1920x1080',
+                            help='Sizes of the generated transcoding sources, comma separated.')
+        parser.add_argument('--skip-transcode', action='store_true')
+        parser.add_argument('--output', '-o', default='-', help='File to write the JSON results to, "-" for stdout.')
+
+    def handle(self, *args, **options):
+        random.seed(options['seed'])
+        results = {
+            'commit': self.get_commit(),
+            'created_at': timezone.now().isoformat(),
+            'python': platform.python_version(),
+            'database': connection.vendor,
+            'options': {key: options[key] for key in ('videos', 'genres', 'requests', 'login_requests', 'seed')},
+        }
+
+        with override_settings(CACHES=BENCHMARK_CACHES, DEBUG=False,
+                               ALLOWED_HOSTS=[*settings.ALLOWED_HOSTS, 'testserver']):
+            with transaction.atomic():
+                video_ids = self.seed(options['videos'], options['genres'])
+                results['api'] = self.benchmark_api(video_ids, options['requests'], options['login_requests'])
+                transaction.set_rollback(True)
+
+        if not options['skip_transcode']:
+            results['transcode'] = self.benchmark_transcode(options['transcode_sources'],
+                                                            options['transcode_duration'])
+
+        self.write_results(results, options['output'])
+
+    def get_commit(self):
+        try:
+            return subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output=True, text=True, check=True,
+                                  cwd=settings.BASE_DIR).stdout.strip()
+        except (OSError, subprocess.CalledProcessError):
+            return None
+
+    def seed(self, videos, genres):
+        started = time.perf_counter()
+        genres = Genre.objects.bulk_create([Genre(name=f'Benchmark genre {i}') for i in range(genres)])
+        user = CustomUser.objects.create_user(username=BENCHMARK_USERNAME, password=BENCHMARK_PASSWORD,
+                                              email='benchmark@example.com')
+        Token.objects.create(user=user)
+
+        video_ids = []
+        for offset in range(0, videos, 5000):
+            batch = []
+            for i in range(offset, min(offset + 5000, videos)):
+                batch.append(Video(
+                    title=f'Benchmark video {i}', description='Generated for the benchmark',
+                    created_at=date(2020, 1, 1) + timedelta(days=random.randint(0, 1500)),
+                    genre=random.choice(genres) if genres else None,
+                    video_file=f'videos/benchmark_{i}.mp4', thumbnail_file=f'thumbnails/benchmark_{i}.jpg',
+                    renditions={name: {'path': f'videos/benchmark_{i}_{name}.mp4', 'size': 1000000,
+                                       'bitrate': rendition['maxrate'] * 1000, 'duration': 60.0,
+                                       'codec': 'h264', 'width': rendition['width'],
+                                       'height': rendition['height']}
+                                for name, rendition in RENDITIONS.items()},
+                ))
+            video_ids += [video.id for video in Video.objects.bulk_create(batch)]
+        if connection.vendor == 'postgresql':
+            with connection.cursor() as cursor:
+                cursor.execute(f'ANALYZE {Video._meta.db_table}')
+                cursor.execute(f'ANALYZE {Genre._meta.db_table}')
+        self.stderr.write(f'Seeded {len(genres)} genre(s) and {videos} video(s) in '
+                          f'{time.perf_counter() - started:.1f}s')
+        return video_ids
+
+    def benchmark_api(self, video_ids, requests, login_requests):
+        client = Client(HTTP_AUTHORIZATION=f'Token {Token.objects.get(user__username=BENCHMARK_USERNAME).key}')
+        # Name and URLs of the endpoints, the requests cycle through the URLs
+        endpoints = [
+            ('videos', ['/api/v1/videos/?page_size=50']),
+            ('video', [f'/api/v1/videos/{video_id}/'
+                       for video_id in random.sample(video_ids, min(len(video_ids), 10))]),
+            ('genres', ['/api/v1/genres/']),
+        ]
+
+        results = []
+        for name, urls in endpoints:
+            if not urls:
+                continue
+            request = lambda i: client.get(urls[i % len(urls)])
+            results.append(self.measure(name, 'cold', request, requests, clear_cache=True))
+            for i in range(len(urls)):
+                request(i)
+            results.append(self.measure(name, 'warm', request, requests))
+
+        login = {'username': BENCHMARK_USERNAME, 'password': BENCHMARK_PASSWORD}
+        results.append(self.measure('login', None, lambda i: Client().post('/api/v1/login/', login), login_requests))
+        return results
+
+    def measure(self, name, cache_state, request, count, clear_cache=False):
+        latencies = []
+        queries = []
+        errors = 0
+        started = time.perf_counter()
+        for i in range(count):
+            if clear_cache:
+                cache.clear()
+            with CaptureQueriesContext(connection) as captured:
+                request_started = time.perf_counter()
+                response = request(i)
+                latencies.append((time.perf_counter() - request_started) * 1000)
+            queries.append(len(captured))
+            errors += response.status_code >= 400
+        elapsed = time.perf_counter() - started
+
+        latencies.sort()
+        percentile = lambda p: latencies[min(int(len(latencies) * p), len(latencies) - 1)]
+        result = {
+            'endpoint': name, 'cache': cache_state, 'requests': count, 'errors': errors,
+            'requests_per_second': round(count / elapsed, 1),
+            'mean_ms': round(statistics.mean(latencies), 2), 'p50_ms': round(percentile(0.5), 2),
+            'p95_ms': round(percentile(0.95), 2), 'p99_ms': round(percentile(0.99), 2),
+            'max_ms': round(latencies[-1], 2),
+            'queries_mean': round(statistics.mean(queries), 2), 'queries_max': max(queries),
+        }
+        self.stderr.write(f'{name} ({cache_state or "no cache"}): {result["requests_per_second"]} req/s, '
+                          f'p50 {result["p50_ms"]}ms, p99 {result["p99_ms"]}ms, '
+                          f'{result["queries_mean"]} queries, {errors} error(s)')
+        return result
+
+    def benchmark_transcode(self, sources, duration):
+        results = []
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            for size in [size.strip() for size in sources.split(',') if size.strip()]:
+                source = os.path.join(tmp_dir, f'source_{size}.mp4')
+                self.generate_source(source, size, duration)
+
+                result = convert_video(source, previews=True)
+                if result.return_code != 0:
+                    raise CommandError(f'Converting the {size} source failed:\n{result.output}')
+
+                cpu = result.cpu_user + result.cpu_system
+                results.append({
+                    'source': size, 'duration': duration, 'renditions': list(RENDITIONS),
+                    'seconds': round(result.duration, 2), 'cpu_seconds': round(cpu, 2),
+                    'realtime_factor': round(duration / result.duration, 2),
+                    'fps': round(result.fps, 1) if result.fps is not None else None,
+                    'max_rss_mb': round(result.max_rss / 1024 / 1024, 1), 'bitrates': result.bitrates,
+                })
+                self.stderr.write(f'Transcode {size}, {duration}s: {result.duration:.1f}s, '
+                                  f'{duration / result.duration:.1f}x realtime, {cpu:.1f} CPU seconds, '
+                                  f'{result.max_rss / 1024 / 1024:.0f} MB peak memory')
+        return results
+
+    def generate_source(self, path, size, duration):
+        # Synthetic test pattern and tone, encoded like a typical upload
+        command = [*get_ffmpeg_command(), '-y', '-v', 'error',
+                   '-f', 'lavfi', '-i', f'testsrc2=size={size}:rate=30:duration={duration}',
+                   '-f', 'lavfi', '-i', f'sine=frequency=440:duration={duration}',
+                   '-c:v', 'libx264', '-preset', 'veryfast', '-b:v', '6M', '-c:a', 'aac', '-shortest', path]
+        process = subprocess.run(command, capture_output=True, text=True)
+        if process.returncode != 0:
+            raise CommandError(f'Generating the {size} source failed:\n{process.stderr}')
+
+    def write_results(self, results, path):
+        output = json.dumps(results, indent=2)
+        if path == '-':
+            self.stdout.write(output)
+        else:
+            with open(path, 'w') as file:
+                file.write(output + '\n')
+            self.stderr.write(f'Wrote the results to {path}')
@@ -0,0 +1,63 @@
+import random
+import statistics
+import time
+from django.core.management.base import BaseCommand
+from django.db import connection, transaction
+from videoflix.models import Video
+from videoflix.search import search_supported, search_videos, update_search_vectors
+
+# Words the titles, descriptions and queries of the benchmark are built from
+WORDS = ['ocean', 'mountain', 'city', 'night', 'forest', 'river', 'desert', 'journey', 'storm', 'winter',
+         'summer', 'island', 'space', 'robot', 'dragon', 'castle', 'secret', 'family', 'music', 'football',
+         'cooking', 'history', 'planet', 'animal', 'speed', 'love', 'crime', 'detective', 'war', 'dream']
+
+
+class Command(BaseCommand):
+    help = ('Measure the latency of the video search. Seeds the catalog with generated videos in a '
+            'transaction, which is rolled back afterwards (unless --keep is given).')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--rows', type=int, default=100000, help='Number of videos to seed.')
+        parser.add_argument('--queries', type=int, default=200, help='Number of searches to time.')
+        parser.add_argument('--page-size', type=int, default=20)
+        parser.add_argument('--seed', type=int, default=0, help='Seed of the generated data and queries.')
+        parser.add_argument('--keep', action='store_true', help='Keep the seeded videos.')
+
+    def handle(self, *args, **options):
+        random.seed(options['seed'])
+        with transaction.atomic():
+            self.seed(options['rows'])
+            self.run(options['queries'], options['page_size'])
+            if not options['keep']:
+                transaction.set_rollback(True)
+
+    def seed(self, rows):
+        started = time.perf_counter()
+        for offset in range(0, rows, 5000):
+            videos = Video.objects.bulk_create([
+                Video(title=' '.join(random.sample(WORDS, 3)), description=' '.join(random.choices(WORDS, k=30)))
+                for _ in range(min(5000, rows - offset))
+            ])
+            update_search_vectors(Video.objects.filter(id__in=[video.id for video in videos]))
+        if connection.vendor == 'postgresql':
+            # Fresh statistics, so the planner picks the GIN index
+            with connection.cursor() as cursor:
+                cursor.execute(f'ANALYZE {Video._meta.db_table}')
+        self.stdout.write(f'Seeded {rows} video(s) in {time.perf_counter() - started:.1f}s')
+
+    def run(self, queries, page_size):
+        mode = 'full-text (GIN index)' if search_supported() else 'LIKE fallback'
+        latencies = []
+        for _ in range(queries):
+            query = ' '.join(random.sample(WORDS, random.randint(1, 2)))
+            started = time.perf_counter()
+            list(search_videos(Video.objects.defer('search_vector'), query)[:page_size + 1])
+            latencies.append((time.perf_counter() - started) * 1000)
+
+        latencies.sort()
+        percentile = lambda p: latencies[min(int(len(latencies) * p), len(latencies) - 1)]
+        self.stdout.write(f'Search, {mode}, {queries} queries: '
+                          f'mean {statistics.mean(latencies):.1f}ms, p50 {percentile(0.5):.1f}ms, '
+                          f'p95 {percentile(0.95):.1f}ms, p99 {percentile(0.99):.1f}ms, max {latencies[-1]:.1f}ms')
+        if search_supported():
+            self.stdout.write(search_videos(Video.objects.all(), 'ocean')[:page_size].explain())
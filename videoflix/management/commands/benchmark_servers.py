@@ -0,0 +1,135 @@
+import http.client
+import itertools
+import json
+import socket
+import statistics
+import subprocess
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from django.core.management.base import BaseCommand, CommandError
+from rest_framework.authtoken.models import Token
+from users.models import CustomUser
+
+# Method, sync URL (WSGI) and async URL (ASGI) of the compared endpoints
+ENDPOINTS = {
+    'videos': ('GET', '/api/v1/videos/?page_size=20', '/api/v1/async/videos/?page_size=20'),
+    'genres': ('GET', '/api/v1/genres/with-videos/', '/api/v1/async/genres/with-videos/'),
+    'login': ('POST', '/api/v1/login/', '/api/v1/async/login/'),
+}
+
+# Seconds to wait for a server to accept connections
+SERVER_START_TIMEOUT = 30
+
+
+class Command(BaseCommand):
+    help = ('Compare requests/s and latency of the sync views under WSGI (gunicorn) with the async views '
+            'under ASGI (gunicorn with uvicorn workers). Both servers are started in turn, with the same '
+            'number of processes, and get the same load.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--username', required=True, help='Existing, active user to log in and query as.')
+        parser.add_argument('--password', required=True)
+        parser.add_argument('--endpoints', default=','.join(ENDPOINTS), help=f'Any of {", ".join(ENDPOINTS)}.')
+        parser.add_argument('--requests', type=int, default=2000, help='Requests per endpoint and server.')
+        parser.add_argument('--concurrency', type=int, default=50, help='Parallel client connections.')
+        parser.add_argument('--workers', type=int, default=2, help='Server processes.')
+        parser.add_argument('--threads', type=int, default=4, help='Threads per WSGI process.')
+        parser.add_argument('--port', type=int, default=8765)
+
+    def handle(self, *args, **options):
+        endpoints = [name.strip() for name in options['endpoints'].split(',') if name.strip()]
+        unknown = set(endpoints) - set(ENDPOINTS)
+        if unknown:
+            raise CommandError(f'Unknown endpoint(s): {", ".join(sorted(unknown))}')
+        try:
+            user = CustomUser.objects.get(username=options['username'], is_active=True)
+        except CustomUser.DoesNotExist:
+            raise CommandError(f'There is no active user {options["username"]}')
+        token, _ = Token.objects.get_or_create(user=user)
+        headers = {'Authorization': f'Token {token.key}', 'Content-Type': 'application/json'}
+        login = json.dumps({'username': options['username'], 'password': options['password']})
+
+        workers = str(options['workers'])
+        servers = [
+            ('WSGI', 1, [sys.executable, '-m', 'gunicorn', 'videoflix_backend.wsgi:application',
+                         '--workers', workers, '--threads', str(options['threads'])]),
+            ('ASGI', 2, [sys.executable, '-m', 'gunicorn', 'videoflix_backend.asgi:application',
+                         '--workers', workers, '--worker-class', 'uvicorn.workers.UvicornWorker']),
+        ]
+        for server, url_index, command in servers:
+            with self.server(command, options['port']):
+                for name in endpoints:
+                    method, url = ENDPOINTS[name][0], ENDPOINTS[name][url_index]
+                    body = login if name == 'login' else None
+                    # Warm up the connections and caches
+                    self.load(options['port'], method, url, headers, body, options['concurrency'],
+                              options['concurrency'])
+                    elapsed, latencies, errors = self.load(options['port'], method, url, headers, body,
+                                                           options['requests'], options['concurrency'])
+                    self.report(server, name, elapsed, latencies, errors)
+
+    @contextmanager
+    def server(self, command, port):
+        process = subprocess.Popen([*command, '--bind', f'127.0.0.1:{port}', '--log-level', 'warning'])
+        try:
+            self.wait_for_port(port, process)
+            yield
+        finally:
+            process.terminate()
+            process.wait()
+
+    def wait_for_port(self, port, process):
+        deadline = time.monotonic() + SERVER_START_TIMEOUT
+        while time.monotonic() < deadline:
+            if process.poll() is not None:
+                raise CommandError(f'The server exited with {process.returncode}')
+            try:
+                socket.create_connection(('127.0.0.1', port), timeout=1).close()
+                return
+            except OSError:
+                time.sleep(0.2)
+        raise CommandError(f'The server did not start within {SERVER_START_TIMEOUT}s')
+
+    def load(self, port, method, url, headers, body, requests, concurrency):
+        """
+        Send the requests over concurrency keep-alive connections.
+        Returns the elapsed seconds, the latencies (ms) and the number of errors.
+        """
+        counter = itertools.count()
+        latencies = []
+        errors = []
+        lock = threading.Lock()
+
+        def client():
+            connection = http.client.HTTPConnection('127.0.0.1', port, timeout=30)
+            try:
+                while next(counter) < requests:
+                    started = time.perf_counter()
+                    try:
+                        connection.request(method, url, body=body, headers=headers)
+                        response = connection.getresponse()
+                        response.read()
+                        failed = response.status >= 400
+                    except (OSError, http.client.HTTPException):
+                        connection.close()
+                        failed = True
+                    with lock:
+                        latencies.append((time.perf_counter() - started) * 1000)
+                        errors.append(failed)
+            finally:
+                connection.close()
+
+        started = time.perf_counter()
+        with ThreadPoolExecutor(concurrency) as executor:
+            for _ in range(concurrency):
+                executor.submit(client)
+        return time.perf_counter() - started, sorted(latencies), sum(errors)
+
+    def report(self, server, name, elapsed, latencies, errors):
+        percentile = lambda p: latencies[min(int(len(latencies) * p), len(latencies) - 1)]
+        self.stdout.write(f'{server} {name}: {len(latencies)} requests, {len(latencies) / elapsed:.0f} req/s, '
+                          f'mean {statistics.mean(latencies):.1f}ms, p50 {percentile(0.5):.1f}ms, '
+                          f'p99 {percentile(0.99):.1f}ms, {errors} error(s)')
@@ -0,0 +1,20 @@
+from datetime import timedelta
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+from videoflix.models import UploadSession
+
+
+class Command(BaseCommand):
+    help = 'Delete resumable uploads (and their received bytes) that were not continued for a while.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--hours', type=int, default=24, help='Hours since the last received bytes.')
+
+    def handle(self, *args, **options):
+        expired = UploadSession.objects.filter(updated_at__lt=timezone.now() - timedelta(hours=options['hours']))
+        count = 0
+        # One by one, so the files are deleted along (see signals.py)
+        for session in expired.iterator():
+            session.delete()
+            count += 1
+        self.stdout.write(f'Deleted {count} upload session(s)')
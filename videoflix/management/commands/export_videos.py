@@ -0,0 +1,84 @@
+import csv
+import gzip
+import io
+import json
+import sys
+from django.core.management.base import BaseCommand, CommandError
+from django.core.serializers.json import DjangoJSONEncoder
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+from videoflix.models import Video
+
+# Columns of the exported rows. The analysis and the converted files are included,
+# so a restored catalog is served without transcoding it again.
+EXPORT_FIELDS = ['id', 'title', 'description', 'created_at', 'updated_at', 'video_file', 'thumbnail_file', 'genre',
+                 'content_hash', 'width', 'height', 'video_codec', 'audio_codec', 'duration', 'bitrate',
+                 'keyframes_aligned', 'renditions', 'hls_manifest', 'preview_vtt']
+
+
+class Command(BaseCommand):
+    help = ('Export the video catalog as newline-delimited JSON or CSV. Rows are streamed from the database '
+            'in chunks, so large catalogs are exported in constant memory.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--output', '-o', default='-', help='File to write to, "-" for stdout (default).')
+        parser.add_argument('--format', choices=['ndjson', 'csv'], default='ndjson')
+        parser.add_argument('--gzip', action='store_true', help='Compress the output with gzip.')
+        parser.add_argument('--since', help='Only export videos updated at or after this ISO timestamp.')
+        parser.add_argument('--after-id', type=int, help='Only export videos with a greater id.')
+        parser.add_argument('--chunk-size', type=int, default=2000, help='Rows fetched from the database at once.')
+
+    def handle(self, *args, **options):
+        videos = Video.objects.order_by('id')
+        if options['since']:
+            since = parse_datetime(options['since'])
+            if since is None:
+                raise CommandError(f"Invalid --since timestamp: {options['since']}")
+            if timezone.is_naive(since):
+                since = timezone.make_aware(since)
+            videos = videos.filter(updated_at__gte=since)
+        if options['after_id'] is not None:
+            videos = videos.filter(id__gt=options['after_id'])
+        rows = videos.values(*EXPORT_FIELDS).iterator(chunk_size=options['chunk_size'])
+
+        # The export is written to a binary stream, self.stdout would append line endings to the CSV rows
+        if options['output'] == '-':
+            # Text written to stdout before comes first
+            sys.stdout.flush()
+            binary = sys.stdout.buffer
+        else:
+            binary = open(options['output'], 'wb')
+        compressed = gzip.GzipFile(fileobj=binary, mode='wb') if options['gzip'] else None
+        output = io.TextIOWrapper(compressed or binary, encoding='utf-8', newline='')
+        try:
+            count, last_id = self.write_rows(rows, output, options['format'])
+        finally:
+            # Flush the text layer without closing the stream below it
+            output.flush()
+            output.detach()
+            if compressed:
+                # Writes the gzip trailer, it leaves the binary stream open
+                compressed.close()
+            if binary is sys.stdout.buffer:
+                binary.flush()
+            else:
+                binary.close()
+
+        # Summary on stderr, so stdout only holds the export
+        self.stderr.write(f'Exported {count} video(s), last id: {last_id}')
+
+    def write_rows(self, rows, output, format):
+        count = 0
+        last_id = None
+        if format == 'csv':
+            writer = csv.DictWriter(output, fieldnames=EXPORT_FIELDS)
+            writer.writeheader()
+        for row in rows:
+            if format == 'csv':
+                # Nested values are written as JSON, like in ndjson
+                writer.writerow({**row, 'renditions': json.dumps(row['renditions'])})
+            else:
+                output.write(json.dumps(row, cls=DjangoJSONEncoder) + '\n')
+            count += 1
+            last_id = row['id']
+        return count, last_id
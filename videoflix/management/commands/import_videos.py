@@ -0,0 +1,52 @@
+import csv
+import gzip
+import json
+import sys
+from django.core.management.base import BaseCommand, CommandError
+from videoflix.importing import import_videos, IMPORT_CHUNK_SIZE
+
+
+class Command(BaseCommand):
+    help = ('Import videos from newline-delimited JSON or CSV, as written by export_videos. Rows with '
+            'an existing id are updated, all others created, in chunks and in one transaction. '
+            'Transcodes of the created videos are enqueued after the import is committed.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--input', '-i', default='-', help='File to read from, "-" for stdin (default).')
+        parser.add_argument('--format', choices=['ndjson', 'csv'], default='ndjson')
+        parser.add_argument('--gzip', action='store_true', help='Decompress the input with gzip.')
+        parser.add_argument('--chunk-size', type=int, default=IMPORT_CHUNK_SIZE,
+                            help='Rows written to the database at once.')
+        parser.add_argument('--no-transcode', action='store_true',
+                            help='Do not enqueue transcodes of the created videos.')
+
+    def handle(self, *args, **options):
+        input = self.open_input(options['input'], options['gzip'])
+        try:
+            rows = self.read_rows(input, options['format'])
+            created, updated = import_videos(rows, chunk_size=options['chunk_size'],
+                                             transcode=not options['no_transcode'])
+        except (KeyError, ValueError) as error:
+            raise CommandError(f'Invalid input: {error!r}')
+        finally:
+            if input is not sys.stdin:
+                input.close()
+
+        self.stderr.write(f'Created {created} video(s), updated {updated} video(s)')
+
+    def open_input(self, path, compressed):
+        if path == '-':
+            if compressed:
+                return gzip.open(sys.stdin.buffer, 'rt', encoding='utf-8')
+            return sys.stdin
+        if compressed:
+            return gzip.open(path, 'rt', encoding='utf-8', newline='')
+        return open(path, encoding='utf-8', newline='')
+
+    def read_rows(self, input, format):
+        if format == 'csv':
+            yield from csv.DictReader(input)
+            return
+        for line in input:
+            if line.strip():
+                yield json.loads(line)
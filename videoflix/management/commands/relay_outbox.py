@@ -0,0 +1,29 @@
+import time
+from datetime import timedelta
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+from videoflix.models import TaskOutbox
+from videoflix.outbox import OUTBOX_BATCH_SIZE, relay_outbox
+
+
+class Command(BaseCommand):
+    help = ('Enqueue the tasks of the outbox that were not relayed right after their commit '
+            '(e.g. because Redis was not reachable), and purge relayed tasks.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=OUTBOX_BATCH_SIZE,
+                            help='Tasks enqueued per transaction and Redis round trip.')
+        parser.add_argument('--loop', action='store_true', help='Keep relaying, every --interval seconds.')
+        parser.add_argument('--interval', type=float, default=5)
+        parser.add_argument('--purge-days', type=int, default=7, help='Days relayed tasks are kept.')
+
+    def handle(self, *args, **options):
+        while True:
+            relayed = relay_outbox(batch_size=options['batch_size'])
+            purged, _ = TaskOutbox.objects.filter(
+                enqueued_at__lt=timezone.now() - timedelta(days=options['purge_days'])).delete()
+            if relayed or purged or not options['loop']:
+                self.stderr.write(f'Relayed {relayed} task(s), purged {purged} task(s)')
+            if not options['loop']:
+                break
+            time.sleep(options['interval'])
@@ -0,0 +1,93 @@
+import json
+from datetime import timedelta
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+from videoflix.models import TranscodeJob
+from videoflix.tasks import RENDITIONS
+
+
+class Command(BaseCommand):
+    help = ('Report the transcoding throughput of the workers from the finished jobs: minutes of video '
+            'converted per CPU-hour and per wall-clock hour, encoded frames per second and peak memory '
+            'per rendition set (one ffmpeg run), and the output bitrates per rendition. Use it to size '
+            'the worker fleet and to compare encoder settings.')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--days', type=int, default=30, help='Jobs finished in the last days.')
+        parser.add_argument('--json', action='store_true', help='Write the report as JSON.')
+
+    def handle(self, *args, **options):
+        jobs = (TranscodeJob.objects
+                .filter(state=TranscodeJob.STATE_DONE, cpu_user__isnull=False, source_duration__gt=0,
+                        updated_at__gte=timezone.now() - timedelta(days=options['days']))
+                .values('renditions', 'source_duration', 'duration', 'cpu_user', 'cpu_system', 'max_rss', 'fps',
+                        'output_bitrates'))
+
+        # Renditions of a job are converted in one run, so its CPU time can only be told per rendition set
+        runs = {}
+        bitrates = {}
+        for job in jobs.iterator():
+            run = runs.setdefault(','.join(job['renditions']), {'jobs': 0, 'video_seconds': 0, 'wall_seconds': 0,
+                                                                'cpu_seconds': 0, 'fps': [], 'max_rss': 0})
+            run['jobs'] += 1
+            run['video_seconds'] += job['source_duration']
+            run['wall_seconds'] += job['duration'] or 0
+            run['cpu_seconds'] += job['cpu_user'] + (job['cpu_system'] or 0)
+            if job['fps'] is not None:
+                run['fps'].append(job['fps'])
+            run['max_rss'] = max(run['max_rss'], job['max_rss'] or 0)
+            for resolution, bitrate in job['output_bitrates'].items():
+                bitrates.setdefault(resolution, []).append(bitrate)
+
+        report = {
+            'days': options['days'],
+            'rendition_sets': [self.summarize(renditions, run) for renditions, run in sorted(runs.items())],
+            'renditions': [
+                {'rendition': resolution, 'jobs': len(values), 'mean_bitrate': round(sum(values) / len(values)),
+                 'max_bitrate': max(values), 'target_bitrate': self.target_bitrate(resolution)}
+                # Renditions that were removed from RENDITIONS since are left out
+                for resolution, values in sorted(bitrates.items(), key=lambda item: self.height(item[0]))
+                if resolution in RENDITIONS
+            ],
+        }
+        if options['json']:
+            self.stdout.write(json.dumps(report, indent=2))
+        else:
+            self.write_text(report)
+
+    def summarize(self, renditions, run):
+        video_minutes = run['video_seconds'] / 60
+        cpu_hours = run['cpu_seconds'] / 3600
+        wall_hours = run['wall_seconds'] / 3600
+        return {
+            'renditions': renditions, 'jobs': run['jobs'], 'video_minutes': round(video_minutes, 1),
+            'cpu_hours': round(cpu_hours, 3), 'wall_hours': round(wall_hours, 3),
+            'video_minutes_per_cpu_hour': round(video_minutes / cpu_hours, 1) if cpu_hours else None,
+            'video_minutes_per_wall_hour': round(video_minutes / wall_hours, 1) if wall_hours else None,
+            'mean_fps': round(sum(run['fps']) / len(run['fps']), 1) if run['fps'] else None,
+            'peak_rss_mb': round(run['max_rss'] / 1024 / 1024, 1),
+        }
+
+    def target_bitrate(self, resolution):
+        # Highest bitrate of the rendition, video and audio (see rendition_fits)
+        return (RENDITIONS[resolution]['maxrate'] + RENDITIONS[resolution]['audio_bitrate']) * 1000
+
+    def height(self, resolution):
+        return RENDITIONS.get(resolution, {}).get('height', 0)
+
+    def write_text(self, report):
+        self.stdout.write(f'Finished transcoding jobs of the last {report["days"]} day(s)')
+        if not report['rendition_sets']:
+            self.stdout.write('No jobs with resource usage found')
+            return
+        for run in report['rendition_sets']:
+            self.stdout.write(
+                f'{run["renditions"]}: {run["jobs"]} job(s), {run["video_minutes"]} video minutes, '
+                f'{run["video_minutes_per_cpu_hour"]} video minutes per CPU-hour, '
+                f'{run["video_minutes_per_wall_hour"]} per wall-clock hour, {run["mean_fps"]} fps, '
+                f'peak memory {run["peak_rss_mb"]} MB')
+        for rendition in report['renditions']:
+            self.stdout.write(
+                f'{rendition["rendition"]}: mean bitrate {rendition["mean_bitrate"] // 1000} kbit/s, '
+                f'max {rendition["max_bitrate"] // 1000} kbit/s (target {rendition["target_bitrate"] // 1000} kbit/s) '
+                f'in {rendition["jobs"]} job(s)')
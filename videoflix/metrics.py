@@ -0,0 +1,193 @@
+import bisect
+import os
+import threading
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from django.conf import settings
+
+# Share of the requests measured by PerformanceMiddleware, 0 (none) to 1 (all)
+DEFAULT_SAMPLE_RATE = 0.1
+
+# Upper bounds of the histogram buckets, in seconds and in queries per request
+DURATION_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+QUERY_BUCKETS = (0, 1, 2, 3, 5, 10, 20, 50, 100)
+
+# Methods exported as they are, others (sent by the client) as 'other' to keep the series bounded
+HTTP_METHODS = ('GET', 'HEAD', 'POST', 'PUT', 'PATCH', 'DELETE', 'OPTIONS')
+
+# Name: (type, help, buckets) of the exported metrics
+METRICS = {
+    'videoflix_request_duration_seconds': (
+        'histogram', 'Wall time of the sampled requests, per view.', DURATION_BUCKETS),
+    'videoflix_request_db_queries': (
+        'histogram', 'Database queries of the sampled requests, per view.', QUERY_BUCKETS),
+    'videoflix_request_db_duration_seconds': (
+        'histogram', 'Time spent in database queries by the sampled requests, per view.', DURATION_BUCKETS),
+    'videoflix_request_serializer_duration_seconds': (
+        'histogram', 'Time spent in serializers by the sampled requests, per view.', DURATION_BUCKETS),
+    'videoflix_cache_lookups_total': (
+        'counter', 'Cache hits and misses of the sampled requests, per view and cache.', None),
+}
+
+# Measurements of the sampled request being handled (None if it is not sampled)
+current_request = ContextVar('current_request', default=None)
+
+
+class RequestMetrics:
+    """ Measurements of one sampled request """
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.queries = 0
+        self.query_time = 0.0
+        self.serializer_time = 0.0
+        # Cache name: [hits, misses]
+        self.cache_lookups = {}
+
+    def server_timing(self, total):
+        """
+        Value of the Server-Timing header, durations in milliseconds.
+        """
+        hits = sum(hits for hits, misses in self.cache_lookups.values())
+        misses = sum(misses for hits, misses in self.cache_lookups.values())
+        return ', '.join([
+            f'db;dur={self.query_time * 1000:.1f};desc="{self.queries} queries"',
+            f'cache;desc="{hits} hits, {misses} misses"',
+            f'serializer;dur={self.serializer_time * 1000:.1f}',
+            f'total;dur={total * 1000:.1f}',
+        ])
+
+
+def get_sample_rate():
+    return getattr(settings, 'PERFORMANCE_SAMPLE_RATE', DEFAULT_SAMPLE_RATE)
+
+
+def record_query(execute, sql, params, many, context):
+    """
+    Database execute wrapper (see install_query_timer), which times the queries
+    of sampled requests. Other queries only pay for the context variable lookup.
+    """
+    metrics = current_request.get()
+    if metrics is None:
+        return execute(sql, params, many, context)
+    started = time.perf_counter()
+    try:
+        return execute(sql, params, many, context)
+    finally:
+        metrics.queries += 1
+        metrics.query_time += time.perf_counter() - started
+
+
+def install_query_timer(connection):
+    # Installed on every connection, as async views query from another thread (and connection)
+    if record_query not in connection.execute_wrappers:
+        connection.execute_wrappers.append(record_query)
+
+
+def record_cache_lookup(name, hit):
+    metrics = current_request.get()
+    if metrics is not None:
+        lookups = metrics.cache_lookups.setdefault(name, [0, 0])
+        lookups[0 if hit else 1] += 1
+
+
+@contextmanager
+def measure_serializer():
+    metrics = current_request.get()
+    if metrics is None:
+        yield
+        return
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        metrics.serializer_time += time.perf_counter() - started
+
+
+class Histogram:
+    def __init__(self, buckets):
+        self.buckets = buckets
+        # One count per bucket, the last one for values above all buckets (+Inf)
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+
+
+class MetricsRegistry:
+    """
+    Histograms and counters of the sampled requests of this process. Every
+    sample carries the pid, so the series of several workers can be summed up.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        # (name, labels): Histogram or count
+        self.samples = {}
+
+    def observe(self, name, labels, value):
+        with self.lock:
+            histogram = self.samples.get((name, labels))
+            if histogram is None:
+                histogram = self.samples[(name, labels)] = Histogram(METRICS[name][2])
+            histogram.observe(value)
+
+    def inc(self, name, labels, amount=1):
+        with self.lock:
+            self.samples[(name, labels)] = self.samples.get((name, labels), 0) + amount
+
+    def record_request(self, view, method, metrics, total):
+        labels = (('view', view), ('method', method if method in HTTP_METHODS else 'other'))
+        self.observe('videoflix_request_duration_seconds', labels, total)
+        self.observe('videoflix_request_db_queries', labels, metrics.queries)
+        self.observe('videoflix_request_db_duration_seconds', labels, metrics.query_time)
+        self.observe('videoflix_request_serializer_duration_seconds', labels, metrics.serializer_time)
+        for name, (hits, misses) in metrics.cache_lookups.items():
+            for result, count in (('hit', hits), ('miss', misses)):
+                if count:
+                    self.inc('videoflix_cache_lookups_total',
+                             (('view', view), ('cache', name), ('result', result)), count)
+
+    def render(self):
+        """
+        Return the metrics in the Prometheus text format.
+        """
+        with self.lock:
+            samples = sorted(self.samples.items(), key=lambda item: item[0])
+            samples = [(key, (list(value.counts), value.sum) if isinstance(value, Histogram) else value)
+                       for key, value in samples]
+
+        pid = ('pid', str(os.getpid()))
+        lines = []
+        for name, (metric_type, help_text, buckets) in METRICS.items():
+            lines += [f'# HELP {name} {help_text}', f'# TYPE {name} {metric_type}']
+            for (sample_name, labels), value in samples:
+                if sample_name != name:
+                    continue
+                labels = (pid, *labels)
+                if metric_type == 'counter':
+                    lines.append(f'{name}{format_labels(labels)} {value}')
+                    continue
+                counts, total = value
+                cumulative = 0
+                for bound, count in zip([*buckets, '+Inf'], counts):
+                    cumulative += count
+                    lines.append(f'{name}_bucket{format_labels((*labels, ("le", str(bound))))} {cumulative}')
+                lines.append(f'{name}_sum{format_labels(labels)} {total}')
+                lines.append(f'{name}_count{format_labels(labels)} {cumulative}')
+        return '\n'.join(lines) + '\n'
+
+    def clear(self):
+        with self.lock:
+            self.samples.clear()
+
+
+def format_labels(labels):
+    escape = lambda value: value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+    return '{' + ','.join(f'{key}="{escape(value)}"' for key, value in labels) + '}'
+
+
+registry = MetricsRegistry()
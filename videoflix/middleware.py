@@ -0,0 +1,56 @@
+import random
+import time
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+from videoflix.metrics import RequestMetrics, current_request, get_sample_rate, registry
+
+
+class PerformanceMiddleware:
+    """
+    Measures a sample of the requests (PERFORMANCE_SAMPLE_RATE): wall time,
+    database queries and their time, cache hits and misses and serializer time.
+    Adds them to the response as Server-Timing header and to the histograms
+    exported by PerformanceMetricsView. Other requests are passed through.
+    Supports sync and async views.
+    """
+
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        if iscoroutinefunction(get_response):
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+        if random.random() >= get_sample_rate():
+            return self.get_response(request)
+
+        metrics = RequestMetrics()
+        token = current_request.set(metrics)
+        try:
+            response = self.get_response(request)
+        finally:
+            current_request.reset(token)
+        return self.finish(request, response, metrics)
+
+    async def __acall__(self, request):
+        if random.random() >= get_sample_rate():
+            return await self.get_response(request)
+
+        metrics = RequestMetrics()
+        token = current_request.set(metrics)
+        try:
+            response = await self.get_response(request)
+        finally:
+            current_request.reset(token)
+        return self.finish(request, response, metrics)
+
+    def finish(self, request, response, metrics):
+        total = time.perf_counter() - metrics.started
+        response['Server-Timing'] = metrics.server_timing(total)
+        # The URL pattern, not the path, so the number of series stays bounded
+        match = request.resolver_match
+        registry.record_request(match.route if match else 'unmatched', request.method, metrics, total)
+        return response
@@ -1,9 +1,27 @@
+import uuid
+from django.conf import settings
+from django.contrib.postgres.indexes import GinIndex
+from django.contrib.postgres.search import SearchVectorField
 from django.db import models
 from datetime import date
 
+
+class SearchVectorIndex(GinIndex):
+    """
+    GIN index on Postgres. Other databases (SQLite test runs) get a plain index,
+    the search falls back to LIKE there anyway.
+    """
+
+    def create_sql(self, model, schema_editor, using='', **kwargs):
+        if schema_editor.connection.vendor != 'postgresql':
+            return models.Index.create_sql(self, model, schema_editor, using=using, **kwargs)
+        return super().create_sql(model, schema_editor, using=using, **kwargs)
+
+
 # Genre model
 class Genre(models.Model):
     name = models.CharField(max_length=100, unique=True)
+    updated_at = models.DateTimeField(auto_now=True)
 
     def __str__(self):
         return f'({self.id}) - {self.name}'
@@ -14,8 +32,113 @@ class Video(models.Model):
     description = models.CharField(max_length=500)
     created_at = models.DateField(default=date.today)
     video_file = models.FileField(upload_to='videos', blank=True, null=True)
+    # SHA-256 of the video file, videos with the same content share the file and its renditions
+    content_hash = models.CharField(max_length=64, blank=True, db_index=True, editable=False)
     thumbnail_file = models.FileField(upload_to='thumbnails', blank=True, null=True)
     genre = models.ForeignKey(Genre, on_delete=models.SET_NULL, null=True, blank=True)
+    # Source media, as analyzed by ffprobe before transcoding
+    width = models.PositiveIntegerField(null=True, blank=True, editable=False)
+    height = models.PositiveIntegerField(null=True, blank=True, editable=False)
+    video_codec = models.CharField(max_length=50, blank=True, editable=False)
+    audio_codec = models.CharField(max_length=50, blank=True, editable=False)
+    duration = models.FloatField(null=True, blank=True, editable=False)  # Seconds
+    bitrate = models.PositiveIntegerField(null=True, blank=True, editable=False)  # bit/s
+    # A keyframe starts every HLS segment, so the source can be copied into a rendition
+    keyframes_aligned = models.BooleanField(default=False, editable=False)
+    # Converted renditions by name (path, size, bitrate, duration, codec, width, height),
+    # recorded by the transcoding task once the files exist
+    renditions = models.JSONField(default=dict, blank=True, editable=False)
+    hls_manifest = models.FileField(blank=True, null=True, editable=False)
+    preview_vtt = models.FileField(blank=True, null=True, editable=False)
+    updated_at = models.DateTimeField(auto_now=True, db_index=True)
+    # Title and description for the full-text search, kept current by videoflix/search.py
+    search_vector = SearchVectorField(null=True, editable=False)
+
+    class Meta:
+        indexes = [
+            # Backs the keyset pagination of the video listing
+            models.Index(fields=['created_at', 'id']),
+            # Backs the genre filter (with the same keyset order) and the newest videos per genre
+            models.Index(fields=['genre', 'created_at', 'id']),
+            SearchVectorIndex(fields=['search_vector'], name='video_search_vector_idx'),
+        ]
 
     def __str__(self):
         return f'({self.id}) - {self.title}'
+
+
+# Transcoding job of a video, one per ffmpeg run
+class TranscodeJob(models.Model):
+    STATE_QUEUED = 'queued'
+    STATE_RUNNING = 'running'
+    STATE_RETRYING = 'retrying'
+    STATE_DONE = 'done'
+    STATE_FAILED = 'failed'
+    STATE_CHOICES = [
+        (STATE_QUEUED, 'Queued'),
+        (STATE_RUNNING, 'Running'),
+        (STATE_RETRYING, 'Retrying'),
+        (STATE_DONE, 'Done'),
+        (STATE_FAILED, 'Failed'),
+    ]
+
+    video = models.ForeignKey(Video, on_delete=models.CASCADE, related_name='transcode_jobs')
+    renditions = models.JSONField(default=list)
+    previews = models.BooleanField(default=False)  # Extract the poster and seek previews as well
+    state = models.CharField(max_length=20, choices=STATE_CHOICES, default=STATE_QUEUED)
+    progress = models.FloatField(default=0)  # Percent of the source converted
+    return_code = models.IntegerField(null=True, blank=True)
+    duration = models.FloatField(null=True, blank=True)  # Seconds the ffmpeg run took
+    attempts = models.PositiveIntegerField(default=0)
+    output = models.TextField(blank=True)  # Last lines of the ffmpeg output
+    # Resource usage of the last ffmpeg run, see the transcode_report command
+    source_duration = models.FloatField(null=True, blank=True)  # Seconds of video converted
+    cpu_user = models.FloatField(null=True, blank=True)  # CPU seconds in user mode
+    cpu_system = models.FloatField(null=True, blank=True)  # CPU seconds in kernel mode
+    max_rss = models.PositiveBigIntegerField(null=True, blank=True)  # Peak memory in bytes
+    fps = models.FloatField(null=True, blank=True)  # Frames encoded per second
+    output_bitrates = models.JSONField(default=dict, blank=True)  # Rendition: bitrate in bit/s
+    created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return f'({self.id}) - {self.video_id} {", ".join(self.renditions)} - {self.state}'
+
+
+# Resumable upload of a source video, sent in chunks (see videoflix/uploads.py)
+class UploadSession(models.Model):
+    id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
+    user = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.CASCADE, related_name='upload_sessions')
+    filename = models.CharField(max_length=255)
+    length = models.PositiveBigIntegerField()  # Total size in bytes
+    offset = models.PositiveBigIntegerField(default=0)  # Bytes received so far
+    # Video created by the finalize step
+    title = models.CharField(max_length=100)
+    description = models.CharField(max_length=500, blank=True)
+    genre = models.ForeignKey(Genre, on_delete=models.SET_NULL, null=True, blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True, db_index=True)
+
+    def __str__(self):
+        return f'({self.id}) - {self.filename} {self.offset}/{self.length}'
+
+
+# Task recorded in the same transaction as the rows it works on (transactional outbox).
+# It is enqueued to RQ once committed, see videoflix/outbox.py
+class TaskOutbox(models.Model):
+    job_id = models.UUIDField(default=uuid.uuid4, unique=True, editable=False)  # RQ job id, enqueued once
+    queue = models.CharField(max_length=50)
+    func = models.CharField(max_length=200)  # Dotted path of the task function
+    args = models.JSONField(default=list)
+    retry_intervals = models.JSONField(null=True, blank=True)  # Delays of the RQ retries in seconds
+    created_at = models.DateTimeField(auto_now_add=True)
+    enqueued_at = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        indexes = [
+            # Backs the lookup of pending tasks
+            models.Index(fields=['enqueued_at', 'id']),
+        ]
+
+    def __str__(self):
+        return f'({self.id}) - {self.func}{tuple(self.args)} on {self.queue}'
@@ -0,0 +1,106 @@
+import logging
+import django_rq
+from django.db import transaction
+from django.utils import timezone
+from django.utils.module_loading import import_string
+from rq import Retry
+from rq.job import Job
+from videoflix.models import TaskOutbox
+
+logger = logging.getLogger(__name__)
+
+# Number of tasks enqueued per database transaction and Redis round trip
+OUTBOX_BATCH_SIZE = 500
+
+
+def outbox_task(queue_name, func, *args, retry_intervals=None):
+    """
+    Build an (unsaved) outbox entry for func(*args) on the given queue.
+    """
+    return TaskOutbox(queue=queue_name, func=f'{func.__module__}.{func.__name__}', args=list(args),
+                      retry_intervals=retry_intervals)
+
+
+def enqueue_on_commit(queue_name, func, *args, retry_intervals=None):
+    """
+    Record a task in the outbox, within the current transaction. It reaches RQ only
+    after the commit, so a worker never sees rows or files that are not visible yet,
+    and a rollback discards the task together with the rows.
+    """
+    task = outbox_task(queue_name, func, *args, retry_intervals=retry_intervals)
+    task.save()
+    transaction.on_commit(relay_after_commit)
+    return task
+
+
+def enqueue_many_on_commit(tasks):
+    """
+    Record several outbox entries (see outbox_task) with one insert.
+    """
+    tasks = TaskOutbox.objects.bulk_create(tasks)
+    if tasks:
+        transaction.on_commit(relay_after_commit)
+    return tasks
+
+
+def relay_after_commit():
+    """
+    Relay the pending tasks right after the commit. If that fails (e.g. Redis is
+    down) the tasks stay in the outbox and the relay_outbox command enqueues them.
+    """
+    try:
+        relay_outbox(max_batches=1)
+    except Exception:
+        logger.exception('Relaying the task outbox failed, relay_outbox will retry')
+
+
+def relay_outbox(batch_size=OUTBOX_BATCH_SIZE, max_batches=None):
+    """
+    Enqueue the pending tasks of the outbox to RQ, in batches of one database
+    transaction and one pipelined Redis round trip per queue.
+
+    Every task is enqueued with its own job id. Jobs that already exist in Redis
+    (relayed before, but the transaction marking them failed) are not enqueued
+    again, so tasks are neither lost nor duplicated.
+    Returns the number of relayed tasks.
+    """
+    relayed = batches = 0
+    while max_batches is None or batches < max_batches:
+        with transaction.atomic():
+            # Skip tasks another relay is enqueueing right now
+            batch = list(TaskOutbox.objects.select_for_update(skip_locked=True)
+                         .filter(enqueued_at__isnull=True).order_by('id')[:batch_size])
+            if not batch:
+                break
+
+            by_queue = {}
+            for task in batch:
+                by_queue.setdefault(task.queue, []).append(task)
+            for queue_name, tasks in by_queue.items():
+                enqueue_tasks(django_rq.get_queue(queue_name, autocommit=True), tasks)
+
+            now = timezone.now()
+            for task in batch:
+                task.enqueued_at = now
+            TaskOutbox.objects.bulk_update(batch, ['enqueued_at'])
+        relayed += len(batch)
+        batches += 1
+    return relayed
+
+
+def enqueue_tasks(queue, tasks):
+    job_ids = [str(task.job_id) for task in tasks]
+    existing = {job.id for job in Job.fetch_many(job_ids, connection=queue.connection) if job is not None}
+    job_datas = []
+    for task in tasks:
+        if str(task.job_id) in existing:
+            continue
+        retry = None
+        if task.retry_intervals:
+            retry = Retry(max=len(task.retry_intervals), interval=task.retry_intervals)
+        job_datas.append(queue.prepare_data(import_string(task.func), args=tuple(task.args),
+                                            job_id=str(task.job_id), retry=retry))
+    if job_datas:
+        with queue.connection.pipeline() as pipe:
+            queue.enqueue_many(job_datas, pipeline=pipe)
+            pipe.execute()
@@ -0,0 +1,45 @@
+from django.contrib.postgres.search import SearchQuery, SearchRank, SearchVector
+from django.db import connection
+from django.db.models import F, Q
+
+# Text search configuration of the search vector and queries
+SEARCH_CONFIG = 'english'
+
+
+def search_supported():
+    """
+    Full-text search needs Postgres, other databases (SQLite test runs) fall back to LIKE.
+    """
+    return connection.vendor == 'postgresql'
+
+
+def video_search_vector(title='title', description='description'):
+    # Matches in the title rank higher than matches in the description.
+    # Built from the columns, or from the values of a video that is being saved.
+    return (SearchVector(title, weight='A', config=SEARCH_CONFIG)
+            + SearchVector(description, weight='B', config=SEARCH_CONFIG))
+
+
+def update_search_vectors(videos):
+    """
+    Recompute the stored search vector of the videos (a queryset) in one UPDATE.
+    """
+    if search_supported():
+        videos.update(search_vector=video_search_vector())
+
+
+def search_videos(videos, query):
+    """
+    Filter the videos (a queryset) by the search query and order them by relevance.
+    Uses the GIN indexed search vector on Postgres, and LIKE on other databases.
+    """
+    if not search_supported():
+        matches = Q()
+        for term in query.split():
+            matches &= Q(title__icontains=term) | Q(description__icontains=term)
+        return videos.filter(matches).order_by('-created_at', '-id')
+
+    search_query = SearchQuery(query, search_type='websearch', config=SEARCH_CONFIG)
+    return (videos.filter(search_vector=search_query)
+            .annotate(rank=SearchRank(F('search_vector'), search_query))
+            .order_by('-rank', '-created_at', '-id'))
@@ -1,38 +1,195 @@
 from rest_framework import serializers
-from videoflix.models import Video, Genre
+from videoflix.metrics import measure_serializer
+from videoflix.models import Video, Genre, TranscodeJob, UploadSession
+from videoflix.uploads import MAX_UPLOAD_LENGTH
+from videoflix.tasks import RENDITIONS
+from django.core.exceptions import SuspiciousFileOperation
+from django.db import models
+from django.urls import reverse
+from django.utils.text import get_valid_filename
 import os
 
 
+class TimedListSerializer(serializers.ListSerializer):
+    # Serializer time of the request, for the PerformanceMiddleware
+    @property
+    def data(self):
+        with measure_serializer():
+            return super().data
+
+
+class TimedSerializerMixin:
+    """
+    Adds the time spent building .data to the serializer time of the request.
+    Lists are timed as a whole, with Meta.list_serializer_class = TimedListSerializer.
+    """
+
+    @property
+    def data(self):
+        with measure_serializer():
+            return super().data
+
+
+def media_url(name):
+    """
+    Return the URL of a media file, served to authenticated users by StreamMedia.
+    """
+    return reverse('stream-media', args=[name])
+
+
+class MediaFileField(serializers.FileField):
+    # Media files are only streamed to authenticated users, not from MEDIA_URL
+    def to_representation(self, value):
+        return media_url(value.name) if value else None
+
+
 # Serializer for Genre
-class GenreItemSerializer(serializers.ModelSerializer):
+class GenreItemSerializer(TimedSerializerMixin, serializers.ModelSerializer):
     class Meta:
         model = Genre
         fields = ['id', 'name']
+        list_serializer_class = TimedListSerializer
 
 
-class VideoItemSerializer(serializers.ModelSerializer):
+class VideoItemSerializer(TimedSerializerMixin, serializers.ModelSerializer):
+    serializer_field_mapping = {
+        **serializers.ModelSerializer.serializer_field_mapping,
+        models.FileField: MediaFileField,
+    }
+
     video_file_360p = serializers.SerializerMethodField()
     video_file_720p = serializers.SerializerMethodField()
+    renditions = serializers.SerializerMethodField()
     genre = serializers.SerializerMethodField()
     class Meta:
         model = Video
-        fields = ['id', 'video_file_360p', 'video_file_720p', 'title', 'description', 'created_at', 'video_file', 'thumbnail_file', 'genre']
-        
+        fields = ['id', 'video_file_360p', 'video_file_720p', 'renditions', 'hls_manifest', 'title', 'description', 'created_at', 'video_file', 'thumbnail_file', 'preview_vtt', 'genre']
+        list_serializer_class = TimedListSerializer
+
+    # Model columns each serialized field reads, used to select only what is needed
+    source_columns = {
+        'video_file_360p': ['renditions'],
+        'video_file_720p': ['renditions'],
+        'genre': ['genre__name'],
+    }
+
+    def __init__(self, *args, **kwargs):
+        # Limit the serialized fields, if requested (e.g. ?fields=id,title)
+        fields = kwargs.pop('fields', None)
+        super().__init__(*args, **kwargs)
+        if fields is not None:
+            for field_name in set(self.fields) - set(fields):
+                self.fields.pop(field_name)
+
+    @classmethod
+    def columns_for(cls, fields):
+        """
+        Return the model columns needed to serialize the given fields.
+        """
+        columns = []
+        for field_name in fields:
+            for column in cls.source_columns.get(field_name, [field_name]):
+                if column not in columns:
+                    columns.append(column)
+        return columns
+
     def get_genre(self, obj):
         # Return the genre name, if genre is not None
         return obj.genre.name if obj.genre else None
 
     def get_video_file_360p(self, obj):
-        return self.get_converted_video_path(obj, '360p')
+        return self.get_rendition_url(obj, '360p')
 
     def get_video_file_720p(self, obj):
-        return self.get_converted_video_path(obj, '720p')
+        return self.get_rendition_url(obj, '720p')
 
-    def get_converted_video_path(self, obj, resolution):
+    def get_renditions(self, obj):
         """
-        Construct the path for the converted video file.
+        Return the converted renditions with their metadata, as recorded by the transcoding task.
+        """
+        return [
+            {'name': name, 'url': media_url(rendition['path']),
+             **{key: value for key, value in rendition.items() if key != 'path'}}
+            for name, rendition in obj.renditions.items()
+        ]
+
+    def get_rendition_url(self, obj, resolution):
         """
-        if obj.video_file:
-            base, ext = os.path.splitext(obj.video_file.url)
-            return f"{base}_{resolution}{ext}"
-        return None
\ No newline at end of file
+        Return the URL of a converted file, or None if it was not converted (yet).
+        """
+        rendition = obj.renditions.get(resolution)
+        return media_url(rendition['path']) if rendition else None
+
+
+class VideoStatusSerializer(TimedSerializerMixin, serializers.ModelSerializer):
+    """
+    Transcoding status of a video, per rendition. Expects the transcode_jobs
+    of the video to be prefetched, ordered by creation.
+
+    Deduplicated uploads have no jobs of their own, they report the jobs of the
+    video they share the file with, or the renditions copied from it.
+    """
+    ready = serializers.SerializerMethodField()
+    renditions = serializers.SerializerMethodField()
+
+    class Meta:
+        model = Video
+        fields = ['id', 'ready', 'renditions']
+        list_serializer_class = TimedListSerializer
+
+    def get_renditions(self, obj):
+        return obj.status_renditions
+
+    def planned_renditions(self, obj):
+        jobs = obj.transcode_jobs.all()
+        if not jobs and obj.video_file:
+            jobs = TranscodeJob.objects.filter(video__video_file=obj.video_file.name).order_by('created_at', 'id')
+        if not jobs and obj.renditions:
+            # The original (and its jobs) may be deleted, its renditions are kept
+            return {resolution: {'state': TranscodeJob.STATE_DONE, 'progress': 100, 'attempts': 0}
+                    for resolution in obj.renditions}
+        if not jobs:
+            # Not analyzed yet, so no renditions are planned
+            return {resolution: None for resolution in RENDITIONS}
+
+        # Only the planned renditions (upscales are skipped), the latest job of a rendition decides its status
+        renditions = {}
+        for job in jobs:
+            for resolution in job.renditions:
+                renditions[resolution] = {
+                    'state': job.state,
+                    'progress': job.progress,
+                    'attempts': job.attempts,
+                }
+        return {resolution: renditions[resolution] for resolution in RENDITIONS if resolution in renditions}
+
+    def to_representation(self, instance):
+        # The renditions are looked up once, for both fields
+        instance.status_renditions = self.planned_renditions(instance)
+        return super().to_representation(instance)
+
+    def get_ready(self, obj):
+        renditions = obj.status_renditions.values()
+        return all(rendition and rendition['state'] == TranscodeJob.STATE_DONE for rendition in renditions)
+
+
+class UploadSessionSerializer(serializers.ModelSerializer):
+    """
+    Starts a resumable upload: the size and name of the file and the details of the video.
+    """
+    class Meta:
+        model = UploadSession
+        fields = ['id', 'filename', 'length', 'offset', 'title', 'description', 'genre', 'created_at']
+        read_only_fields = ['id', 'offset', 'created_at']
+
+    def validate_filename(self, value):
+        # Only the name, never a path
+        try:
+            return get_valid_filename(os.path.basename(value))
+        except SuspiciousFileOperation:
+            raise serializers.ValidationError('Invalid file name.')
+
+    def validate_length(self, value):
+        if not 0 < value <= MAX_UPLOAD_LENGTH:
+            raise serializers.ValidationError(f'The file must have between 1 and {MAX_UPLOAD_LENGTH} bytes.')
+        return value
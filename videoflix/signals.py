@@ -1,55 +1,142 @@
-from .models import Video
-from .tasks import convert_video
+from .models import Video, Genre, UploadSession
+from .tasks import RENDITIONS, analyze_video, rendition_path, hls_dir, previews_dir
+from .cache import bump_catalog_version
+from .outbox import enqueue_on_commit
+from .search import search_supported, update_search_vectors, video_search_vector
+from .uploadhandlers import file_sha256
+from .uploads import delete_upload_file
+from .metrics import install_query_timer
+from django.db import transaction
+from django.db.models import Value
 from django.dispatch import receiver
-from django.db.models.signals import post_save, post_delete
+from django.db.models.fields.files import FieldFile
+from django.db.backends.signals import connection_created
+from django.db.models.signals import pre_save, post_save, post_delete
 import os
+import shutil
 
-from django_rq import enqueue
-import django_rq
 
+# Fields copied from a video with the same content, so its renditions are reused
+SHARED_MEDIA_FIELDS = ['video_file', 'renditions', 'hls_manifest', 'preview_vtt',
+                       'width', 'height', 'video_codec', 'audio_codec', 'duration', 'bitrate', 'keyframes_aligned']
 
 
+@receiver(pre_save, sender=Video)
+def deduplicate_video_file(sender, instance, **kwargs):
+    """
+    Hashes a new upload and, if a video with the same content exists, reuses its
+    stored file and renditions instead of storing and transcoding the upload again.
+    """
+    instance.deduplicated = False
+    upload = instance.video_file
+    if not upload or upload._committed:
+        return
+
+    instance.content_hash = file_sha256(upload.file)
+    original = (Video.objects.filter(content_hash=instance.content_hash).exclude(pk=instance.pk)
+                .exclude(video_file='').exclude(video_file__isnull=True).order_by('id').first())
+    if original is None or not original.video_file.storage.exists(original.video_file.name):
+        return
+
+    for field in SHARED_MEDIA_FIELDS:
+        value = getattr(original, field)
+        # Share the stored files by name
+        setattr(instance, field, value.name if isinstance(value, FieldFile) else value)
+    if not instance.thumbnail_file:
+        instance.thumbnail_file = original.thumbnail_file.name
+    instance.deduplicated = True
+
 
 @receiver(post_save, sender=Video)
 def video_post_save(sender, instance, created, **kwargs):
     print('Video was saved')
-    if created:
+    # Duplicates get their renditions from the original, see record_renditions
+    if created and instance.video_file and not getattr(instance, 'deduplicated', False):
         # print('Video was created')
-        video_path = instance.video_file.path
-        # print(video_path)
-        queue = django_rq.get_queue('default', autocommit=True)
-        # print('Start queue')
-        # Enqueue tasks for 360p, 720p
-        queue.enqueue(convert_video, video_path, '360p')
-        queue.enqueue(convert_video, video_path, '720p')
+        # The analysis probes the source and enqueues the transcoding jobs, see analyze_video.
+        # It is enqueued once the video is committed, see outbox.py
+        enqueue_on_commit('transcode-high', analyze_video, instance.id)
         # print('Finished queue')
-       
+
+
+@receiver(pre_save, sender=Video)
+def set_video_search_vector(sender, instance, update_fields=None, **kwargs):
+    """
+    Computes the stored search vector from the title and description,
+    within the INSERT or UPDATE of the video itself.
+    """
+    if update_fields is None and search_supported():
+        instance.search_vector = video_search_vector(Value(instance.title), Value(instance.description))
+
+
+@receiver(post_save, sender=Video)
+def update_video_search_vector(sender, instance, update_fields=None, **kwargs):
+    """
+    Saves limited to update_fields do not write the search vector,
+    it is updated afterwards if the title or description was saved.
+    """
+    if update_fields is not None and {'title', 'description'} & set(update_fields):
+        update_search_vectors(Video.objects.filter(pk=instance.pk))
 
 
 @receiver(post_delete, sender=Video)
 def auto_delete_file_on_delete(sender, instance, **kwargs):
     """
     Deletes the video file and its converted versions from the filesystem
-    when the corresponding 'Video' object is deleted.
+    when the corresponding 'Video' object is deleted. Files still used by
+    another video (deduplicated uploads) are kept.
     """
-    if instance.video_file:
-        video_path = instance.video_file.path
-        thumbnail_path = instance.thumbnail_file.path
+    # Delete the thumbnail file (uploaded or extracted poster)
+    if (instance.thumbnail_file and os.path.isfile(instance.thumbnail_file.path)
+            and not Video.objects.filter(thumbnail_file=instance.thumbnail_file.name).exists()):
+        os.remove(instance.thumbnail_file.path)
 
-        # List of resolutions
-        resolutions = ['360p', '720p']
+    if instance.video_file and not Video.objects.filter(video_file=instance.video_file.name).exists():
+        video_path = instance.video_file.path
 
         # Delete the original file
         if os.path.isfile(video_path):
             os.remove(video_path)
-        
-        # Delete the thumbnail file
-        if os.path.isfile(thumbnail_path):
-            os.remove(thumbnail_path)
-        
+
         # Delete the converted files
-        for resolution in resolutions:
-            converted_file_path = f"{os.path.splitext(video_path)[0]}_{resolution}.mp4"
+        for resolution in RENDITIONS:
+            converted_file_path = rendition_path(video_path, resolution)
             print('Deleting, ', converted_file_path)
             if os.path.isfile(converted_file_path):
                 os.remove(converted_file_path)
+
+        # Delete the HLS playlists and segments, the poster and the seek previews
+        shutil.rmtree(hls_dir(video_path), ignore_errors=True)
+        shutil.rmtree(previews_dir(video_path), ignore_errors=True)
+
+
+@receiver(post_delete, sender=UploadSession)
+def delete_upload_session_file(sender, instance, **kwargs):
+    """
+    Deletes the received bytes of a finished, aborted or expired upload,
+    once the deletion is committed (a rolled back finalize keeps them).
+    """
+    delete_upload_file(instance)
+
+
+@receiver(post_save, sender=Video)
+@receiver(post_delete, sender=Video)
+@receiver(post_save, sender=Genre)
+@receiver(post_delete, sender=Genre)
+def invalidate_catalog_cache(sender, **kwargs):
+    """
+    Bumps the catalog version whenever a video or genre changes,
+    so no cached catalog response is served after that.
+
+    Only once the change is committed: a request reading the old rows in the
+    meantime would cache them under the new version.
+    """
+    transaction.on_commit(bump_catalog_version)
+
+
+@receiver(connection_created)
+def time_database_queries(sender, connection, **kwargs):
+    """
+    Lets the PerformanceMiddleware time the queries of sampled requests.
+    """
+    install_query_timer(connection)
@@ -0,0 +1,128 @@
+import re
+from urllib.parse import urlsplit
+from django.utils.http import parse_etags, parse_http_date_safe
+from rest_framework.negotiation import BaseContentNegotiation
+
+RANGE_RE = re.compile(r'^bytes=(\d*)-(\d*)$')
+PLAYLIST_URI_RE = re.compile(r'URI="([^"]*)"')
+
+# Size of the chunks read from disk for partial responses
+STREAM_CHUNK_SIZE = 256 * 1024
+
+
+class RangeNotSatisfiable(Exception):
+    pass
+
+
+class IgnoreClientContentNegotiation(BaseContentNegotiation):
+    """
+    Media responses are not rendered, so the Accept header of players
+    (e.g. video/*) must not lead to a 406.
+    """
+
+    def select_parser(self, request, parsers):
+        return parsers[0]
+
+    def select_renderer(self, request, renderers, format_suffix=None):
+        return (renderers[0], renderers[0].media_type)
+
+
+def parse_range_header(header, size):
+    """
+    Parse a single byte range (e.g. bytes=0-499, bytes=500- or bytes=-500)
+    into the inclusive (start, end) positions within a file of the given size.
+
+    Returns None, if the header is missing, malformed or asks for several ranges,
+    so the whole file is served. Raises RangeNotSatisfiable, if the range
+    lies outside of the file.
+    """
+    match = RANGE_RE.match(header.replace(' ', '')) if header else None
+    if not match or match.groups() == ('', ''):
+        return None
+
+    start, end = match.groups()
+    if not start:
+        # Suffix range: the last N bytes
+        length = int(end)
+        if length == 0:
+            raise RangeNotSatisfiable()
+        return max(size - length, 0), size - 1
+
+    start = int(start)
+    end = min(int(end), size - 1) if end else size - 1
+    if start >= size or start > end:
+        raise RangeNotSatisfiable()
+    return start, end
+
+
+def if_range_passes(header, etag, last_modified):
+    """
+    Check the If-Range precondition: the range is only served, if the
+    validator still matches the file, otherwise the whole file is sent.
+    """
+    if not header:
+        return True
+    if header.startswith(('"', 'W/')):
+        # Only strong ETags may be used with If-Range
+        return not header.startswith('W/') and etag in parse_etags(header)
+    return parse_http_date_safe(header) == last_modified
+
+
+def file_range_iterator(path, start, length, chunk_size=STREAM_CHUNK_SIZE):
+    """
+    Yield length bytes of the file, starting at start, in chunks.
+    """
+    with open(path, 'rb') as file:
+        file.seek(start)
+        while length > 0:
+            chunk = file.read(min(chunk_size, length))
+            if not chunk:
+                break
+            length -= len(chunk)
+            yield chunk
+
+
+def append_query(uri, query):
+    """
+    Append the query string to a relative URI, before its fragment.
+    URIs of other hosts are returned as is, so the query (a token) does not leak to them.
+    """
+    parts = urlsplit(uri)
+    if parts.scheme or parts.netloc:
+        return uri
+    uri, hash_mark, fragment = uri.partition('#')
+    return f"{uri}{'&' if '?' in uri else '?'}{query}{hash_mark}{fragment}"
+
+
+def rewrite_playlist_uris(content, query):
+    """
+    Append the query string to every URI of an HLS playlist: the variant and
+    segment lines and the URI attributes of tags (e.g. the init segment of #EXT-X-MAP).
+    """
+    lines = []
+    for line in content.splitlines():
+        if line.startswith('#'):
+            line = PLAYLIST_URI_RE.sub(lambda match: f'URI="{append_query(match.group(1), query)}"', line)
+        elif line.strip():
+            line = append_query(line.strip(), query)
+        lines.append(line)
+    return '\n'.join(lines) + '\n'
+
+
+def rewrite_vtt_uris(content, query):
+    """
+    Append the query string to the cue payloads of a WebVTT file,
+    which are the URIs of the seek preview sprites.
+    """
+    lines = content.splitlines()
+    for index in range(1, len(lines)):
+        if '-->' in lines[index - 1] and lines[index].strip():
+            lines[index] = append_query(lines[index].strip(), query)
+    return '\n'.join(lines) + '\n'
+
+
+# Text files referring to other media files by relative URIs
+URI_REWRITERS = {
+    '.m3u8': rewrite_playlist_uris,
+    '.vtt': rewrite_vtt_uris,
+}
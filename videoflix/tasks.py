@@ -1,24 +1,713 @@
+import bisect
+import fcntl
+import json
+import math
+import os
+import re
 import subprocess
+import tempfile
+import time
+import django_rq
+from collections import deque, namedtuple
+from contextlib import contextmanager
+from datetime import timedelta
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Q
+from django.utils import timezone
+from rq import Retry, get_current_job
+from videoflix.models import TranscodeJob, Video
+from videoflix.outbox import enqueue_on_commit
 
-def convert_video(source, resolution):
-    resolutions = {
-        '360p': '640x360',
-        '720p': 'hd720'
+# Renditions created from every uploaded video (bitrates in kbit/s)
+RENDITIONS = {
+    '360p': {'width': 640, 'height': 360, 'maxrate': 1000, 'audio_bitrate': 96},
+    '720p': {'width': 1280, 'height': 720, 'maxrate': 3000, 'audio_bitrate': 128},
+}
+
+# Length of the HLS segments in seconds, every segment starts with a keyframe
+HLS_SEGMENT_TIME = 4
+
+# Seek previews: one thumbnail every SPRITE_INTERVAL seconds, tiled into sprite sheets
+SPRITE_INTERVAL = 5
+SPRITE_WIDTH = 160
+SPRITE_HEIGHT = 90
+SPRITE_COLUMNS = 10
+SPRITE_ROWS = 10
+
+# The poster is the most representative frame of the first POSTER_FRAMES frames
+POSTER_FRAMES = 300
+POSTER_HEIGHT = 720
+
+# Failed transcoding jobs are retried with backoff (delays in seconds)
+TRANSCODE_RETRY_INTERVALS = [60, 300, 900]
+
+# Number of ffmpeg output lines kept with a job
+OUTPUT_LINES = 50
+
+# CPU threads per ffmpeg run, used to derive the default number of concurrent runs per host
+FFMPEG_THREADS = 4
+
+# Seconds to wait between attempts to get a free transcoding slot
+SLOT_POLL_INTERVAL = 1
+
+# Seconds after which a job is run again by a worker that found no free transcoding slot
+SLOT_RETRY_DELAY = 30
+
+# Sources up to this duration (seconds) and size (bytes) are short clips,
+# converted to all renditions at once on the high priority queue
+SHORT_CLIP_DURATION = 5 * 60
+SHORT_CLIP_SIZE = 200 * 1024 * 1024
+
+# Seconds ffprobe may take to analyze a source
+PROBE_TIMEOUT = 30
+
+# Sources with these codecs can be copied into a rendition of the same size, without re-encoding
+COPY_VIDEO_CODECS = ['h264']
+
+# Seconds ffprobe may take to list the keyframes of a source (it reads the whole file)
+KEYFRAME_PROBE_TIMEOUT = 120
+
+# Seconds a keyframe of a copied source may start after an HLS segment boundary
+KEYFRAME_TOLERANCE = 0.1
+
+DURATION_RE = re.compile(r'Duration: (\d+):(\d+):(\d+(?:\.\d+)?)')
+PROGRESS_RE = re.compile(r'^([\w.]+)=(\S*)$')
+
+# Result of an ffmpeg run, with its resource usage: CPU seconds (user, system), peak memory
+# (bytes), encoded frames per second and the bitrates (bit/s) of the converted renditions
+ConvertResult = namedtuple('ConvertResult', ['return_code', 'output', 'duration', 'source_duration',
+                                             'cpu_user', 'cpu_system', 'max_rss', 'fps', 'bitrates'])
+
+
+class TranscodeError(Exception):
+    pass
+
+
+def get_ffmpeg_command():
+    # Can be overridden in the settings, e.g. with a stub ffmpeg in tests
+    return list(getattr(settings, 'FFMPEG_COMMAND', ['sudo', 'ffmpeg']))
+
+
+def get_ffprobe_command():
+    return list(getattr(settings, 'FFPROBE_COMMAND', ['ffprobe']))
+
+
+def probe_media(source, timeout=30):
+    """
+    Return the format and streams of a media file as reported by ffprobe,
+    or None if it can not be probed.
+    """
+    cmd = get_ffprobe_command() + [
+        '-v', 'error',
+        '-print_format', 'json',
+        '-show_format',
+        '-show_streams',
+        source
+    ]
+    try:
+        result = subprocess.run(cmd, capture_output=True, text=True, timeout=timeout)
+        return json.loads(result.stdout) if result.returncode == 0 else None
+    except (OSError, subprocess.TimeoutExpired, ValueError):
+        return None
+
+
+def probe_duration(source, timeout=30):
+    """
+    Return the duration of a media file in seconds, or None if unknown.
+    """
+    probe = probe_media(source, timeout=timeout)
+    try:
+        return float(probe['format']['duration'])
+    except (TypeError, KeyError, ValueError):
+        return None
+
+
+def analyze_media(source, timeout=PROBE_TIMEOUT):
+    """
+    Return the dimensions, codecs, duration and bitrate of the source,
+    or None if ffprobe can not read it.
+    """
+    probe = probe_media(source, timeout=timeout)
+    if probe is None:
+        return None
+    media_format = probe.get('format', {})
+    streams = probe.get('streams', [])
+    video = next((stream for stream in streams if stream.get('codec_type') == 'video'), {})
+    audio = next((stream for stream in streams if stream.get('codec_type') == 'audio'), {})
+
+    def number(value, cast=float):
+        try:
+            return cast(value)
+        except (TypeError, ValueError):
+            return None
+
+    media = {
+        'width': number(video.get('width'), int),
+        'height': number(video.get('height'), int),
+        'video_codec': video.get('codec_name', ''),
+        'audio_codec': audio.get('codec_name', ''),
+        'duration': number(media_format.get('duration')),
+        'bitrate': number(media_format.get('bit_rate'), int),
     }
+    # Only needed (and probed) for sources that could be copied, see rendition_fits
+    media['keyframes_aligned'] = (media['video_codec'] in COPY_VIDEO_CODECS
+                                  and keyframes_aligned(probe_keyframes(source), media['duration']))
+    return media
+
+
+def probe_keyframes(source, timeout=KEYFRAME_PROBE_TIMEOUT):
+    """
+    Return the timestamps (seconds) of the keyframes of the first video stream,
+    or None if they can not be probed. Only the packets are read, nothing is decoded.
+    """
+    cmd = get_ffprobe_command() + [
+        '-v', 'error',
+        '-select_streams', 'v:0',
+        '-show_entries', 'packet=pts_time,flags',
+        '-of', 'csv=p=0',
+        source
+    ]
+    try:
+        result = subprocess.run(cmd, capture_output=True, text=True, timeout=timeout)
+    except (OSError, subprocess.TimeoutExpired):
+        return None
+    if result.returncode != 0:
+        return None
+    keyframes = []
+    for line in result.stdout.splitlines():
+        pts_time, _, flags = line.partition(',')
+        if 'K' in flags:
+            try:
+                keyframes.append(float(pts_time))
+            except ValueError:
+                continue
+    return keyframes
+
+
+def keyframes_aligned(keyframes, duration):
+    """
+    Check if a keyframe starts every HLS segment (every HLS_SEGMENT_TIME seconds),
+    like in the encoded renditions (-force_key_frames). Only then are the segments
+    of a stream copy cut at the same times, so players can switch between the variants.
+    """
+    if not keyframes or not duration:
+        return False
+    start = min(keyframes)
+    keyframes = sorted(keyframe - start for keyframe in keyframes)
+    for segment in range(math.ceil(duration / HLS_SEGMENT_TIME)):
+        boundary = segment * HLS_SEGMENT_TIME
+        index = bisect.bisect_left(keyframes, boundary)
+        if index == len(keyframes) or keyframes[index] - boundary > KEYFRAME_TOLERANCE:
+            return False
+    return True
+
+
+def get_transcode_concurrency():
+    """
+    Return how many ffmpeg runs may run at the same time on this host.
+    """
+    concurrency = getattr(settings, 'TRANSCODE_CONCURRENCY', None)
+    return concurrency or max(1, (os.cpu_count() or 1) // FFMPEG_THREADS)
+
+
+@contextmanager
+def transcode_slot(blocking=True):
+    """
+    Hold one of the transcoding slots of this host while ffmpeg runs, so
+    several workers do not oversubscribe the CPUs. Yields the CPU threads
+    ffmpeg may use, or None if no slot is free and blocking is False.
+
+    The slots are file locks, so they are released even if a worker dies.
+    """
+    concurrency = get_transcode_concurrency()
+    lock_dir = getattr(settings, 'TRANSCODE_LOCK_DIR', tempfile.gettempdir())
+    while True:
+        for slot in range(concurrency):
+            lock_file = open(os.path.join(lock_dir, f'videoflix-transcode-{slot}.lock'), 'w')
+            try:
+                fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                lock_file.close()
+                continue
+            try:
+                yield max(1, (os.cpu_count() or 1) // concurrency)
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+                lock_file.close()
+            return
+        if not blocking:
+            yield None
+            return
+        time.sleep(SLOT_POLL_INTERVAL)
+
+
+def rendition_path(source, resolution):
+    """
+    Return the path of the converted file of the given resolution.
+    """
+    return f"{os.path.splitext(source)[0]}_{resolution}.mp4"
+
+
+def hls_dir(source):
+    """
+    Return the directory holding the HLS playlists and segments of a video.
+    """
+    return f"{os.path.splitext(source)[0]}_hls"
+
+
+def hls_manifest_path(source):
+    return os.path.join(hls_dir(source), 'master.m3u8')
+
+
+def previews_dir(source):
+    """
+    Return the directory holding the poster and the seek preview sprites of a video.
+    """
+    return f"{os.path.splitext(source)[0]}_previews"
+
+
+def poster_path(source):
+    return os.path.join(previews_dir(source), 'poster.jpg')
+
+
+def previews_vtt_path(source):
+    return os.path.join(previews_dir(source), 'previews.vtt')
+
 
-    file_name = source.split('.')
-    new_file_name = f"{file_name[0]}_{resolution}.mp4"
-    
-    cmd = [
-        'sudo',
-        'ffmpeg',
+def build_convert_command(source, resolutions, threads=None, previews=False, copy=()):
+    """
+    Build one ffmpeg command for all given resolutions. The source is decoded
+    once and the decoded frames are split into one scaled stream per rendition.
+    Every rendition is encoded once and written both as progressive mp4 and
+    as an HLS variant (fMP4 segments) through the tee muxer.
+    threads limits the CPU threads of all encoders together.
+    With previews, two more branches of the same decoded frames produce
+    the poster and the seek preview sprite sheets.
+    Renditions in copy get the source video stream as is (-c:v copy),
+    only their audio is encoded.
+    """
+    encoded = [resolution for resolution in resolutions if resolution not in copy]
+    branches = [f'[v{index}]' for index in range(len(encoded))]
+    if previews:
+        branches += ['[vposter]', '[vsprites]']
+    filters = [f"[0:v]split={len(branches)}{''.join(branches)}"] if branches else []
+    for index, resolution in enumerate(encoded):
+        rendition = RENDITIONS[resolution]
+        filters.append(f"[v{index}]scale={rendition['width']}:{rendition['height']}[out{index}]")
+    if previews:
+        filters.append(f'[vposter]thumbnail={POSTER_FRAMES},scale=-2:{POSTER_HEIGHT}[poster]')
+        filters.append(
+            f'[vsprites]fps=1/{SPRITE_INTERVAL},scale={SPRITE_WIDTH}:{SPRITE_HEIGHT},'
+            f'tile={SPRITE_COLUMNS}x{SPRITE_ROWS}[sprites]'
+        )
+
+    cmd = get_ffmpeg_command() + [
+        '-y',
+        # Machine readable progress on stdout
+        '-progress', 'pipe:1',
+        '-nostats',
         '-i', source,
-        '-s', resolutions[resolution],
-        '-c:v', 'libx264',
-        '-crf', '23',
-        '-c:a', 'aac',
-        '-strict', '-2',
-        new_file_name
     ]
+    if filters:
+        cmd += ['-filter_complex', ';'.join(filters)]
+    for resolution in resolutions:
+        rendition = RENDITIONS[resolution]
+        if resolution in copy:
+            cmd += [
+                '-map', '0:v:0',
+                '-map', '0:a?',
+                '-c:v', 'copy',
+            ]
+        else:
+            cmd += [
+                '-map', f'[out{encoded.index(resolution)}]',
+                '-map', '0:a?',
+                '-c:v', 'libx264',
+                '-crf', '23',
+            ]
+            if threads:
+                cmd += ['-threads', str(max(1, threads // len(encoded)))]
+            cmd += [
+                # Cap the bitrate, so players can pick a variant for their bandwidth
+                '-maxrate', f"{rendition['maxrate']}k",
+                '-bufsize', f"{rendition['maxrate'] * 2}k",
+                # Aligned keyframes, so players can switch variants at every segment
+                '-force_key_frames', f'expr:gte(t,n_forced*{HLS_SEGMENT_TIME})',
+            ]
+        cmd += [
+            '-c:a', 'aac',
+            '-b:a', f"{rendition['audio_bitrate']}k",
+            '-f', 'tee',
+            build_tee_outputs(source, resolution)
+        ]
+    if previews:
+        cmd += [
+            '-map', '[poster]',
+            '-frames:v', '1',
+            '-update', '1',
+            poster_path(source),
+            '-map', '[sprites]',
+            '-q:v', '5',
+            os.path.join(previews_dir(source), 'sprites_%03d.jpg'),
+        ]
+    return cmd
+
+
+def build_tee_outputs(source, resolution):
+    mp4_output = f'[f=mp4:movflags=+faststart]{rendition_path(source, resolution)}'
+    hls_output = (
+        f'[f=hls:hls_time={HLS_SEGMENT_TIME}:hls_playlist_type=vod:hls_segment_type=fmp4'
+        f':hls_fmp4_init_filename={resolution}_init.mp4'
+        f':hls_segment_filename={os.path.join(hls_dir(source), resolution)}_%03d.m4s]'
+        f'{os.path.join(hls_dir(source), resolution)}.m3u8'
+    )
+    return f'{mp4_output}|{hls_output}'
+
+
+def write_hls_manifest(source):
+    """
+    Write the master playlist, listing every HLS variant converted so far.
+    """
+    lines = ['#EXTM3U', '#EXT-X-VERSION:7', '#EXT-X-INDEPENDENT-SEGMENTS']
+    for resolution, rendition in RENDITIONS.items():
+        if not os.path.isfile(os.path.join(hls_dir(source), f'{resolution}.m3u8')):
+            continue
+        bandwidth = (rendition['maxrate'] + rendition['audio_bitrate']) * 1000
+        lines.append(f"#EXT-X-STREAM-INF:BANDWIDTH={bandwidth},RESOLUTION={rendition['width']}x{rendition['height']}")
+        lines.append(f'{resolution}.m3u8')
+
+    with open(hls_manifest_path(source), 'w') as manifest:
+        manifest.write('\n'.join(lines) + '\n')
+
+
+def write_previews_vtt(source, source_duration):
+    """
+    Write the WebVTT index of the seek previews: one cue per thumbnail,
+    pointing to its position within the sprite sheet.
+    """
+    def timestamp(seconds):
+        hours, seconds = divmod(seconds, 3600)
+        minutes, seconds = divmod(seconds, 60)
+        return f'{int(hours):02d}:{int(minutes):02d}:{seconds:06.3f}'
+
+    lines = ['WEBVTT', '']
+    per_sheet = SPRITE_COLUMNS * SPRITE_ROWS
+    for index in range(math.ceil(source_duration / SPRITE_INTERVAL)):
+        start = index * SPRITE_INTERVAL
+        end = min(start + SPRITE_INTERVAL, source_duration)
+        sheet, position = divmod(index, per_sheet)
+        x = (position % SPRITE_COLUMNS) * SPRITE_WIDTH
+        y = (position // SPRITE_COLUMNS) * SPRITE_HEIGHT
+        lines.append(f'{timestamp(start)} --> {timestamp(end)}')
+        lines.append(f'sprites_{sheet + 1:03d}.jpg#xywh={x},{y},{SPRITE_WIDTH},{SPRITE_HEIGHT}')
+        lines.append('')
+
+    with open(previews_vtt_path(source), 'w') as vtt:
+        vtt.write('\n'.join(lines))
+
+
+def convert_video(source, resolutions=None, on_progress=None, threads=None, previews=False, copy=()):
+    """
+    Convert the source video into all renditions (or only the given ones)
+    with a single ffmpeg run. on_progress is called with the converted
+    percentage of the source, as reported by ffmpeg. With previews, the
+    poster and the seek preview sprites are extracted in the same run.
+    Renditions in copy are stream copied from the source.
+    """
+    if resolutions is None:
+        resolutions = list(RENDITIONS)
+    elif isinstance(resolutions, str):
+        # Jobs enqueued for a single resolution
+        resolutions = [resolutions]
+
+    os.makedirs(hls_dir(source), exist_ok=True)
+    if previews:
+        os.makedirs(previews_dir(source), exist_ok=True)
+    cmd = build_convert_command(source, resolutions, threads=threads, previews=previews, copy=copy)
+
+    started = time.monotonic()
+    process = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True, errors='replace')
+    source_duration = None
+    frames = 0
+    output = deque(maxlen=OUTPUT_LINES)
+    for line in process.stdout:
+        line = line.strip()
+        progress = PROGRESS_RE.match(line)
+        if progress:
+            key, value = progress.groups()
+            if key == 'out_time_us' and value.isdigit() and source_duration and on_progress:
+                on_progress(min(int(value) / 1000000 / source_duration * 100, 100))
+            elif key == 'frame' and value.isdigit():
+                frames = int(value)
+            continue
+
+        duration = DURATION_RE.search(line)
+        if duration and source_duration is None:
+            hours, minutes, seconds = duration.groups()
+            source_duration = int(hours) * 3600 + int(minutes) * 60 + float(seconds)
+        output.append(line)
+    return_code, usage = wait_for_process(process)
+    duration = time.monotonic() - started
+
+    bitrates = {}
+    if return_code == 0:
+        write_hls_manifest(source)
+        if previews and source_duration:
+            write_previews_vtt(source, source_duration)
+        if source_duration:
+            bitrates = {
+                resolution: round(os.path.getsize(rendition_path(source, resolution)) * 8 / source_duration)
+                for resolution in resolutions if os.path.isfile(rendition_path(source, resolution))
+            }
+    return ConvertResult(return_code, '\n'.join(output), duration, source_duration,
+                         usage.ru_utime, usage.ru_stime, usage.ru_maxrss * 1024,
+                         frames / duration if duration else None, bitrates)
+
+
+def wait_for_process(process):
+    """
+    Wait for a child process like Popen.wait(), but with os.wait4(), which also returns
+    the resource usage of exactly this child (ru_maxrss is in KiB on Linux).
+    Returns the exit code (negative for a signal, like Popen) and the usage.
+    """
+    _, status, usage = os.wait4(process.pid, 0)
+    process.returncode = os.waitstatus_to_exitcode(status)
+    return process.returncode, usage
+
+
+def describe_rendition(path):
+    """
+    Return the metadata of a converted file: size, bitrate, duration, codec and
+    dimensions. Values ffprobe can not report are None.
+    """
+    probe = probe_media(path) or {}
+    media_format = probe.get('format', {})
+    video = next((stream for stream in probe.get('streams', []) if stream.get('codec_type') == 'video'), {})
+
+    def number(value, cast=float):
+        try:
+            return cast(value)
+        except (TypeError, ValueError):
+            return None
+
+    return {
+        'size': os.path.getsize(path),
+        'bitrate': number(media_format.get('bit_rate'), int),
+        'duration': number(media_format.get('duration')),
+        'codec': video.get('codec_name'),
+        'width': number(video.get('width'), int),
+        'height': number(video.get('height'), int),
+    }
+
+
+def media_name(path):
+    # Name of a file below MEDIA_ROOT, as stored in file fields
+    return os.path.relpath(path, settings.MEDIA_ROOT)
+
+
+def plan_renditions(video):
+    """
+    Plan the rendition ladder of an analyzed video. Renditions larger than the
+    source are skipped, as upscaling only costs CPU and bandwidth. The smallest
+    rendition is always converted, so every video is playable.
+    Returns the renditions, smallest first.
+    """
+    resolutions = sorted(RENDITIONS, key=lambda resolution: RENDITIONS[resolution]['height'])
+    if not video.height:
+        return resolutions
+    return [resolutions[0]] + [
+        resolution for resolution in resolutions[1:] if RENDITIONS[resolution]['height'] <= video.height
+    ]
+
+
+def rendition_fits(video, resolution):
+    """
+    Check if the source already is a valid encoding of the rendition: same size,
+    a copyable codec, a bitrate within the rendition's limit and keyframes at the
+    HLS segment boundaries. Such renditions are stream copied (-c:v copy) instead
+    of re-encoded.
+    """
+    rendition = RENDITIONS[resolution]
+    max_bitrate = (rendition['maxrate'] + rendition['audio_bitrate']) * 1000
+    return (
+        video.video_codec in COPY_VIDEO_CODECS
+        and video.keyframes_aligned
+        and (video.width, video.height) == (rendition['width'], rendition['height'])
+        and video.bitrate is not None and video.bitrate <= max_bitrate
+    )
+
+
+def plan_transcode_jobs(video, resolutions):
+    """
+    Route the transcoding of an analyzed video to the queues, based on its duration and size.
+    Returns a list of (queue name, renditions) tuples.
+
+    Short clips are converted in one job on 'transcode-high'. For longer sources
+    the smallest rendition is converted first on 'transcode-high', so the video is
+    playable soon, and the remaining renditions on 'transcode-bulk'.
+    """
+    try:
+        size = video.video_file.size
+    except (OSError, ValueError):
+        size = 0
+    if size <= SHORT_CLIP_SIZE and (video.duration or 0) <= SHORT_CLIP_DURATION:
+        return [('transcode-high', list(resolutions))]
+
+    first, *remaining = resolutions
+    jobs = [('transcode-high', [first])]
+    if remaining:
+        jobs.append(('transcode-bulk', remaining))
+    return jobs
+
+
+def analyze_video(video_id, queue_name=None):
+    """
+    Analyze the source of a video with ffprobe, store its dimensions, codecs,
+    duration and bitrate, then plan the renditions and enqueue the transcoding jobs.
+    queue_name sends all jobs to one queue (e.g. 'transcode-bulk' for imports),
+    instead of routing them by duration and size.
+    """
+    video = Video.objects.get(pk=video_id)
+    media = analyze_media(video.video_file.path)
+    if media is not None:
+        for field, value in media.items():
+            setattr(video, field, value)
+        video.save(update_fields=[*media, 'updated_at'])
+        shared_file_videos(video).update(**media, updated_at=timezone.now())
+
+    resolutions = plan_renditions(video)
+    if queue_name:
+        plan = [(queue_name, resolutions)]
+    else:
+        plan = plan_transcode_jobs(video, resolutions)
+    jobs = []
+    # The jobs and their outbox entries are committed together
+    with transaction.atomic():
+        for index, (name, renditions) in enumerate(plan):
+            # The first job extracts the poster and seek previews in its decode pass
+            job = TranscodeJob.objects.create(video=video, renditions=renditions, previews=index == 0)
+            # One task per queue, converting its renditions in a single pass
+            enqueue_on_commit(name, transcode_video, job.id, retry_intervals=TRANSCODE_RETRY_INTERVALS)
+            jobs.append(job)
+    return jobs
+
+
+def record_renditions(video_id, source, resolutions, previews=False):
+    """
+    Store the metadata of the converted renditions, the HLS master playlist and the
+    seek previews on the video, so they can be listed without touching the filesystem.
+    Only files that exist are recorded.
+    """
+    renditions = {}
+    for resolution in resolutions:
+        path = rendition_path(source, resolution)
+        if os.path.isfile(path):
+            renditions[resolution] = {'path': media_name(path), **describe_rendition(path)}
+
+    # Jobs of the same video may finish at the same time, lock the row to merge their renditions
+    with transaction.atomic():
+        video = Video.objects.select_for_update().get(pk=video_id)
+        renditions = {**video.renditions, **renditions}
+        video.renditions = dict(sorted(renditions.items(), key=lambda item: item[1].get('height') or 0))
+        update_fields = ['renditions', 'updated_at']
+        if os.path.isfile(hls_manifest_path(source)):
+            video.hls_manifest.name = media_name(hls_manifest_path(source))
+            update_fields.append('hls_manifest')
+        if previews and os.path.isfile(previews_vtt_path(source)):
+            video.preview_vtt.name = media_name(previews_vtt_path(source))
+            update_fields.append('preview_vtt')
+        if previews and not video.thumbnail_file and os.path.isfile(poster_path(source)):
+            # Use the extracted poster, if no thumbnail was uploaded
+            video.thumbnail_file.name = media_name(poster_path(source))
+            update_fields.append('thumbnail_file')
+        video.save(update_fields=update_fields)
+
+        # Deduplicated uploads share the source, so they share the renditions as well
+        shared = {field: getattr(video, field) for field in ['renditions', 'hls_manifest', 'preview_vtt']}
+        shared_file_videos(video).update(**shared, updated_at=timezone.now())
+        if 'thumbnail_file' in update_fields:
+            shared_file_videos(video).filter(Q(thumbnail_file='') | Q(thumbnail_file__isnull=True)).update(
+                thumbnail_file=video.thumbnail_file.name, updated_at=timezone.now())
+
+
+def shared_file_videos(video):
+    """
+    Return the other videos using the same video file (deduplicated uploads).
+    """
+    return Video.objects.filter(video_file=video.video_file.name).exclude(pk=video.pk)
+
+
+def failed_state():
+    # RQ retries the job, if it has retries left
+    rq_job = get_current_job()
+    return TranscodeJob.STATE_RETRYING if rq_job and rq_job.retries_left else TranscodeJob.STATE_FAILED
+
+
+def defer_transcode(rq_job, job_id):
+    """
+    Enqueue a transcoding job again after SLOT_RETRY_DELAY seconds, on the same
+    queue and with the retries and timeout it has left.
+    """
+    retry = None
+    if rq_job.retries_left:
+        retry = Retry(max=rq_job.retries_left, interval=rq_job.retry_intervals)
+    django_rq.get_queue(rq_job.origin).enqueue_in(
+        timedelta(seconds=SLOT_RETRY_DELAY), transcode_video, job_id, retry=retry, job_timeout=rq_job.timeout)
+
+
+def transcode_video(job_id):
+    """
+    Run a transcoding job and record its state, progress and result.
+    Raises TranscodeError if ffmpeg fails, so RQ retries the job.
+    """
+    rq_job = get_current_job()
+    # A worker does not wait for a free slot, the wait would count against the job timeout
+    with transcode_slot(blocking=rq_job is None) as threads:
+        if threads is None:
+            defer_transcode(rq_job, job_id)
+            return
+        job = TranscodeJob.objects.select_related('video').get(pk=job_id)
+        job.state = TranscodeJob.STATE_RUNNING
+        job.attempts += 1
+        job.progress = 0
+        job.save(update_fields=['state', 'attempts', 'progress', 'updated_at'])
+
+        def record_progress(percent):
+            # Only write whole percent steps to the database
+            if percent - job.progress >= 1:
+                job.progress = round(percent, 1)
+                TranscodeJob.objects.filter(pk=job.pk).update(progress=job.progress)
+
+        try:
+            source = job.video.video_file.path
+            # Renditions the source already fits are copied, see analyze_video
+            copy = [resolution for resolution in job.renditions if rendition_fits(job.video, resolution)]
+            result = convert_video(source, job.renditions, on_progress=record_progress, threads=threads,
+                                   previews=job.previews, copy=copy)
+        except Exception as error:
+            # E.g. the source is missing or ffmpeg is not installed, do not leave the job running
+            job.state = failed_state()
+            job.output = f'{type(error).__name__}: {error}'
+            job.save(update_fields=['state', 'output', 'updated_at'])
+            raise
+
+    job.return_code = result.return_code
+    job.duration = result.duration
+    job.output = result.output
+    job.source_duration = result.source_duration
+    job.cpu_user = result.cpu_user
+    job.cpu_system = result.cpu_system
+    job.max_rss = result.max_rss
+    job.fps = result.fps
+    job.output_bitrates = result.bitrates
+    if result.return_code == 0:
+        job.state = TranscodeJob.STATE_DONE
+        job.progress = 100
+        record_renditions(job.video_id, source, job.renditions, previews=job.previews)
+    else:
+        job.state = failed_state()
+    job.save()
 
-    subprocess.run(cmd, capture_output=True)
\ No newline at end of file
+    if result.return_code != 0:
+        raise TranscodeError(f'ffmpeg exited with {result.return_code} for job {job.id}')
@@ -1,21 +1,98 @@
-from django.test import TestCase, Client
+from django.test import TestCase, Client, override_settings
+from django.conf import settings
+from django.core.cache import cache
+from django.core.management import call_command
+from django.core.management.base import CommandError
+from django.db import DatabaseError, connection, transaction
 from django.urls import reverse
 from rest_framework.test import APIClient
 from rest_framework.authtoken.models import Token
 from users.models import CustomUser
-from videoflix.models import Video
+from users.authentication import CachedTokenAuthentication
+from videoflix.admin import VideoResource
+from videoflix.cache import get_async_redis, get_catalog_version
+from videoflix.metrics import registry
+from videoflix.models import Video, Genre, TaskOutbox, TranscodeJob, UploadSession
+from videoflix.outbox import enqueue_on_commit, relay_outbox
 from videoflix.serializers import VideoItemSerializer
+from videoflix.uploadhandlers import HashingTemporaryFileUploadHandler
+from videoflix.views import ListVideos
+from videoflix.tasks import (analyze_video, convert_video, describe_rendition, hls_dir, keyframes_aligned,
+                             previews_dir, transcode_video, transcode_slot, write_hls_manifest, write_previews_vtt,
+                             TranscodeError)
 from rest_framework import status
 from django.core.files.uploadedfile import SimpleUploadedFile
+from datetime import date
+from unittest import mock
+from urllib.parse import urljoin
+import asyncio
+import csv
+import gzip
+import hashlib
+import io
+import json
 import os
+import re
+import sys
+import tablib
+import tempfile
 import time
+import warnings
+
+# Keep the catalog cache of the tests out of Redis
+LOCMEM_CACHES = {'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}}
+
+
+def take_outbox():
+    """ Return the pending outbox tasks as (queue, func path, args) and clear the outbox """
+    tasks = [(task.queue, task.func, task.args) for task in TaskOutbox.objects.order_by('id')]
+    TaskOutbox.objects.all().delete()
+    return tasks
+
+
+# Outbox tasks are not relayed to Redis after the commit, they stay in the outbox (see take_outbox)
+NO_RELAY = mock.patch('videoflix.outbox.relay_after_commit', lambda: None)
+
+ANALYZE_VIDEO = 'videoflix.tasks.analyze_video'
+TRANSCODE_VIDEO = 'videoflix.tasks.transcode_video'
+
+
+# Stand-in for ffmpeg: logs its arguments and creates the requested outputs (including tee outputs)
+FFMPEG_STUB = '''
+import json
+import sys
+args = sys.argv[1:]
+with open(sys.argv[0] + '.log', 'a') as log:
+    log.write(json.dumps(args) + '\\n')
+source = args[args.index('-i') + 1]
+sys.stderr.write('  Duration: 00:00:10.00, start: 0.000000, bitrate: 1000 kb/s\\n')
+sys.stderr.flush()
+for out_time in (2500000, 5000000, 10000000):
+    print(f'frame={out_time // 40000}')
+    print(f'out_time_us={out_time}')
+    print('progress=continue')
+try:
+    open(sys.argv[0] + '.fail').close()
+    sys.exit(1)
+except FileNotFoundError:
+    pass
+for arg in args:
+    for output in arg.split('|'):
+        path = output.split(']')[-1].replace('%03d', '001')
+        if path.endswith(('.mp4', '.m3u8', '.jpg')) and path != source:
+            open(path, 'w').close()
+print('progress=end')
+'''
+
 
 # Create your tests here.
     # Test loading all videos.
+@override_settings(CACHES=LOCMEM_CACHES)
 class VideosAPITest(TestCase):
     # Tests for videos listing and creation
 
     def setUp(self):
+        cache.clear()
         self.client = APIClient()
         self.user = CustomUser.objects.create_user(
             username='test_user', password='test_password', email='test@example.com')
@@ -30,8 +107,360 @@ class VideosAPITest(TestCase):
         # Assert response status and content
         self.assertEqual(response.status_code, status.HTTP_200_OK)
         # Assuming no videos exist initially
-        self.assertEqual(len(response.data), 0)
-        
+        self.assertEqual(len(response.data['results']), 0)
+        self.assertIsNone(response.data['next'])
+
+    def test_list_videos_cursor_pagination(self):
+        self.client.force_authenticate(user=self.user, token=self.token)
+        for day in (3, 1, 2):
+            Video.objects.create(title=f'Video {day}', description='Test', created_at=date(2024, 8, day),
+                                 video_file=f'videos/video_{day}.mp4')
+
+        # First page is ordered by created_at and links to the next one
+        response = self.client.get('/api/v1/videos/', {'page_size': 2})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual([video['title'] for video in response.data['results']], ['Video 1', 'Video 2'])
+        self.assertIsNotNone(response.data['next'])
+
+        # Following the cursor returns the remaining video and no further link
+        response = self.client.get(response.data['next'])
+        self.assertEqual([video['title'] for video in response.data['results']], ['Video 3'])
+        self.assertIsNone(response.data['next'])
+
+        # A tampered cursor is rejected
+        response = self.client.get('/api/v1/videos/', {'cursor': 'not-a-cursor'})
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+
+    def test_list_videos_selected_fields(self):
+        self.client.force_authenticate(user=self.user, token=self.token)
+        Video.objects.create(title='Test Video', description='Test', video_file='videos/test.mp4')
+
+        # Only the requested fields are serialized, renditions that are not converted yet are missing
+        response = self.client.get('/api/v1/videos/', {'fields': 'id,title,video_file_360p,renditions'})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(set(response.data['results'][0]), {'id', 'title', 'video_file_360p', 'renditions'})
+        self.assertIsNone(response.data['results'][0]['video_file_360p'])
+        self.assertEqual(response.data['results'][0]['renditions'], [])
+
+        # Converted renditions are listed with their recorded metadata
+        rendition = {'path': 'videos/test_360p.mp4', 'size': 1000, 'bitrate': 800000, 'duration': 10.0,
+                     'codec': 'h264', 'width': 640, 'height': 360}
+        Video.objects.update(renditions={'360p': rendition}, hls_manifest='videos/test_hls/master.m3u8',
+                             preview_vtt='videos/test_previews/previews.vtt')
+        cache.clear()
+        response = self.client.get('/api/v1/videos/', {'fields': 'video_file_360p,video_file_720p,renditions'})
+        self.assertEqual(response.data['results'][0]['video_file_360p'], '/api/v1/media/videos/test_360p.mp4')
+        self.assertIsNone(response.data['results'][0]['video_file_720p'])
+        self.assertEqual(response.data['results'][0]['renditions'], [
+            {'name': '360p', 'url': '/api/v1/media/videos/test_360p.mp4', 'size': 1000, 'bitrate': 800000,
+             'duration': 10.0, 'codec': 'h264', 'width': 640, 'height': 360}])
+
+        response = self.client.get('/api/v1/videos/', {'fields': 'hls_manifest,preview_vtt'})
+        self.assertEqual(response.data['results'][0]['hls_manifest'], '/api/v1/media/videos/test_hls/master.m3u8')
+        self.assertEqual(response.data['results'][0]['preview_vtt'], '/api/v1/media/videos/test_previews/previews.vtt')
+        response = self.client.get('/api/v1/videos/', {'fields': 'video_file,thumbnail_file'})
+        self.assertEqual(response.data['results'][0],
+                         {'video_file': '/api/v1/media/videos/test.mp4', 'thumbnail_file': None})
+
+        # Unknown fields are rejected
+        response = self.client.get('/api/v1/videos/', {'fields': 'id,password'})
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_list_videos_by_genre(self):
+        self.client.force_authenticate(user=self.user, token=self.token)
+        drama = Genre.objects.create(name='Drama')
+        comedy = Genre.objects.create(name='Comedy')
+        for day, genre in enumerate([drama, comedy, drama], 1):
+            Video.objects.create(title=f'Video {day}', description='Test', created_at=date(2024, 8, day),
+                                 genre=genre, video_file=f'videos/video_{day}.mp4')
+
+        # By id or by name
+        response = self.client.get('/api/v1/videos/', {'genre': drama.id})
+        self.assertEqual([video['title'] for video in response.data['results']], ['Video 1', 'Video 3'])
+        response = self.client.get('/api/v1/videos/', {'genre': 'Comedy'})
+        self.assertEqual([video['title'] for video in response.data['results']], ['Video 2'])
+
+    @NO_RELAY
+    def test_list_genres_with_videos(self):
+        self.client.force_authenticate(user=self.user, token=self.token)
+        # The catalog version is bumped once the videos are committed
+        with self.captureOnCommitCallbacks(execute=True):
+            drama = Genre.objects.create(name='Drama')
+            comedy = Genre.objects.create(name='Comedy')
+            Genre.objects.create(name='Empty')
+            for day in range(1, 5):
+                Video.objects.create(title=f'Drama {day}', description='Test', created_at=date(2024, 8, day),
+                                     genre=drama, video_file=f'videos/drama_{day}.mp4')
+            Video.objects.create(title='Comedy 1', description='Test', genre=comedy, video_file='videos/comedy.mp4')
+            Video.objects.create(title='No genre', description='Test', video_file='videos/none.mp4')
+
+        # The newest videos per genre, loaded in a single query
+        with self.assertNumQueries(1):
+            response = self.client.get('/api/v1/genres/with-videos/', {'limit': 2})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual([genre['name'] for genre in response.data], ['Comedy', 'Drama'])
+        self.assertEqual([video['title'] for video in response.data[1]['videos']], ['Drama 4', 'Drama 3'])
+        self.assertEqual(response.data[1]['videos'][0]['genre'], 'Drama')
+
+        response = self.client.get('/api/v1/genres/with-videos/', {'fields': 'id,title'})
+        self.assertEqual(len(response.data[1]['videos']), 4)
+        self.assertEqual(set(response.data[1]['videos'][0]), {'id', 'title'})
+
+        response = self.client.get('/api/v1/genres/with-videos/', {'limit': 'all'})
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_search_videos(self):
+        self.client.force_authenticate(user=self.user, token=self.token)
+        for day, title in enumerate(['Ocean Storm', 'Mountain Ocean', 'Desert Night'], 1):
+            Video.objects.create(title=title, description='Test', created_at=date(2024, 8, day),
+                                 video_file=f'videos/video_{day}.mp4')
+
+        # Matching videos only, one page at a time
+        response = self.client.get('/api/v1/videos/search/', {'q': 'ocean', 'page_size': 1})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(len(response.data['results']), 1)
+        self.assertIsNotNone(response.data['next'])
+        second = self.client.get(response.data['next'])
+        self.assertIsNone(second.data['next'])
+        titles = {video['title'] for video in response.data['results'] + second.data['results']}
+        self.assertEqual(titles, {'Ocean Storm', 'Mountain Ocean'})
+
+        # All terms must match
+        response = self.client.get('/api/v1/videos/search/', {'q': 'ocean storm', 'fields': 'id,title'})
+        self.assertEqual([video['title'] for video in response.data['results']], ['Ocean Storm'])
+        self.assertEqual(set(response.data['results'][0]), {'id', 'title'})
+
+        # A query is required, and the page must be valid
+        response = self.client.get('/api/v1/videos/search/')
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        response = self.client.get('/api/v1/videos/search/', {'q': 'ocean', 'page': 0})
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+
+    @mock.patch('videoflix.signals.search_supported', return_value=True)
+    @mock.patch('videoflix.signals.update_search_vectors')
+    def test_search_vector_saved_with_video(self, update_search_vectors, search_supported):
+        # The vector is written by the INSERT or UPDATE of the video, not by a query of its own
+        with mock.patch.object(Video, '_save_table', autospec=True) as save_table:
+            video = Video(title='Ocean Storm', description='Waves')
+            video.save()
+        self.assertIs(save_table.call_args.args[0], video)
+        self.assertIn("Value('Ocean Storm')", repr(video.search_vector))
+        self.assertIn("Value('Waves')", repr(video.search_vector))
+        update_search_vectors.assert_not_called()
+
+        # Saves of other fields leave it alone, saved titles are updated afterwards
+        video = Video(id=1, title='Ocean Storm', description='Waves')
+        with mock.patch.object(Video, '_save_table', autospec=True):
+            video.save(update_fields=['renditions'])
+            update_search_vectors.assert_not_called()
+            video.save(update_fields=['title'])
+        update_search_vectors.assert_called_once()
+
+    @NO_RELAY
+    def test_list_videos_query_count(self):
+        self.client.force_authenticate(user=self.user, token=self.token)
+
+        # The number of queries must not grow with the number of videos (no N+1 on genre)
+        for count in (1, 5):
+            with self.captureOnCommitCallbacks(execute=True):
+                for i in range(count):
+                    genre = Genre.objects.create(name=f'Genre {count}-{i}')
+                    Video.objects.create(title=f'Video {count}-{i}', description='Test', genre=genre,
+                                         video_file=f'videos/video_{count}_{i}.mp4')
+            with self.assertNumQueries(1):
+                response = self.client.get('/api/v1/videos/')
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+            self.assertTrue(all(video['genre'] for video in response.data['results']))
+
+        with self.assertNumQueries(1):
+            response = self.client.get('/api/v1/videos/', {'fields': 'id,genre'})
+        self.assertEqual(len(response.data['results']), 6)
+
+        video = Video.objects.first()
+        with self.assertNumQueries(1):
+            response = self.client.get(f'/api/v1/videos/{video.id}/')
+        self.assertEqual(response.data['genre'], video.genre.name)
+
+    def test_create_video_atomic(self):
+        # The upload is stored, keep it out of the project's media folder
+        media_root = tempfile.TemporaryDirectory()
+        self.addCleanup(media_root.cleanup)
+        settings_override = self.settings(MEDIA_ROOT=media_root.name)
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+        self.client.force_authenticate(user=self.user, token=self.token)
+        video_file = SimpleUploadedFile('video.mp4', b'video content', content_type='video/mp4')
+
+        # A failure after the video and its analysis task are inserted rolls back both
+        with mock.patch('videoflix.outbox.transaction.on_commit', side_effect=DatabaseError()):
+            with self.assertRaises(DatabaseError):
+                self.client.post('/api/v1/videos/', {'title': 'Video', 'description': 'Test',
+                                                     'video_file': video_file}, format='multipart')
+        self.assertFalse(Video.objects.exists())
+        self.assertFalse(TaskOutbox.objects.exists())
+
+    def test_video_status(self):
+        self.client.force_authenticate(user=self.user, token=self.token)
+        video = Video.objects.create(title='Test Video', description='Test', video_file='videos/test.mp4')
+        TranscodeJob.objects.create(video=video, renditions=['360p', '720p'])
+
+        response = self.client.get(f'/api/v1/videos/{video.id}/status/')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertFalse(response.data['ready'])
+        self.assertEqual(response.data['renditions']['360p']['state'], TranscodeJob.STATE_QUEUED)
+
+        # A later job (e.g. a retry of a single rendition) decides the state
+        TranscodeJob.objects.filter(video=video).update(state=TranscodeJob.STATE_DONE, progress=100)
+        TranscodeJob.objects.create(video=video, renditions=['720p'], state=TranscodeJob.STATE_FAILED)
+        response = self.client.get(f'/api/v1/videos/{video.id}/status/')
+        self.assertFalse(response.data['ready'])
+        self.assertEqual(response.data['renditions']['360p']['state'], TranscodeJob.STATE_DONE)
+        self.assertEqual(response.data['renditions']['720p']['state'], TranscodeJob.STATE_FAILED)
+
+        TranscodeJob.objects.filter(video=video).update(state=TranscodeJob.STATE_DONE)
+        self.assertTrue(self.client.get(f'/api/v1/videos/{video.id}/status/').data['ready'])
+
+        # Before the analysis no rendition is planned
+        video = Video.objects.create(title='Small Video', description='Test', video_file='videos/small.mp4')
+        response = self.client.get(f'/api/v1/videos/{video.id}/status/')
+        self.assertFalse(response.data['ready'])
+        self.assertEqual(response.data['renditions'], {'360p': None, '720p': None})
+
+        # A 360p source is not upscaled, so it is ready without a 720p rendition
+        TranscodeJob.objects.create(video=video, renditions=['360p'], state=TranscodeJob.STATE_DONE, progress=100)
+        response = self.client.get(f'/api/v1/videos/{video.id}/status/')
+        self.assertTrue(response.data['ready'])
+        self.assertEqual(list(response.data['renditions']), ['360p'])
+
+    @NO_RELAY
+    def test_catalog_cache_invalidation(self):
+        self.client.force_authenticate(user=self.user, token=self.token)
+        with self.captureOnCommitCallbacks(execute=True):
+            Video.objects.create(title='First Video', description='Test', video_file='videos/first.mp4')
+            Genre.objects.create(name='Drama')
+
+        # The second request is served from the cache
+        for url in ('/api/v1/videos/', '/api/v1/genres/'):
+            first_response = self.client.get(url)
+            with self.assertNumQueries(0):
+                response = self.client.get(url)
+            self.assertEqual(response.data, first_response.data)
+
+        # Saving or deleting a video or genre invalidates the cached responses, once committed
+        with self.captureOnCommitCallbacks(execute=True):
+            Video.objects.create(title='Second Video', description='Test', video_file='videos/second.mp4')
+            Genre.objects.create(name='Comedy')
+        self.assertEqual(len(self.client.get('/api/v1/videos/').data['results']), 2)
+        self.assertEqual(len(self.client.get('/api/v1/genres/').data), 2)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            Genre.objects.get(name='Comedy').delete()
+        self.assertEqual(len(self.client.get('/api/v1/genres/').data), 1)
+
+    @NO_RELAY
+    def test_catalog_invalidation_after_commit(self):
+        self.client.force_authenticate(user=self.user, token=self.token)
+        version = get_catalog_version()
+
+        with self.captureOnCommitCallbacks(execute=True):
+            Video.objects.create(title='First Video', description='Test', video_file='videos/first.mp4')
+            # Not bumped before the commit, so a read of the old rows (e.g. by a concurrent
+            # request) is cached under the old version only
+            self.assertEqual(get_catalog_version(), version)
+            with mock.patch.object(ListVideos, 'get_data', return_value={'results': []}):
+                self.client.get('/api/v1/videos/')
+        self.assertNotEqual(get_catalog_version(), version)
+        self.assertEqual(len(self.client.get('/api/v1/videos/').data['results']), 1)
+
+    @NO_RELAY
+    def test_catalog_conditional_get(self):
+        self.client.force_authenticate(user=self.user, token=self.token)
+        with self.captureOnCommitCallbacks(execute=True):
+            Video.objects.create(title='First Video', description='Test', video_file='videos/first.mp4')
+
+        etags = {}
+        for url in ('/api/v1/videos/', '/api/v1/genres/'):
+            response = self.client.get(url)
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+            etag = etags[url] = response['ETag']
+            self.assertFalse(etag.startswith('W/'))  # Strong ETag
+
+            # Matching validators are answered with 304, without touching the database
+            with self.assertNumQueries(0):
+                response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+            self.assertEqual(response.status_code, status.HTTP_304_NOT_MODIFIED)
+            response = self.client.get(url, HTTP_IF_MODIFIED_SINCE=response['Last-Modified'])
+            self.assertEqual(response.status_code, status.HTTP_304_NOT_MODIFIED)
+
+        # A catalog change produces a new ETag, once committed
+        with self.captureOnCommitCallbacks(execute=True):
+            Video.objects.create(title='Second Video', description='Test', video_file='videos/second.mp4')
+        response = self.client.get('/api/v1/videos/', HTTP_IF_NONE_MATCH=etags['/api/v1/videos/'])
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertNotEqual(response['ETag'], etags['/api/v1/videos/'])
+
+    def test_async_catalog_views(self):
+        drama = Genre.objects.create(name='Drama')
+        video = Video.objects.create(title='Ocean Video', description='Test', genre=drama,
+                                     video_file='videos/ocean.mp4')
+        Video.objects.create(title='Forest Video', description='Test', video_file='videos/forest.mp4')
+
+        # A token is required
+        response = self.client.get('/api/v1/async/videos/')
+        self.assertEqual(response.status_code, status.HTTP_401_UNAUTHORIZED)
+        self.assertEqual(response['WWW-Authenticate'], 'Token')
+        self.client.credentials(HTTP_AUTHORIZATION='Token invalid')
+        self.assertEqual(self.client.get('/api/v1/async/videos/').status_code, status.HTTP_401_UNAUTHORIZED)
+
+        # The async views return the same data as the sync ones
+        self.client.credentials(HTTP_AUTHORIZATION=f'Token {self.token.key}')
+        for url, params in (('videos/', {'page_size': 1}), ('videos/', {'genre': 'Drama', 'fields': 'id,title'}),
+                            (f'videos/{video.id}/', {}), ('videos/search/', {'q': 'ocean'}),
+                            ('genres/', {}), ('genres/with-videos/', {'limit': 1})):
+            sync_response = self.client.get(f'/api/v1/{url}', params)
+            cache.clear()
+            response = self.client.get(f'/api/v1/async/{url}', params)
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+            # (apart from the next links, which point to the async URLs)
+            self.assertEqual(response.content.decode().replace('/api/v1/async/', '/api/v1/'),
+                             json.dumps(sync_response.data, separators=(',', ':')), url)
+
+        # Served from the cache, and answered with 304 for a matching ETag
+        self.client.get('/api/v1/async/genres/')
+        with self.assertNumQueries(0):
+            response = self.client.get('/api/v1/async/genres/')
+        self.assertEqual(len(response.json()), 1)
+        response = self.client.get('/api/v1/async/genres/', HTTP_IF_NONE_MATCH=response['ETag'])
+        self.assertEqual(response.status_code, status.HTTP_304_NOT_MODIFIED)
+
+        # Errors are reported like by the sync views
+        response = self.client.get('/api/v1/async/videos/', {'fields': 'id,password'})
+        self.assertEqual(response.status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertEqual(response.json(), {'error': 'Unknown field(s): password.'})
+        self.assertEqual(self.client.get('/api/v1/async/videos/search/').status_code, status.HTTP_400_BAD_REQUEST)
+        self.assertEqual(self.client.get('/api/v1/async/videos/999/').status_code, status.HTTP_404_NOT_FOUND)
+        self.assertEqual(self.client.get('/api/v1/async/videos/', {'cursor': 'x'}).status_code,
+                         status.HTTP_404_NOT_FOUND)
+
+    def test_async_redis_client(self):
+        # The async client connects to the first server of the cache settings, nothing is connected yet
+        redis_caches = {'default': {
+            'BACKEND': 'django_redis.cache.RedisCache',
+            'LOCATION': 'redis://10.0.0.1:6380/2,redis://10.0.0.2:6380/2',
+            'OPTIONS': {'PASSWORD': 'secret'},
+        }}
+        with self.settings(CACHES=redis_caches):
+            client = asyncio.run(self.get_async_redis())
+        self.assertEqual(
+            {key: client.connection_pool.connection_kwargs[key] for key in ['host', 'port', 'db', 'password']},
+            {'host': '10.0.0.1', 'port': 6380, 'db': 2, 'password': 'secret'})
+
+        # No client for other cache backends
+        self.assertIsNone(asyncio.run(self.get_async_redis()))
+
+    async def get_async_redis(self):
+        return get_async_redis()
+
 
 # class VideoUploadTestCase(TestCase):
 #     def setUp(self):
@@ -86,4 +515,1027 @@ class VideosAPITest(TestCase):
 #             # os.remove(video_720p_path)
 #             # os.remove(video_1080p_path)
 #         except FileNotFoundError:
-#             pass
\ No newline at end of file
+#             pass
+
+
+@override_settings(CACHES=LOCMEM_CACHES)
+class ConvertVideoTest(TestCase):
+    # Tests for the ffmpeg conversion, using a stub ffmpeg
+
+    def setUp(self):
+        tmp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp_dir.cleanup)
+        self.tmp_dir = tmp_dir.name
+        self.ffmpeg = os.path.join(self.tmp_dir, 'ffmpeg.py')
+        with open(self.ffmpeg, 'w') as file:
+            file.write(FFMPEG_STUB)
+        self.source = os.path.join(self.tmp_dir, 'video.mp4')
+        open(self.source, 'w').close()
+        settings_override = self.settings(MEDIA_ROOT=self.tmp_dir)
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+
+    def ffmpeg_calls(self):
+        with open(self.ffmpeg + '.log') as log:
+            return [json.loads(line) for line in log]
+
+    def test_convert_all_renditions_in_one_pass(self):
+        progress = []
+        with self.settings(FFMPEG_COMMAND=[sys.executable, self.ffmpeg]):
+            result = convert_video(self.source, on_progress=progress.append)
+        self.assertEqual(result.return_code, 0)
+
+        # Progress is parsed from -progress pipe:1, relative to the source duration
+        self.assertEqual(progress, [25, 50, 100])
+
+        # ffmpeg runs once, decoding the source once and splitting it per rendition
+        calls = self.ffmpeg_calls()
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(calls[0].count('-i'), 1)
+        self.assertIn('split=2', calls[0][calls[0].index('-filter_complex') + 1])
+        for resolution in ('360p', '720p'):
+            self.assertTrue(os.path.isfile(os.path.join(self.tmp_dir, f'video_{resolution}.mp4')))
+            self.assertTrue(os.path.isfile(os.path.join(self.tmp_dir, 'video_hls', f'{resolution}.m3u8')))
+
+    def test_convert_writes_hls_manifest(self):
+        with self.settings(FFMPEG_COMMAND=[sys.executable, self.ffmpeg]):
+            convert_video(self.source, '360p')
+
+        # HLS variants are written as fMP4 segments
+        self.assertIn('hls_segment_type=fmp4', ' '.join(self.ffmpeg_calls()[0]))
+
+        # The master playlist lists the converted variants only
+        with open(os.path.join(self.tmp_dir, 'video_hls', 'master.m3u8')) as manifest:
+            playlist = manifest.read()
+        self.assertTrue(playlist.startswith('#EXTM3U'))
+        self.assertIn('#EXT-X-STREAM-INF:BANDWIDTH=1096000,RESOLUTION=640x360\n360p.m3u8', playlist)
+        self.assertNotIn('720p.m3u8', playlist)
+
+    def test_convert_extracts_previews(self):
+        with self.settings(FFMPEG_COMMAND=[sys.executable, self.ffmpeg]):
+            convert_video(self.source, '360p', previews=True)
+
+        # Poster and sprites come from the same decode pass
+        calls = self.ffmpeg_calls()
+        self.assertEqual(len(calls), 1)
+        self.assertIn('split=3', calls[0][calls[0].index('-filter_complex') + 1])
+        self.assertTrue(os.path.isfile(os.path.join(self.tmp_dir, 'video_previews', 'poster.jpg')))
+
+        # One WebVTT cue per thumbnail of the 10 second source
+        with open(os.path.join(self.tmp_dir, 'video_previews', 'previews.vtt')) as vtt:
+            cues = vtt.read()
+        self.assertTrue(cues.startswith('WEBVTT'))
+        self.assertIn('00:00:05.000 --> 00:00:10.000\nsprites_001.jpg#xywh=160,0,160,90', cues)
+
+    def test_transcode_job(self):
+        # Creating a video enqueues its analysis
+        video = Video.objects.create(title='Test Video', description='Test', video_file='video.mp4')
+        self.assertEqual(take_outbox(), [('transcode-high', ANALYZE_VIDEO, [video.id])])
+        self.assertFalse(TranscodeJob.objects.exists())
+
+        # The analysis records a job and enqueues it with retries (ffprobe is not available in tests)
+        analyze_video(video.id)
+        job = TranscodeJob.objects.get(video=video)
+        self.assertEqual(job.renditions, ['360p', '720p'])
+        self.assertTrue(job.previews)
+        self.assertEqual(job.state, TranscodeJob.STATE_QUEUED)
+        self.assertEqual(TaskOutbox.objects.get().retry_intervals, [60, 300, 900])
+        self.assertEqual(take_outbox(), [('transcode-high', TRANSCODE_VIDEO, [job.id])])
+
+        with self.settings(FFMPEG_COMMAND=[sys.executable, self.ffmpeg]):
+            transcode_video(job.id)
+        job.refresh_from_db()
+        self.assertEqual(job.state, TranscodeJob.STATE_DONE)
+        self.assertEqual(job.return_code, 0)
+        self.assertEqual(job.progress, 100)
+        self.assertEqual(job.attempts, 1)
+        self.assertIn('Duration: 00:00:10.00', job.output)
+        self.assertIsNotNone(job.duration)
+
+        # Resource usage of the ffmpeg run, the stub reports 250 frames
+        self.assertEqual(job.source_duration, 10)
+        self.assertGreater(job.cpu_user + job.cpu_system, 0)
+        self.assertGreater(job.max_rss, 1024 * 1024)
+        self.assertAlmostEqual(job.fps, 250 / job.duration)
+        self.assertEqual(job.output_bitrates, {'360p': 0, '720p': 0})
+
+        # The extracted poster is used as thumbnail, as none was uploaded
+        video.refresh_from_db()
+        self.assertEqual(video.thumbnail_file.name, 'video_previews/poster.jpg')
+
+        # The converted files are recorded (the stub writes empty files, ffprobe can not read them)
+        self.assertEqual(list(video.renditions), ['360p', '720p'])
+        self.assertEqual(video.renditions['360p']['path'], 'video_360p.mp4')
+        self.assertEqual(video.renditions['360p']['size'], 0)
+        self.assertEqual(video.hls_manifest.name, 'video_hls/master.m3u8')
+        self.assertEqual(video.preview_vtt.name, 'video_previews/previews.vtt')
+
+        # Deleting the video removes all its files
+        video.delete()
+        self.assertEqual(sorted(os.listdir(self.tmp_dir)), ['ffmpeg.py', 'ffmpeg.py.log'])
+
+    def test_transcode_job_error(self):
+        video = Video.objects.create(title='Test Video', description='Test', video_file='video.mp4')
+        job = TranscodeJob.objects.create(video=video, renditions=['360p'])
+
+        # ffmpeg is not installed
+        with self.settings(FFMPEG_COMMAND=[os.path.join(self.tmp_dir, 'missing-ffmpeg')]):
+            with self.assertRaises(FileNotFoundError):
+                transcode_video(job.id)
+        job.refresh_from_db()
+        self.assertEqual(job.state, TranscodeJob.STATE_FAILED)
+        self.assertEqual(job.attempts, 1)
+        self.assertTrue(job.output.startswith('FileNotFoundError: '))
+
+    def test_transcode_report(self):
+        video = Video.objects.create(title='Test Video', description='Test', video_file='video.mp4')
+        for renditions, cpu_user, bitrates in ((['360p'], 50, {'360p': 800000}),
+                                               (['360p'], 100, {'360p': 1000000}),
+                                               (['360p', '720p'], 400, {'360p': 900000, '720p': 2500000})):
+            TranscodeJob.objects.create(video=video, renditions=renditions, state=TranscodeJob.STATE_DONE,
+                                        source_duration=600, duration=60, cpu_user=cpu_user, cpu_system=20,
+                                        max_rss=200 * 1024 * 1024, fps=250, output_bitrates=bitrates)
+        # Failed jobs and jobs from before the resource accounting are left out
+        TranscodeJob.objects.create(video=video, renditions=['360p'], state=TranscodeJob.STATE_FAILED,
+                                    source_duration=600, duration=60, cpu_user=10, cpu_system=1)
+        TranscodeJob.objects.create(video=video, renditions=['360p'], state=TranscodeJob.STATE_DONE, duration=60)
+
+        stdout = io.StringIO()
+        call_command('transcode_report', '--json', stdout=stdout)
+        report = json.loads(stdout.getvalue())
+
+        # 20 video minutes in 190 CPU seconds, 10 video minutes in 420 CPU seconds
+        self.assertEqual(report['rendition_sets'], [
+            {'renditions': '360p', 'jobs': 2, 'video_minutes': 20.0, 'cpu_hours': 0.053, 'wall_hours': 0.033,
+             'video_minutes_per_cpu_hour': 378.9, 'video_minutes_per_wall_hour': 600.0, 'mean_fps': 250.0,
+             'peak_rss_mb': 200.0},
+            {'renditions': '360p,720p', 'jobs': 1, 'video_minutes': 10.0, 'cpu_hours': 0.117, 'wall_hours': 0.017,
+             'video_minutes_per_cpu_hour': 85.7, 'video_minutes_per_wall_hour': 600.0, 'mean_fps': 250.0,
+             'peak_rss_mb': 200.0},
+        ])
+        self.assertEqual(report['renditions'], [
+            {'rendition': '360p', 'jobs': 3, 'mean_bitrate': 900000, 'max_bitrate': 1000000,
+             'target_bitrate': 1096000},
+            {'rendition': '720p', 'jobs': 1, 'mean_bitrate': 2500000, 'max_bitrate': 2500000,
+             'target_bitrate': 3128000},
+        ])
+
+        stdout = io.StringIO()
+        call_command('transcode_report', stdout=stdout)
+        self.assertIn('360p: 2 job(s), 20.0 video minutes, 378.9 video minutes per CPU-hour', stdout.getvalue())
+
+    def probe_result(self, width=1920, height=1080, codec='h264', duration=60, bitrate=5000000):
+        return {
+            'format': {'duration': str(duration), 'bit_rate': str(bitrate)},
+            'streams': [{'codec_type': 'video', 'codec_name': codec, 'width': width, 'height': height},
+                        {'codec_type': 'audio', 'codec_name': 'aac'}],
+        }
+
+    @mock.patch('videoflix.tasks.probe_media')
+    def test_transcode_queue_routing(self, probe_media):
+        # Short clips are converted at once, with high priority
+        probe_media.return_value = self.probe_result(duration=60)
+        video = Video.objects.create(title='Short Video', description='Test', video_file='video.mp4')
+        take_outbox()
+        analyze_video(video.id)
+        self.assertEqual(take_outbox(), [('transcode-high', TRANSCODE_VIDEO, [video.transcode_jobs.get().id])])
+        self.assertEqual([job.renditions for job in video.transcode_jobs.all()], [['360p', '720p']])
+
+        # The analysis is stored on the video
+        video.refresh_from_db()
+        self.assertEqual((video.width, video.height, video.video_codec, video.audio_codec), (1920, 1080, 'h264', 'aac'))
+        self.assertEqual((video.duration, video.bitrate), (60, 5000000))
+
+        # Long videos get their 360p rendition first, the rest is converted on the bulk queue
+        probe_media.return_value = self.probe_result(duration=3600)
+        video = Video.objects.create(title='Long Video', description='Test', video_file='video.mp4')
+        take_outbox()
+        analyze_video(video.id)
+        self.assertEqual([task[0] for task in take_outbox()], ['transcode-high', 'transcode-bulk'])
+        self.assertEqual([job.renditions for job in video.transcode_jobs.order_by('id')], [['360p'], ['720p']])
+
+        # Imports send everything to one queue
+        analyze_video(video.id, 'transcode-bulk')
+        self.assertEqual([task[0] for task in take_outbox()], ['transcode-bulk'])
+
+    @mock.patch('videoflix.tasks.probe_media')
+    def test_transcode_ladder(self, probe_media):
+        # Small sources are not upscaled, the smallest rendition is always converted
+        for height, renditions in ((240, ['360p']), (480, ['360p']), (720, ['360p', '720p'])):
+            probe_media.return_value = self.probe_result(width=height * 16 // 9, height=height)
+            video = Video.objects.create(title='Video', description='Test', video_file='video.mp4')
+            analyze_video(video.id)
+            self.assertEqual(video.transcode_jobs.get().renditions, renditions)
+
+        # A 720p H.264 source within the bitrate limit, with a keyframe at every HLS segment
+        # boundary, is copied into the 720p rendition
+        probe_media.return_value = self.probe_result(width=1280, height=720, bitrate=2500000)
+        video = Video.objects.create(title='Video', description='Test', video_file='video.mp4')
+        with mock.patch('videoflix.tasks.probe_keyframes', return_value=[1.5 + i * 2 for i in range(30)]):
+            analyze_video(video.id)
+        video.refresh_from_db()
+        self.assertTrue(video.keyframes_aligned)
+        with self.settings(FFMPEG_COMMAND=[sys.executable, self.ffmpeg]):
+            transcode_video(video.transcode_jobs.get().id)
+        args = self.ffmpeg_calls()[-1]
+        self.assertEqual(args.count('libx264'), 1)
+        copied = args.index('copy')
+        self.assertEqual(args[copied - 5:copied + 1], ['-map', '0:v:0', '-map', '0:a?', '-c:v', 'copy'])
+        self.assertIn('video_720p.mp4', args[copied + 7])
+        # Only the encoded rendition and the previews are decoded and split
+        self.assertIn('split=3', args[args.index('-filter_complex') + 1])
+
+        # Its segments would not line up with the encoded variants, so it is re-encoded
+        video = Video.objects.create(title='Video', description='Test', video_file='video.mp4')
+        with mock.patch('videoflix.tasks.probe_keyframes', return_value=[i * 5 for i in range(12)]):
+            analyze_video(video.id)
+        video.refresh_from_db()
+        self.assertFalse(video.keyframes_aligned)
+        with self.settings(FFMPEG_COMMAND=[sys.executable, self.ffmpeg]):
+            transcode_video(video.transcode_jobs.get().id)
+        self.assertEqual(self.ffmpeg_calls()[-1].count('libx264'), 2)
+
+    def test_keyframes_aligned(self):
+        self.assertTrue(keyframes_aligned([0, 2, 4.04, 6, 8, 9], 10))
+        self.assertFalse(keyframes_aligned([0, 2, 4.5, 6, 8.04], 10))
+        # Segments start at the last boundary before the end
+        self.assertFalse(keyframes_aligned([0, 4], 10))
+        self.assertFalse(keyframes_aligned(None, 10))
+
+    def test_transcode_slots(self):
+        # No more ffmpeg runs than slots at the same time on a host
+        with self.settings(TRANSCODE_CONCURRENCY=2, TRANSCODE_LOCK_DIR=self.tmp_dir):
+            with transcode_slot() as first, transcode_slot() as second:
+                self.assertIsNotNone(first)
+                self.assertIsNotNone(second)
+                with transcode_slot(blocking=False) as third:
+                    self.assertIsNone(third)
+            with transcode_slot(blocking=False) as slot:
+                self.assertIsNotNone(slot)
+
+    @mock.patch('videoflix.tasks.django_rq.get_queue')
+    @mock.patch('videoflix.tasks.get_current_job')
+    def test_transcode_job_deferred(self, get_current_job, get_queue):
+        video = Video.objects.create(title='Test Video', description='Test', video_file='video.mp4')
+        job = TranscodeJob.objects.create(video=video, renditions=['360p'])
+        get_current_job.return_value = mock.Mock(origin='transcode-low', retries_left=2, retry_intervals=[300, 900],
+                                                 timeout=3600)
+
+        # A worker that finds no free slot enqueues the job again instead of waiting
+        with self.settings(TRANSCODE_CONCURRENCY=1, TRANSCODE_LOCK_DIR=self.tmp_dir):
+            with transcode_slot():
+                transcode_video(job.id)
+        get_queue.assert_called_once_with('transcode-low')
+        delay, func, job_id = get_queue.return_value.enqueue_in.call_args.args
+        self.assertEqual(delay.total_seconds(), 30)
+        self.assertEqual((func, job_id), (transcode_video, job.id))
+        kwargs = get_queue.return_value.enqueue_in.call_args.kwargs
+        self.assertEqual((kwargs['retry'].max, kwargs['retry'].intervals), (2, [300, 900]))
+        self.assertEqual(kwargs['job_timeout'], 3600)
+        job.refresh_from_db()
+        self.assertEqual(job.state, TranscodeJob.STATE_QUEUED)
+        self.assertEqual(job.attempts, 0)
+
+    def test_transcode_job_failure(self):
+        video = Video.objects.create(title='Test Video', description='Test', video_file='video.mp4')
+        job, = analyze_video(video.id)
+        open(self.ffmpeg + '.fail', 'w').close()
+
+        with self.settings(FFMPEG_COMMAND=[sys.executable, self.ffmpeg]):
+            with self.assertRaises(TranscodeError):
+                transcode_video(job.id)
+        job.refresh_from_db()
+        self.assertEqual(job.state, TranscodeJob.STATE_FAILED)
+        self.assertEqual(job.return_code, 1)
+
+    @mock.patch('videoflix.tasks.probe_media')
+    def test_describe_rendition(self, probe_media):
+        path = os.path.join(self.tmp_dir, 'video_360p.mp4')
+        with open(path, 'wb') as file:
+            file.write(b'0' * 100)
+        probe_media.return_value = {
+            'format': {'duration': '10.000000', 'bit_rate': '812345'},
+            'streams': [{'codec_type': 'audio', 'codec_name': 'aac'},
+                        {'codec_type': 'video', 'codec_name': 'h264', 'width': 640, 'height': 360}],
+        }
+        self.assertEqual(describe_rendition(path), {'size': 100, 'bitrate': 812345, 'duration': 10.0,
+                                                    'codec': 'h264', 'width': 640, 'height': 360})
+
+    @mock.patch('videoflix.tasks.probe_media')
+    def test_backfill_renditions(self, probe_media):
+        probe_media.return_value = {'format': {'duration': '10.000000', 'bit_rate': '812345'},
+                                    'streams': [{'codec_type': 'video', 'codec_name': 'h264', 'width': 640,
+                                                 'height': 360}]}
+        # Converted before the renditions were stored on the video
+        video = Video.objects.create(title='Test Video', description='Test', video_file='video.mp4')
+        with open(os.path.join(self.tmp_dir, 'video_360p.mp4'), 'wb') as file:
+            file.write(b'0' * 100)
+        missing = Video.objects.create(title='Missing Video', description='Test', video_file='missing.mp4')
+
+        call_command('backfill_renditions', stderr=io.StringIO())
+        video.refresh_from_db()
+        self.assertEqual(video.renditions, {'360p': {'path': 'video_360p.mp4', 'size': 100, 'bitrate': 812345,
+                                                     'duration': 10.0, 'codec': 'h264', 'width': 640,
+                                                     'height': 360}})
+        missing.refresh_from_db()
+        self.assertEqual(missing.renditions, {})
+        response = VideoItemSerializer(video).data
+        self.assertIsNotNone(response['video_file_360p'])
+
+    def test_convert_single_rendition(self):
+        with self.settings(FFMPEG_COMMAND=[sys.executable, self.ffmpeg]):
+            convert_video(self.source, '360p')
+
+        self.assertTrue(os.path.isfile(os.path.join(self.tmp_dir, 'video_360p.mp4')))
+        self.assertFalse(os.path.isfile(os.path.join(self.tmp_dir, 'video_720p.mp4')))
+
+
+@override_settings(CACHES=LOCMEM_CACHES)
+class DeduplicationTest(TestCase):
+    # Tests for the content hash deduplication of uploads
+
+    def setUp(self):
+        tmp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp_dir.cleanup)
+        self.tmp_dir = tmp_dir.name
+        self.ffmpeg = os.path.join(self.tmp_dir, 'ffmpeg.py')
+        with open(self.ffmpeg, 'w') as file:
+            file.write(FFMPEG_STUB)
+        settings_override = self.settings(MEDIA_ROOT=self.tmp_dir)
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+        self.client = APIClient()
+        user = CustomUser.objects.create_user(username='test_user', password='test_password', email='test@example.com')
+        self.client.force_authenticate(user=user)
+
+    def upload(self, title, content):
+        response = self.client.post('/api/v1/videos/', {
+            'title': title, 'description': 'Test',
+            'video_file': SimpleUploadedFile('upload.mp4', content, content_type='video/mp4'),
+        }, format='multipart')
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        return Video.objects.get(pk=response.data['id'])
+
+    def test_hashing_upload_handler(self):
+        handler = HashingTemporaryFileUploadHandler()
+        handler.new_file('video_file', 'upload.mp4', 'video/mp4', 6)
+        handler.receive_data_chunk(b'abc', 0)
+        handler.receive_data_chunk(b'def', 3)
+        file = handler.file_complete(6)
+        self.assertEqual(file.sha256, hashlib.sha256(b'abcdef').hexdigest())
+        file.close()
+
+    def test_duplicate_upload(self):
+        original = self.upload('Original', b'video content')
+        self.assertEqual(original.content_hash, hashlib.sha256(b'video content').hexdigest())
+        self.assertEqual(take_outbox(), [('transcode-high', ANALYZE_VIDEO, [original.id])])
+
+        # The same content is stored and analyzed only once
+        duplicate = self.upload('Duplicate', b'video content')
+        self.assertEqual(duplicate.video_file.name, original.video_file.name)
+        self.assertEqual(duplicate.content_hash, original.content_hash)
+        self.assertEqual(take_outbox(), [])
+        self.assertEqual(os.listdir(os.path.join(self.tmp_dir, 'videos')), [os.path.basename(original.video_file.name)])
+
+        other = self.upload('Other', b'other content')
+        self.assertNotEqual(other.video_file.name, original.video_file.name)
+
+        # The renditions of the original are shared with the duplicate
+        with self.settings(FFMPEG_COMMAND=[sys.executable, self.ffmpeg]):
+            job, = analyze_video(original.id)
+            transcode_video(job.id)
+        original.refresh_from_db()
+        duplicate.refresh_from_db()
+        self.assertEqual(list(duplicate.renditions), ['360p', '720p'])
+        self.assertEqual(duplicate.renditions, original.renditions)
+        self.assertEqual(duplicate.hls_manifest.name, original.hls_manifest.name)
+        self.assertEqual(duplicate.thumbnail_file.name, original.thumbnail_file.name)
+
+        # The duplicate has no jobs of its own, it reports the jobs of the original
+        response = self.client.get(f'/api/v1/videos/{duplicate.id}/status/')
+        self.assertTrue(response.data['ready'])
+        self.assertEqual(response.data['renditions']['720p']['state'], TranscodeJob.STATE_DONE)
+
+        # Files are deleted with the last video using them
+        original.delete()
+        self.assertTrue(os.path.isfile(duplicate.video_file.path))
+        # Without the jobs of the original, the copied renditions are reported
+        response = self.client.get(f'/api/v1/videos/{duplicate.id}/status/')
+        self.assertTrue(response.data['ready'])
+        self.assertEqual(list(response.data['renditions']), ['360p', '720p'])
+        self.assertTrue(os.path.isfile(duplicate.thumbnail_file.path))
+        self.assertTrue(os.path.isfile(os.path.join(self.tmp_dir, duplicate.renditions['360p']['path'])))
+        duplicate.delete()
+        self.assertFalse(os.path.isfile(duplicate.video_file.path))
+        self.assertFalse(os.path.isfile(duplicate.thumbnail_file.path))
+        self.assertFalse(os.path.isdir(os.path.join(self.tmp_dir, os.path.dirname(duplicate.hls_manifest.name))))
+
+
+@override_settings(CACHES=LOCMEM_CACHES)
+@NO_RELAY
+class UploadSessionTest(TestCase):
+    # Tests for the resumable uploads
+
+    def setUp(self):
+        tmp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp_dir.cleanup)
+        self.tmp_dir = tmp_dir.name
+        self.upload_dir = os.path.join(self.tmp_dir, 'uploads')
+        settings_override = self.settings(MEDIA_ROOT=os.path.join(self.tmp_dir, 'media'),
+                                          UPLOAD_SESSION_DIR=self.upload_dir)
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+        self.client = APIClient()
+        self.user = CustomUser.objects.create_user(username='test_user', password='test_password',
+                                                   email='test@example.com')
+        self.client.force_authenticate(user=self.user)
+        self.content = os.urandom(3000)
+
+    def start(self, **data):
+        response = self.client.post('/api/v1/uploads/', {
+            'filename': '../My Video.mp4', 'length': len(self.content), 'title': 'Uploaded', **data})
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        return response
+
+    def send(self, url, offset, data):
+        return self.client.patch(url, data, content_type='application/offset+octet-stream',
+                                 headers={'Upload-Offset': str(offset)})
+
+    def test_resumable_upload(self):
+        response = self.start()
+        url = response['Location']
+        self.assertEqual(response['Upload-Offset'], '0')
+        self.assertEqual(response.data['filename'], 'My_Video.mp4')
+
+        # First chunk, then the client asks where to resume
+        response = self.send(url, 0, self.content[:1000])
+        self.assertEqual(response.status_code, status.HTTP_204_NO_CONTENT)
+        self.assertEqual(response['Upload-Offset'], '1000')
+        response = self.client.head(url)
+        self.assertEqual(response['Upload-Offset'], '1000')
+        self.assertEqual(response['Upload-Length'], '3000')
+
+        # Chunks must continue at the received offset
+        response = self.send(url, 500, self.content[500:])
+        self.assertEqual(response.status_code, status.HTTP_409_CONFLICT)
+        response = self.client.post(f'{url}finalize/')
+        self.assertEqual(response.status_code, status.HTTP_409_CONFLICT)
+
+        response = self.send(url, 1000, self.content[1000:])
+        self.assertEqual(response['Upload-Offset'], '3000')
+
+        # Finalizing moves the file into the media storage and starts the analysis
+        response = self.client.post(f'{url}finalize/')
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        video = Video.objects.get(pk=response.data['id'])
+        self.assertEqual(video.title, 'Uploaded')
+        self.assertEqual(video.video_file.name, 'videos/My_Video.mp4')
+        with video.video_file.open('rb') as file:
+            self.assertEqual(file.read(), self.content)
+        self.assertEqual(video.content_hash, hashlib.sha256(self.content).hexdigest())
+        self.assertEqual(take_outbox(), [('transcode-high', ANALYZE_VIDEO, [video.id])])
+        self.assertFalse(UploadSession.objects.exists())
+        self.assertEqual(os.listdir(self.upload_dir), [])
+
+    def test_finalize_atomic(self):
+        url = self.start()['Location']
+        self.send(url, 0, self.content)
+
+        # Ending the session fails, so the video and its analysis task are rolled back
+        with mock.patch.object(UploadSession, 'delete', side_effect=DatabaseError()):
+            with self.assertRaises(DatabaseError):
+                self.client.post(f'{url}finalize/')
+        self.assertFalse(Video.objects.exists())
+        self.assertFalse(TaskOutbox.objects.exists())
+        self.assertTrue(UploadSession.objects.exists())
+
+        # The file is moved back out of the storage, so finalizing can be retried
+        self.assertEqual(os.listdir(os.path.join(self.tmp_dir, 'media', 'videos')), [])
+        with open(os.path.join(self.upload_dir, os.listdir(self.upload_dir)[0]), 'rb') as file:
+            self.assertEqual(file.read(), self.content)
+        with self.captureOnCommitCallbacks(execute=True):
+            response = self.client.post(f'{url}finalize/')
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        with Video.objects.get().video_file.open('rb') as file:
+            self.assertEqual(file.read(), self.content)
+        self.assertEqual(os.listdir(self.upload_dir), [])
+
+    def test_lost_upload_file(self):
+        url = self.start()['Location']
+        self.send(url, 0, self.content)
+
+        # Bytes that are no longer on disk are not finalized, the client sends them again
+        os.truncate(os.path.join(self.upload_dir, os.listdir(self.upload_dir)[0]), 1000)
+        response = self.client.post(f'{url}finalize/')
+        self.assertEqual(response.status_code, status.HTTP_409_CONFLICT)
+        self.assertEqual(response['Upload-Offset'], '1000')
+        self.assertFalse(Video.objects.exists())
+
+        self.send(url, 1000, self.content[1000:])
+        response = self.client.post(f'{url}finalize/')
+        self.assertEqual(response.status_code, status.HTTP_201_CREATED)
+        with Video.objects.get().video_file.open('rb') as file:
+            self.assertEqual(file.read(), self.content)
+
+    def test_upload_limits(self):
+        url = self.start()['Location']
+
+        response = self.client.patch(url, self.content, content_type='application/octet-stream',
+                                     headers={'Upload-Offset': '0'})
+        self.assertEqual(response.status_code, status.HTTP_415_UNSUPPORTED_MEDIA_TYPE)
+
+        # Bytes beyond the announced length are rejected, the announced ones are kept
+        response = self.send(url, 0, self.content + b'more')
+        self.assertEqual(response.status_code, status.HTTP_413_REQUEST_ENTITY_TOO_LARGE)
+        self.assertEqual(response['Upload-Offset'], '3000')
+
+        # Uploads of other users can not be seen
+        other = CustomUser.objects.create_user(username='other', password='test_password', email='other@example.com')
+        self.client.force_authenticate(user=other)
+        self.assertEqual(self.client.head(url).status_code, status.HTTP_404_NOT_FOUND)
+
+        # Aborting deletes the received bytes, once committed
+        self.client.force_authenticate(user=self.user)
+        with self.captureOnCommitCallbacks(execute=True):
+            response = self.client.delete(url)
+        self.assertEqual(response.status_code, status.HTTP_204_NO_CONTENT)
+        self.assertEqual(os.listdir(self.upload_dir), [])
+
+
+@override_settings(CACHES=LOCMEM_CACHES)
+class StreamMediaTest(TestCase):
+    # Tests for streaming media files with byte ranges
+
+    def setUp(self):
+        media_root = tempfile.TemporaryDirectory()
+        self.addCleanup(media_root.cleanup)
+        os.makedirs(os.path.join(media_root.name, 'videos'))
+        with open(os.path.join(media_root.name, 'videos', 'video.mp4'), 'wb') as file:
+            file.write(b'0123456789')
+        settings_override = self.settings(MEDIA_ROOT=media_root.name)
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+
+        self.client = APIClient()
+        self.user = CustomUser.objects.create_user(username='test_user', password='test_password')
+        self.token = Token.objects.create(user=self.user)
+        self.client.credentials(HTTP_AUTHORIZATION='Token ' + self.token.key)
+        self.url = '/api/v1/media/videos/video.mp4'
+
+    def test_stream_whole_file(self):
+        response = self.client.get(self.url, HTTP_ACCEPT='video/*')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(b''.join(response.streaming_content), b'0123456789')
+        self.assertEqual(response['Accept-Ranges'], 'bytes')
+        self.assertEqual(response['Content-Type'], 'video/mp4')
+
+    def test_stream_byte_ranges(self):
+        response = self.client.get(self.url, HTTP_RANGE='bytes=2-5')
+        self.assertEqual(response.status_code, status.HTTP_206_PARTIAL_CONTENT)
+        self.assertEqual(b''.join(response.streaming_content), b'2345')
+        self.assertEqual(response['Content-Range'], 'bytes 2-5/10')
+        self.assertEqual(response['Content-Length'], '4')
+
+        # Open ended and suffix ranges
+        response = self.client.get(self.url, HTTP_RANGE='bytes=7-')
+        self.assertEqual(b''.join(response.streaming_content), b'789')
+        response = self.client.get(self.url, HTTP_RANGE='bytes=-3', HTTP_IF_RANGE=response['ETag'])
+        self.assertEqual(b''.join(response.streaming_content), b'789')
+
+        # A changed file (If-Range mismatch) is sent as a whole
+        response = self.client.get(self.url, HTTP_RANGE='bytes=2-5', HTTP_IF_RANGE='"outdated"')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+        # Ranges outside of the file can not be satisfied
+        response = self.client.get(self.url, HTTP_RANGE='bytes=20-30')
+        self.assertEqual(response.status_code, status.HTTP_416_REQUESTED_RANGE_NOT_SATISFIABLE)
+        self.assertEqual(response['Content-Range'], 'bytes */10')
+
+    def test_stream_access(self):
+        # Token via query parameter, for <video> elements
+        client = APIClient()
+        self.assertEqual(client.get(self.url).status_code, status.HTTP_401_UNAUTHORIZED)
+        self.assertEqual(client.get(self.url, {'token': self.token.key}).status_code, status.HTTP_200_OK)
+
+        # No files outside of MEDIA_ROOT
+        response = self.client.get('/api/v1/media/../manage.py')
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+        response = self.client.get('/api/v1/media/videos/missing.mp4')
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+
+    def test_stream_hls_playlist(self):
+        # Layout of a converted video: the master playlist, a variant with its init and media segments
+        source = os.path.join(settings.MEDIA_ROOT, 'videos', 'video.mp4')
+        os.makedirs(hls_dir(source))
+        with open(os.path.join(hls_dir(source), '360p.m3u8'), 'w') as file:
+            file.write('#EXTM3U\n#EXT-X-VERSION:7\n#EXT-X-TARGETDURATION:4\n#EXT-X-PLAYLIST-TYPE:VOD\n'
+                       '#EXT-X-MAP:URI="360p_init.mp4"\n#EXTINF:4.000000,\n360p_000.m4s\n#EXT-X-ENDLIST\n')
+        for name in ['360p_init.mp4', '360p_000.m4s']:
+            with open(os.path.join(hls_dir(source), name), 'wb') as file:
+                file.write(name.encode())
+        write_hls_manifest(source)
+        video = Video.objects.create(title='Test', description='Test', video_file='videos/video.mp4',
+                                     hls_manifest='videos/video_hls/master.m3u8')
+
+        # The player follows the relative URIs of the playlists, with the token of the master playlist
+        manifest_url = VideoItemSerializer(video).data['hls_manifest']
+        client = APIClient()
+        master = client.get(manifest_url, {'token': self.token.key})
+        self.assertEqual(master.status_code, status.HTTP_200_OK)
+        self.assertEqual(master['Content-Type'], 'application/vnd.apple.mpegurl')
+        self.assertIn('no-store', master['Cache-Control'])
+        variant_uri = master.content.decode().splitlines()[-1]
+        self.assertEqual(variant_uri, f'360p.m3u8?token={self.token.key}')
+        variant_url = urljoin(manifest_url, variant_uri)
+        variant = client.get(variant_url)
+        self.assertEqual(variant.status_code, status.HTTP_200_OK)
+        init_uri = re.search(r'URI="([^"]*)"', variant.content.decode()).group(1)
+        segment_uri = [line for line in variant.content.decode().splitlines() if line.endswith(self.token.key)][-1]
+        for uri, content in [(init_uri, b'360p_init.mp4'), (segment_uri, b'360p_000.m4s')]:
+            response = client.get(urljoin(variant_url, uri))
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+            self.assertEqual(b''.join(response.streaming_content), content)
+
+        # Playlists are still rewritten with X-Accel-Redirect, the segments are served by nginx
+        with self.settings(MEDIA_X_ACCEL_REDIRECT_PREFIX='/protected-media/'):
+            self.assertEqual(client.get(variant_url).content, variant.content)
+            response = client.get(urljoin(variant_url, segment_uri))
+        self.assertEqual(response['X-Accel-Redirect'], '/protected-media/videos/video_hls/360p_000.m4s')
+
+        # With the Authorization header, the playlist is served as is
+        response = self.client.get(manifest_url)
+        self.assertEqual(b''.join(response.streaming_content).decode().splitlines()[-1], '360p.m3u8')
+
+    def test_stream_preview_sprites(self):
+        source = os.path.join(settings.MEDIA_ROOT, 'videos', 'video.mp4')
+        os.makedirs(previews_dir(source))
+        write_previews_vtt(source, 12)
+        with open(os.path.join(previews_dir(source), 'sprites_001.jpg'), 'wb') as file:
+            file.write(b'sprites')
+
+        vtt_url = '/api/v1/media/videos/video_previews/previews.vtt'
+        client = APIClient()
+        response = client.get(vtt_url, {'token': self.token.key})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        cue = response.content.decode().split('\n\n')[1].splitlines()
+        self.assertEqual(cue[1], f'sprites_001.jpg?token={self.token.key}#xywh=0,0,160,90')
+        response = client.get(urljoin(vtt_url, cue[1].split('#')[0]))
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+    def test_stream_x_accel_redirect(self):
+        with self.settings(MEDIA_X_ACCEL_REDIRECT_PREFIX='/protected-media/'):
+            response = self.client.get(self.url)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response['X-Accel-Redirect'], '/protected-media/videos/video.mp4')
+
+        # File names are URL quoted
+        with open(os.path.join(settings.MEDIA_ROOT, 'videos', 'my vidéo?.mp4'), 'wb') as file:
+            file.write(b'0123456789')
+        with self.settings(MEDIA_X_ACCEL_REDIRECT_PREFIX='/protected-media/'):
+            response = self.client.get('/api/v1/media/videos/my%20vid%C3%A9o%3F.mp4')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response['X-Accel-Redirect'], '/protected-media/videos/my%20vid%C3%A9o%3F.mp4')
+
+
+@override_settings(CACHES=LOCMEM_CACHES)
+class ExportVideosTest(TestCase):
+    # Tests for the streaming catalog export
+
+    def setUp(self):
+        tmp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp_dir.cleanup)
+        self.output = os.path.join(tmp_dir.name, 'videos.ndjson.gz')
+
+    def export(self, *args):
+        call_command('export_videos', '--output', self.output, *args, stderr=io.StringIO())
+
+    def test_export_ndjson_gzip(self):
+        genre = Genre.objects.create(name='Drama')
+        videos = [Video.objects.create(title=f'Video {i}', description='Test', genre=genre,
+                                       video_file=f'videos/video_{i}.mp4') for i in range(3)]
+
+        self.export('--gzip', '--chunk-size', '2')
+        with gzip.open(self.output, 'rt') as file:
+            rows = [json.loads(line) for line in file]
+        self.assertEqual([row['id'] for row in rows], [video.id for video in videos])
+        self.assertEqual(rows[0]['video_file'], 'videos/video_0.mp4')
+        self.assertEqual(rows[0]['genre'], genre.id)
+
+        # Incremental exports, by id or by update time
+        self.export('--gzip', '--after-id', str(videos[0].id))
+        with gzip.open(self.output, 'rt') as file:
+            self.assertEqual(len(file.readlines()), 2)
+
+        Video.objects.filter(pk=videos[1].pk).update(updated_at='2030-01-01T00:00:00Z')
+        self.export('--gzip', '--since', '2029-12-31T00:00:00Z')
+        with gzip.open(self.output, 'rt') as file:
+            self.assertEqual([json.loads(line)['id'] for line in file], [videos[1].id])
+
+    def test_export_csv(self):
+        Video.objects.create(title='Test, "quoted"', description='Test', video_file='videos/test.mp4')
+
+        self.export('--format', 'csv')
+        with open(self.output, newline='') as file:
+            rows = list(csv.DictReader(file))
+        self.assertEqual(len(rows), 1)
+        self.assertEqual(rows[0]['title'], 'Test, "quoted"')
+
+    def export_stdout(self, *args):
+        # The export is written to the binary stream of stdout
+        stdout = io.TextIOWrapper(io.BytesIO(), encoding='utf-8')
+        with mock.patch('sys.stdout', stdout):
+            call_command('export_videos', *args, stderr=io.StringIO())
+        return stdout.buffer.getvalue()
+
+    def test_export_stdout(self):
+        video = Video.objects.create(title='Test Video', description='Test', video_file='videos/test.mp4')
+
+        output = self.export_stdout('--format', 'csv')
+        rows = list(csv.DictReader(io.StringIO(output.decode(), newline='')))
+        self.assertEqual([row['id'] for row in rows], [str(video.id)])
+
+        # Compressed
+        rows = gzip.decompress(self.export_stdout('--gzip')).decode().splitlines()
+        self.assertEqual([json.loads(row)['id'] for row in rows], [video.id])
+
+    def test_export_since_naive(self):
+        videos = [Video.objects.create(title=f'Video {i}', description='Test') for i in range(2)]
+        Video.objects.filter(pk=videos[1].pk).update(updated_at='2030-01-01T00:00:00Z')
+
+        # Timestamps without offset are in the current time zone, without a naive datetime warning
+        with self.settings(TIME_ZONE='Europe/Berlin'), warnings.catch_warnings():
+            warnings.simplefilter('error', RuntimeWarning)
+            output = self.export_stdout('--since', '2030-01-01T00:30:00')
+        self.assertEqual([json.loads(row)['id'] for row in output.decode().splitlines()], [videos[1].id])
+
+
+# No job of the outbox exists in Redis yet
+NO_JOBS = mock.patch('videoflix.outbox.Job.fetch_many', lambda job_ids, connection: [None] * len(job_ids))
+
+
+@override_settings(CACHES=LOCMEM_CACHES)
+@NO_JOBS
+@mock.patch('videoflix.outbox.django_rq.get_queue')
+class ImportVideosTest(TestCase):
+    # Tests for the bulk catalog import
+
+    def setUp(self):
+        tmp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp_dir.cleanup)
+        self.input = os.path.join(tmp_dir.name, 'videos.ndjson')
+
+    def test_import_ndjson(self, get_queue):
+        genre = Genre.objects.create(name='Drama')
+        existing = Video.objects.create(title='Old title', description='Test')
+        rows = [{'id': existing.id, 'title': 'New title', 'description': 'Test', 'created_at': '2024-01-01',
+                 'genre': genre.id}]
+        rows += [{'title': f'Video {i}', 'description': 'Test', 'created_at': '2024-01-02',
+                  'video_file': f'videos/video_{i}.mp4', 'genre': genre.id} for i in range(3)]
+        with open(self.input, 'w') as file:
+            file.writelines(json.dumps(row) + '\n' for row in rows)
+
+        with self.captureOnCommitCallbacks(execute=True), \
+                mock.patch.object(connection.ops, 'sequence_reset_sql', return_value=[]) as sequence_reset_sql:
+            call_command('import_videos', '--input', self.input, '--chunk-size', '2', stderr=io.StringIO())
+            # Nothing is enqueued before the import is committed
+            get_queue.assert_not_called()
+        # The id sequence is moved past the imported ids
+        sequence_reset_sql.assert_called_once_with(mock.ANY, [Video])
+        self.assertFalse(TaskOutbox.objects.filter(enqueued_at__isnull=True).exists())
+
+        existing.refresh_from_db()
+        self.assertEqual(existing.title, 'New title')
+        self.assertEqual(existing.genre, genre)
+        self.assertEqual(Video.objects.count(), 4)
+
+        # One analysis per created video, enqueued in a single batch on the bulk queue
+        created = Video.objects.exclude(pk=existing.pk).order_by('id')
+        get_queue.assert_called_once_with('transcode-bulk', autocommit=True)
+        queue = get_queue.return_value
+        queue.enqueue.assert_not_called()
+        job_datas, = queue.enqueue_many.call_args.args
+        self.assertEqual(len(job_datas), 3)
+        self.assertEqual([call.args[0] for call in queue.prepare_data.call_args_list], [analyze_video] * 3)
+        self.assertEqual([call.kwargs['args'] for call in queue.prepare_data.call_args_list],
+                         [(video.id, 'transcode-bulk') for video in created])
+        self.assertEqual([call.kwargs['job_id'] for call in queue.prepare_data.call_args_list],
+                         [str(task.job_id) for task in TaskOutbox.objects.order_by('id')])
+
+    def test_import_rollback(self, get_queue):
+        with open(self.input, 'w') as file:
+            file.write(json.dumps({'title': 'Video', 'video_file': 'videos/video.mp4'}) + '\n')
+            file.write(json.dumps({'description': 'Missing title'}) + '\n')
+
+        with self.captureOnCommitCallbacks(execute=True):
+            with self.assertRaises(CommandError):
+                call_command('import_videos', '--input', self.input, stderr=io.StringIO())
+        self.assertFalse(Video.objects.exists())
+        self.assertFalse(TaskOutbox.objects.exists())
+        get_queue.assert_not_called()
+
+    def test_import_restores_renditions(self, get_queue):
+        media_root = os.path.dirname(self.input)
+        fields = {'video_file': 'videos/video.mp4', 'content_hash': 'a' * 64, 'width': 1280, 'height': 720,
+                  'video_codec': 'h264', 'audio_codec': 'aac', 'duration': 10.5, 'bitrate': 3000000,
+                  'keyframes_aligned': True, 'renditions': {'360p': {'path': 'videos/video_360p.mp4', 'height': 360}},
+                  'hls_manifest': 'videos/video_hls/master.m3u8', 'preview_vtt': 'videos/video_previews/previews.vtt'}
+
+        for format in ('ndjson', 'csv'):
+            with self.settings(MEDIA_ROOT=media_root):
+                Video.objects.all().delete()
+                Video.objects.create(title='Video', description='Test', **fields)
+                TaskOutbox.objects.all().delete()
+                call_command('export_videos', '--format', format, '--output', self.input, stderr=io.StringIO())
+                Video.objects.all().delete()
+
+                # A restored backup keeps the analysis and the converted files, so it is not transcoded again
+                with self.captureOnCommitCallbacks(execute=True):
+                    call_command('import_videos', '--format', format, '--input', self.input, stderr=io.StringIO())
+            video = Video.objects.get()
+            self.assertEqual({field: getattr(video, field) for field in fields},
+                             {**fields, 'video_file': mock.ANY, 'hls_manifest': mock.ANY, 'preview_vtt': mock.ANY})
+            self.assertEqual((video.video_file.name, video.hls_manifest.name, video.preview_vtt.name),
+                             (fields['video_file'], fields['hls_manifest'], fields['preview_vtt']))
+            self.assertFalse(TaskOutbox.objects.exists())
+        get_queue.assert_not_called()
+
+    def test_admin_import(self, get_queue):
+        dataset = tablib.Dataset(headers=['id', 'title', 'description', 'video_file'])
+        dataset.append(['', 'Video', 'Test', 'videos/video.mp4'])
+
+        with self.captureOnCommitCallbacks(execute=True):
+            result = VideoResource().import_data(dataset, dry_run=True)
+        self.assertFalse(result.has_errors())
+        self.assertFalse(Video.objects.exists())
+
+        with self.captureOnCommitCallbacks(execute=True):
+            result = VideoResource().import_data(dataset)
+        self.assertFalse(result.has_errors())
+        video = Video.objects.get()
+        get_queue.return_value.prepare_data.assert_called_once_with(analyze_video, args=(video.id, 'transcode-bulk'),
+                                                                   job_id=mock.ANY, retry=None)
+        get_queue.return_value.enqueue_many.assert_called_once()
+        get_queue.return_value.enqueue.assert_not_called()
+
+
+@override_settings(CACHES=LOCMEM_CACHES)
+@mock.patch('videoflix.outbox.django_rq.get_queue')
+class OutboxTest(TestCase):
+    # Tests for the transactional outbox of the background tasks
+
+    @NO_JOBS
+    def test_enqueue_on_commit(self, get_queue):
+        with self.captureOnCommitCallbacks(execute=True):
+            task = enqueue_on_commit('light', transcode_video, 1, retry_intervals=[60])
+            # Only the outbox entry is written within the transaction
+            get_queue.assert_not_called()
+
+        get_queue.assert_called_once_with('light', autocommit=True)
+        queue = get_queue.return_value
+        queue.prepare_data.assert_called_once_with(transcode_video, args=(1,), job_id=str(task.job_id), retry=mock.ANY)
+        self.assertEqual(queue.prepare_data.call_args.kwargs['retry'].intervals, [60])
+        queue.enqueue_many.assert_called_once()
+        task.refresh_from_db()
+        self.assertIsNotNone(task.enqueued_at)
+
+    def test_rollback(self, get_queue):
+        with self.captureOnCommitCallbacks(execute=True):
+            with self.assertRaises(ValueError), transaction.atomic():
+                Video.objects.create(title='Video', description='Test', video_file='video.mp4')
+                raise ValueError()
+        self.assertFalse(TaskOutbox.objects.exists())
+        get_queue.assert_not_called()
+
+    @NO_JOBS
+    def test_relay_after_redis_failure(self, get_queue):
+        # The tasks stay in the outbox while Redis is not reachable
+        get_queue.return_value.enqueue_many.side_effect = ConnectionError()
+        with self.assertLogs('videoflix.outbox', 'ERROR'), self.captureOnCommitCallbacks(execute=True):
+            Video.objects.create(title='Video', description='Test', video_file='video.mp4')
+        self.assertTrue(TaskOutbox.objects.filter(enqueued_at__isnull=True).exists())
+
+        # And are relayed later on, by the relay_outbox command
+        get_queue.return_value.enqueue_many.side_effect = None
+        output = io.StringIO()
+        call_command('relay_outbox', stderr=output)
+        self.assertIn('Relayed 1 task(s)', output.getvalue())
+        self.assertFalse(TaskOutbox.objects.filter(enqueued_at__isnull=True).exists())
+        self.assertEqual(relay_outbox(), 0)
+
+    def test_relay_skips_existing_jobs(self, get_queue):
+        Video.objects.create(title='Video', description='Test', video_file='video.mp4')
+        # The job was enqueued before, but the outbox entry was not marked
+        with mock.patch('videoflix.outbox.Job.fetch_many', return_value=[mock.Mock(id=None)]) as fetch_many:
+            fetch_many.return_value[0].id = str(TaskOutbox.objects.get().job_id)
+            self.assertEqual(relay_outbox(), 1)
+        get_queue.return_value.prepare_data.assert_not_called()
+        get_queue.return_value.enqueue_many.assert_not_called()
+
+
+@override_settings(CACHES=LOCMEM_CACHES)
+class BenchmarkTest(TestCase):
+    # Tests for the benchmark suite
+
+    def test_benchmark(self):
+        tmp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp_dir.cleanup)
+        ffmpeg = os.path.join(tmp_dir.name, 'ffmpeg.py')
+        with open(ffmpeg, 'w') as file:
+            file.write(FFMPEG_STUB)
+        output = os.path.join(tmp_dir.name, 'results.json')
+
+        with self.settings(FFMPEG_COMMAND=[sys.executable, ffmpeg]):
+            call_command('benchmark', '--videos', '30', '--genres', '3', '--requests', '3', '--login-requests', '1',
+                         '--transcode-duration', '1', '--transcode-sources', '640x360', '--output', output,
+                         stderr=io.StringIO())
+        with open(output) as file:
+            results = json.load(file)
+
+        self.assertEqual([(result['endpoint'], result['cache']) for result in results['api']], [
+            ('videos', 'cold'), ('videos', 'warm'), ('video', 'cold'), ('video', 'warm'),
+            ('genres', 'cold'), ('genres', 'warm'), ('login', None)])
+        self.assertTrue(all(result['errors'] == 0 for result in results['api']))
+        # Warm requests are served from the catalog cache
+        self.assertEqual(results['api'][1]['queries_max'], 0)
+        self.assertGreater(results['api'][0]['queries_mean'], 0)
+        self.assertEqual([result['source'] for result in results['transcode']], ['640x360'])
+
+        # The seeded data is rolled back
+        self.assertFalse(Video.objects.exists())
+        self.assertFalse(CustomUser.objects.exists())
+
+
+@override_settings(CACHES=LOCMEM_CACHES, PERFORMANCE_SAMPLE_RATE=1)
+class PerformanceMiddlewareTest(TestCase):
+    # Tests for the per-request performance metrics
+
+    def setUp(self):
+        cache.clear()
+        registry.clear()
+        self.addCleanup(registry.clear)
+        self.user = CustomUser.objects.create_user(
+            username='test_user', password='test_password', email='test@example.com')
+        self.client = Client(HTTP_AUTHORIZATION=f'Token {Token.objects.create(user=self.user).key}')
+
+    def server_timing(self, response):
+        # Metric name: its parameters (descriptions may contain commas)
+        metrics = re.split(r', (?=\w+;)', response['Server-Timing'])
+        return {metric.split(';')[0]: metric.split(';')[1:] for metric in metrics}
+
+    def test_server_timing(self):
+        Video.objects.create(title='Video', description='Test', video_file='videos/video.mp4')
+        CachedTokenAuthentication.local_cache.clear()
+
+        # Token and catalog are looked up in the database, then served from the caches
+        timing = self.server_timing(self.client.get('/api/v1/videos/'))
+        self.assertEqual(set(timing), {'db', 'cache', 'serializer', 'total'})
+        self.assertEqual(timing['cache'], ['desc="0 hits, 2 misses"'])
+        self.assertNotEqual(timing['db'][1], 'desc="0 queries"')
+
+        timing = self.server_timing(self.client.get('/api/v1/videos/'))
+        self.assertEqual(timing['cache'], ['desc="2 hits, 0 misses"'])
+        self.assertEqual(timing['db'][1], 'desc="0 queries"')
+        self.assertEqual(timing['serializer'], ['dur=0.0'])
+
+        # Queries of async views run in another thread, they are timed as well
+        cache.clear()
+        timing = self.server_timing(self.client.get('/api/v1/async/videos/'))
+        self.assertNotEqual(timing['db'][1], 'desc="0 queries"')
+
+    def test_sampling(self):
+        with self.settings(PERFORMANCE_SAMPLE_RATE=0):
+            response = self.client.get('/api/v1/genres/')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertNotIn('Server-Timing', response)
+        self.assertEqual(registry.render().count('_count{'), 0)
+
+    def test_metrics(self):
+        self.client.get('/api/v1/genres/')
+        self.client.get('/api/v1/genres/')
+        self.client.get('/api/v1/unknown/')
+        self.client.generic('FOO', '/api/v1/unknown/')
+        self.client.generic('BAR', '/api/v1/unknown/')
+
+        # Admins only
+        response = self.client.get('/api/v1/metrics/')
+        self.assertEqual(response.status_code, status.HTTP_403_FORBIDDEN)
+        with self.captureOnCommitCallbacks(execute=True):
+            self.user.is_staff = True
+            self.user.save()
+        response = self.client.get('/api/v1/metrics/', HTTP_ACCEPT='application/openmetrics-text')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertTrue(response['Content-Type'].startswith('text/plain; version=0.0.4'))
+
+        metrics = response.content.decode()
+        labels = f'pid="{os.getpid()}",view="api/v1/genres/",method="GET"'
+        self.assertIn('# TYPE videoflix_request_duration_seconds histogram', metrics)
+        self.assertIn(f'videoflix_request_duration_seconds_bucket{{{labels},le="+Inf"}} 2\n', metrics)
+        self.assertIn(f'videoflix_request_duration_seconds_count{{{labels}}} 2\n', metrics)
+        self.assertIn(f'videoflix_request_db_queries_count{{{labels}}} 2\n', metrics)
+        self.assertIn('view="unmatched",method="GET"', metrics)
+        # Unknown methods are exported as one series
+        self.assertIn('videoflix_request_duration_seconds_count{'
+                      f'pid="{os.getpid()}",view="unmatched",method="other"}} 2\n', metrics)
+        self.assertNotIn('method="FOO"', metrics)
+        self.assertIn(f'videoflix_cache_lookups_total{{pid="{os.getpid()}",view="api/v1/genres/",cache="catalog",'
+                      f'result="hit"}} 1\n', metrics)
@@ -0,0 +1,64 @@
+import hashlib
+from django.core.files.uploadhandler import MemoryFileUploadHandler, TemporaryFileUploadHandler
+
+# Size of the chunks read, when the hash of a file has to be computed afterwards
+HASH_CHUNK_SIZE = 1024 * 1024
+
+
+def file_sha256(file):
+    """
+    Return the SHA-256 of an uploaded file. Uploads through the hashing upload
+    handlers carry it already, other files are read once.
+    """
+    sha256 = getattr(file, 'sha256', None)
+    if sha256:
+        return sha256
+    digest = hashlib.sha256()
+    file.seek(0)
+    for chunk in file.chunks(HASH_CHUNK_SIZE):
+        digest.update(chunk)
+    file.seek(0)
+    return digest.hexdigest()
+
+
+class HashingMemoryFileUploadHandler(MemoryFileUploadHandler):
+    """
+    Keeps small uploads in memory (like MemoryFileUploadHandler) and computes
+    their SHA-256 on the way, available as file.sha256.
+    """
+
+    def new_file(self, *args, **kwargs):
+        self.sha256 = hashlib.sha256()
+        super().new_file(*args, **kwargs)
+
+    def receive_data_chunk(self, raw_data, start):
+        # Larger uploads are passed on to the next handler, which hashes them
+        if self.activated:
+            self.sha256.update(raw_data)
+        return super().receive_data_chunk(raw_data, start)
+
+    def file_complete(self, file_size):
+        file = super().file_complete(file_size)
+        if file is not None:
+            file.sha256 = self.sha256.hexdigest()
+        return file
+
+
+class HashingTemporaryFileUploadHandler(TemporaryFileUploadHandler):
+    """
+    Streams uploads to a temporary file (like TemporaryFileUploadHandler) and
+    computes their SHA-256 on the way, available as file.sha256.
+    """
+
+    def new_file(self, *args, **kwargs):
+        super().new_file(*args, **kwargs)
+        self.sha256 = hashlib.sha256()
+
+    def receive_data_chunk(self, raw_data, start):
+        self.sha256.update(raw_data)
+        return super().receive_data_chunk(raw_data, start)
+
+    def file_complete(self, file_size):
+        file = super().file_complete(file_size)
+        file.sha256 = self.sha256.hexdigest()
+        return file
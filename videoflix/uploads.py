@@ -0,0 +1,157 @@
+import fcntl
+import hashlib
+import os
+from contextlib import contextmanager
+from functools import partial
+from django.conf import settings
+from django.core.files import File
+from django.core.files.move import file_move_safe
+from django.db import transaction
+from django.utils import timezone
+from videoflix.models import UploadSession, Video
+
+# Bytes read from the request and written to disk at once
+UPLOAD_CHUNK_SIZE = 1024 * 1024
+
+# Largest source video that can be uploaded
+MAX_UPLOAD_LENGTH = 20 * 1024 * 1024 * 1024
+
+
+class UploadLocked(Exception):
+    """ Another request is writing to or finalizing the upload """
+
+
+class UploadOffsetMismatch(Exception):
+    """ The client is not in sync with the received bytes (or the upload is incomplete) """
+
+
+class UploadTooLarge(Exception):
+    """ The client sent more bytes than announced """
+
+
+class UploadedPartFile(File):
+    """
+    A completely received upload. Like TemporaryUploadedFile, the storage moves it
+    into place instead of copying it, and the hash is not computed again.
+    """
+
+    def __init__(self, path, name, sha256):
+        super().__init__(open(path, 'rb'), name=name)
+        self.path = path
+        self.sha256 = sha256
+
+    def temporary_file_path(self):
+        return self.path
+
+
+def get_upload_dir():
+    # Best on the same filesystem as MEDIA_ROOT, so finished uploads are moved, not copied
+    return getattr(settings, 'UPLOAD_SESSION_DIR', os.path.join(settings.BASE_DIR, 'uploads'))
+
+
+def upload_path(session):
+    return os.path.join(get_upload_dir(), str(session.pk))
+
+
+@contextmanager
+def locked_upload_file(session):
+    """
+    Open the partial file of the upload, locked against concurrent requests,
+    and sync the session with the database and the file.
+    """
+    os.makedirs(get_upload_dir(), exist_ok=True)
+    with open(os.open(upload_path(session), os.O_RDWR | os.O_CREAT, 0o644), 'r+b') as file:
+        try:
+            fcntl.flock(file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            raise UploadLocked()
+        session.refresh_from_db(fields=['offset'])
+        size = os.fstat(file.fileno()).st_size
+        if size < session.offset:
+            # Bytes that are not on disk (e.g. the file was lost) must be sent again
+            session.offset = size
+            UploadSession.objects.filter(pk=session.pk).update(offset=size, updated_at=timezone.now())
+        yield file
+
+
+def write_chunk(session, stream, offset):
+    """
+    Append the request body (a stream) at the given offset, straight to disk in
+    UPLOAD_CHUNK_SIZE pieces. The received bytes are kept, even if the connection
+    drops, so the client can resume from the returned offset.
+    """
+    with locked_upload_file(session) as file:
+        if offset != session.offset:
+            raise UploadOffsetMismatch()
+        # Drop bytes of an interrupted request, which were never acknowledged
+        file.truncate(offset)
+        file.seek(offset)
+        try:
+            while True:
+                chunk = stream.read(UPLOAD_CHUNK_SIZE)
+                if not chunk:
+                    break
+                remaining = session.length - file.tell()
+                file.write(chunk[:remaining])
+                if len(chunk) > remaining:
+                    raise UploadTooLarge()
+        finally:
+            file.flush()
+            session.offset = file.tell()
+            UploadSession.objects.filter(pk=session.pk).update(offset=session.offset, updated_at=timezone.now())
+    return session.offset
+
+
+def finalize_upload(session):
+    """
+    Create the video from a completely received upload, which starts its
+    analysis and transcoding. Returns the video.
+    """
+    with locked_upload_file(session) as file:
+        if session.offset != session.length:
+            raise UploadOffsetMismatch()
+        sha256 = hashlib.sha256()
+        for chunk in iter(lambda: file.read(UPLOAD_CHUNK_SIZE), b''):
+            sha256.update(chunk)
+
+        part = UploadedPartFile(upload_path(session), session.filename, sha256.hexdigest())
+        video = Video(title=session.title, description=session.description, genre=session.genre, video_file=part)
+        try:
+            # The video, its analysis task (outbox) and the end of the session are committed together
+            with transaction.atomic():
+                video.save()
+                # Removes the partial file as well once committed, unless it was moved into the storage
+                session.delete()
+        except BaseException:
+            restore_upload_file(session, video)
+            raise
+        finally:
+            part.close()
+    return video
+
+
+def restore_upload_file(session, video):
+    """
+    Move the file of a rolled back video out of the storage, back to its upload,
+    so the received bytes are kept and finalizing can be retried.
+    """
+    # Deduplicated uploads reuse a stored file, theirs is not moved
+    if getattr(video, 'deduplicated', False) or not video.video_file._committed:
+        return
+    if os.path.isfile(video.video_file.path):
+        file_move_safe(video.video_file.path, upload_path(session), allow_overwrite=True)
+
+
+def delete_upload_file(session):
+    """
+    Delete the received bytes of the upload, once the current transaction is committed.
+    """
+    # The path is taken now, a deleted session has no pk anymore
+    transaction.on_commit(partial(remove_file, upload_path(session)))
+
+
+def remove_file(path):
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
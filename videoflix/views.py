@@ -1,55 +1,439 @@
+import io
+import mimetypes
+import os
+from urllib.parse import quote, urlencode
 from django.conf import settings
-from django.core.cache.backends.base import DEFAULT_TIMEOUT
+from django.core.cache import cache
+from django.core.exceptions import SuspiciousFileOperation
+from django.http import FileResponse, Http404, HttpResponse, StreamingHttpResponse
 from django.shortcuts import render
+from django.urls import reverse
+from django.utils._os import safe_join
+from django.utils.cache import get_conditional_response, patch_cache_control
+from django.utils.http import http_date
+from django.utils.decorators import method_decorator
+from django.views.decorators.http import condition
 from rest_framework.response import Response
 from rest_framework.views import APIView
 from rest_framework import status
-from django.views.decorators.cache import cache_page
-from videoflix.models import Video, Genre
-from videoflix.serializers import VideoItemSerializer, GenreItemSerializer
-from rest_framework.authentication import TokenAuthentication
-from rest_framework.permissions import IsAuthenticated
+from rest_framework.exceptions import NotFound, ParseError
+from django.db import transaction
+from django.db.models import F, Prefetch, Window
+from django.db.models.functions import RowNumber
+from videoflix.models import Video, Genre, TranscodeJob, UploadSession
+from videoflix.serializers import VideoItemSerializer, GenreItemSerializer, VideoStatusSerializer, UploadSessionSerializer
+from videoflix.pagination import VideoCursorPagination, VideoSearchPagination
+from videoflix.search import search_videos
+from videoflix.cache import CACHE_TTL, catalog_cache_key, catalog_etag, catalog_last_modified
+from videoflix.metrics import record_cache_lookup, registry
+from videoflix.streaming import (URI_REWRITERS, IgnoreClientContentNegotiation, RangeNotSatisfiable,
+                                 file_range_iterator, if_range_passes, parse_range_header)
+from videoflix.uploads import (UploadLocked, UploadOffsetMismatch, UploadTooLarge, finalize_upload,
+                               write_chunk)
+from users.authentication import CachedTokenAuthentication, QueryTokenAuthentication
+from rest_framework.permissions import IsAdminUser, IsAuthenticated
 from rest_framework.generics import get_object_or_404
 
 # Create your views here.
 
-CACHE_TTL = getattr(settings, 'CACHE_TTL', DEFAULT_TIMEOUT)
-
-# @cache_page(CACHE_TTL)
-# # def
+# Answer If-None-Match / If-Modified-Since with 304, before the response is built
+catalog_condition = method_decorator(condition(etag_func=catalog_etag, last_modified_func=catalog_last_modified))
 
 class ListVideos(APIView):
     """ View to load all videos from the database """
 
-    authentication_classes = [TokenAuthentication]
+    authentication_classes = [CachedTokenAuthentication]
     permission_classes = [IsAuthenticated]
 
+    @catalog_condition
     def get(self, request, video_id=None, format=None):
+        fields = self.get_requested_fields(request)
+
+        # Serve from the cache, it is invalidated whenever a video or genre changes
+        cache_key = catalog_cache_key(request)
+        data = cache.get(cache_key)
+        record_cache_lookup('catalog', data is not None)
+        if data is None:
+            data = self.get_data(request, video_id, fields)
+            cache.set(cache_key, data, CACHE_TTL)
+        return Response(data)
+
+    def get_data(self, request, video_id, fields):
+        videos = self.get_queryset(fields)
         if video_id:  # Check if an ID was provided in the URL
-            video = get_object_or_404(Video, id=video_id)  # Get the single video or return 404
-            serializer = VideoItemSerializer(video)
-            return Response(serializer.data)
+            video = get_object_or_404(videos, id=video_id)  # Get the single video or return 404
+            return VideoItemSerializer(video, fields=fields).data
         else:
-            videos = Video.objects.all()  # Get all videos if no ID is provided
-            serializer = VideoItemSerializer(videos, many=True)
-            return Response(serializer.data)
+            # Return one page of videos, ordered by (created_at, id)
+            paginator = VideoCursorPagination()
+            page = paginator.paginate_queryset(self.filter_genre(request, videos), request)
+            serializer = VideoItemSerializer(page, many=True, fields=fields)
+            return paginator.get_paginated_data(serializer.data)
+
+    async def aget_catalog_data(self, request, video_id=None):
+        """ Async variant of get() without the caching, for AsyncListVideos """
+        fields = self.get_requested_fields(request)
+        videos = self.get_queryset(fields)
+        if video_id:
+            try:
+                video = await videos.aget(id=video_id)
+            except Video.DoesNotExist:
+                raise NotFound()
+            return VideoItemSerializer(video, fields=fields).data
+        paginator = VideoCursorPagination()
+        page = await paginator.apaginate_queryset(self.filter_genre(request, videos), request)
+        serializer = VideoItemSerializer(page, many=True, fields=fields)
+        return paginator.get_paginated_data(serializer.data)
+
+    def filter_genre(self, request, videos):
+        genre = request.query_params.get('genre')
+        if genre:
+            # Filter by genre id or name
+            videos = videos.filter(genre_id=genre) if genre.isdigit() else videos.filter(genre__name=genre)
+        return videos
+
+    def get_requested_fields(self, request):
+        """ Parse the optional ?fields= parameter, e.g. ?fields=id,title,thumbnail_file """
+        fields = request.query_params.get('fields')
+        if not fields:
+            return None
+        fields = [field.strip() for field in fields.split(',') if field.strip()]
+        unknown = set(fields) - set(VideoItemSerializer.Meta.fields)
+        if unknown:
+            raise ParseError({"error": f"Unknown field(s): {', '.join(sorted(unknown))}."})
+        return fields
+
+    def get_queryset(self, fields=None):
+        # The search vector is only needed by the database
+        videos = Video.objects.defer('search_vector')
+        if fields is None or 'genre' in fields:
+            # Join the genre, instead of loading it once per video in the serializer
+            videos = videos.select_related('genre')
+        if fields is not None:
+            # The cursor needs id and created_at, even if they are not serialized
+            columns = VideoItemSerializer.columns_for(['id', 'created_at', *fields])
+            videos = videos.only(*columns)
+        return videos
 
     def post(self, request, format=None):
         data = request.data.copy()  # Make a copy of the request data
 
         serializer = VideoItemSerializer(data=data)
         if serializer.is_valid():
-            serializer.save()  # Save the data to the database
+            # The video and its analysis task (outbox) are committed together
+            with transaction.atomic():
+                serializer.save()  # Save the data to the database
             return Response(serializer.data, status=status.HTTP_201_CREATED)
         return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
 
+
+class SearchVideos(ListVideos):
+    """ View to search videos by title and description, ordered by relevance """
+
+    http_method_names = ['get', 'head', 'options']
+
+    # Longer queries are cut off, they only slow down the search
+    max_query_length = 200
+
+    @catalog_condition
+    def get(self, request, format=None):
+        query = self.get_query(request)
+        fields = self.get_requested_fields(request)
+
+        cache_key = catalog_cache_key(request)
+        data = cache.get(cache_key)
+        record_cache_lookup('catalog', data is not None)
+        if data is None:
+            paginator = VideoSearchPagination()
+            page = paginator.paginate_queryset(search_videos(self.get_queryset(fields), query), request)
+            serializer = VideoItemSerializer(page, many=True, fields=fields)
+            data = paginator.get_paginated_data(serializer.data)
+            cache.set(cache_key, data, CACHE_TTL)
+        return Response(data)
+
+    async def aget_catalog_data(self, request):
+        query = self.get_query(request)
+        fields = self.get_requested_fields(request)
+        paginator = VideoSearchPagination()
+        page = await paginator.apaginate_queryset(search_videos(self.get_queryset(fields), query), request)
+        serializer = VideoItemSerializer(page, many=True, fields=fields)
+        return paginator.get_paginated_data(serializer.data)
+
+    def get_query(self, request):
+        query = request.query_params.get('q', '').strip()[:self.max_query_length]
+        if not query:
+            raise ParseError({"error": "The search query (?q=) is required."})
+        return query
+
+
+class ListGenresWithVideos(ListVideos):
+    """ View to load the genres with their newest videos, e.g. for the rows of the start page """
+
+    http_method_names = ['get', 'head', 'options']
+
+    # Videos per genre, can be changed with ?limit=
+    default_limit = 10
+    max_limit = 50
+
+    @catalog_condition
+    def get(self, request, format=None):
+        limit = self.get_limit(request)
+        fields = self.get_requested_fields(request)
+
+        cache_key = catalog_cache_key(request)
+        data = cache.get(cache_key)
+        record_cache_lookup('catalog', data is not None)
+        if data is None:
+            data = self.get_genres_data(limit, fields)
+            cache.set(cache_key, data, CACHE_TTL)
+        return Response(data)
+
+    async def aget_catalog_data(self, request):
+        limit = self.get_limit(request)
+        fields = self.get_requested_fields(request)
+        videos = [video async for video in self.get_genre_videos(limit, fields)]
+        return self.group_by_genre(videos, fields)
+
+    def get_limit(self, request):
+        try:
+            return min(max(int(request.query_params.get('limit', self.default_limit)), 1), self.max_limit)
+        except ValueError:
+            raise ParseError({"error": "The limit must be a number."})
+
+    def get_genres_data(self, limit, fields):
+        return self.group_by_genre(self.get_genre_videos(limit, fields), fields)
+
+    def get_genre_videos(self, limit, fields):
+        # The newest videos of every genre (with the genre joined) in one query,
+        # numbered per genre by a window function
+        return (self.get_queryset(None if fields is None else [*fields, 'genre'])
+                .filter(genre__isnull=False)
+                .annotate(position=Window(RowNumber(), partition_by=[F('genre_id')],
+                                          order_by=[F('created_at').desc(), F('id').desc()]))
+                .filter(position__lte=limit)
+                .order_by('genre__name', 'position'))
+
+    def group_by_genre(self, videos, fields):
+        genres = {}
+        for video in videos:
+            genres.setdefault(video.genre_id, (video.genre, []))[1].append(video)
+        return [
+            {**GenreItemSerializer(genre).data,
+             'videos': VideoItemSerializer(genre_videos, many=True, fields=fields).data}
+            for genre, genre_videos in genres.values()
+        ]
+
+
 class ListGenres(APIView):
     """ View to load all videos from the database """
 
-    authentication_classes = [TokenAuthentication]
+    authentication_classes = [CachedTokenAuthentication]
     permission_classes = [IsAuthenticated]
 
+    @catalog_condition
     def get(self, request, format=None):
-        genres = Genre.objects.all() 
-        serializer = GenreItemSerializer(genres, many=True)
+        cache_key = catalog_cache_key(request)
+        data = cache.get(cache_key)
+        record_cache_lookup('catalog', data is not None)
+        if data is None:
+            genres = Genre.objects.all()
+            data = GenreItemSerializer(genres, many=True).data
+            cache.set(cache_key, data, CACHE_TTL)
+        return Response(data)
+
+    async def aget_catalog_data(self, request):
+        genres = [genre async for genre in Genre.objects.all()]
+        return GenreItemSerializer(genres, many=True).data
+
+
+class VideoStatus(APIView):
+    """ View to load the transcoding status of a video, per rendition """
+
+    authentication_classes = [CachedTokenAuthentication]
+    permission_classes = [IsAuthenticated]
+
+    def get(self, request, video_id, format=None):
+        videos = Video.objects.only('id', 'video_file', 'renditions').prefetch_related(
+            Prefetch('transcode_jobs', queryset=TranscodeJob.objects.order_by('created_at', 'id')))
+        video = get_object_or_404(videos, id=video_id)
+        serializer = VideoStatusSerializer(video)
         return Response(serializer.data)
+
+
+class PerformanceMetricsView(APIView):
+    """
+    View to scrape the request histograms of this process (see PerformanceMiddleware)
+    in the Prometheus text format, for admins.
+    """
+
+    authentication_classes = [CachedTokenAuthentication]
+    permission_classes = [IsAdminUser]
+    content_negotiation_class = IgnoreClientContentNegotiation
+
+    def get(self, request, format=None):
+        return HttpResponse(registry.render(), content_type='text/plain; version=0.0.4; charset=utf-8')
+
+
+class StreamMedia(APIView):
+    """
+    View to stream media files to authenticated users, with support for
+    byte ranges (HTTP 206), so players can seek without downloading from the start.
+
+    If MEDIA_X_ACCEL_REDIRECT_PREFIX is set, the file is handed over to nginx
+    via X-Accel-Redirect after the authentication, and nginx serves the bytes.
+
+    Players fetch the segments of HLS playlists and the sprites of seek previews
+    by the relative URIs in the file. If the file was requested with ?token=,
+    the token is appended to these URIs, so the player sends it along.
+    """
+
+    authentication_classes = [CachedTokenAuthentication, QueryTokenAuthentication]
+    permission_classes = [IsAuthenticated]
+    content_negotiation_class = IgnoreClientContentNegotiation
+
+    def get(self, request, path, format=None):
+        try:
+            full_path = safe_join(settings.MEDIA_ROOT, path)
+        except SuspiciousFileOperation:
+            raise Http404
+        if not os.path.isfile(full_path):
+            raise Http404
+
+        content_type = mimetypes.guess_type(full_path)[0] or 'application/octet-stream'
+
+        rewrite_uris = URI_REWRITERS.get(os.path.splitext(full_path)[1].lower())
+        if rewrite_uris and isinstance(request.successful_authenticator, QueryTokenAuthentication):
+            with open(full_path, encoding='utf-8') as file:
+                content = rewrite_uris(file.read(), urlencode({'token': request.query_params['token']}))
+            response = HttpResponse(content, content_type=content_type)
+            # The file carries the token of the user now
+            patch_cache_control(response, private=True, no_store=True)
+            return response
+
+        accel_prefix = getattr(settings, 'MEDIA_X_ACCEL_REDIRECT_PREFIX', None)
+        if accel_prefix:
+            response = HttpResponse(content_type=content_type)
+            # nginx decodes the URI, so file names with spaces or non-ASCII characters need quoting
+            response['X-Accel-Redirect'] = accel_prefix.rstrip('/') + '/' + quote(path)
+            return response
+
+        stat = os.stat(full_path)
+        size = stat.st_size
+        last_modified = int(stat.st_mtime)
+        etag = f'"{stat.st_mtime_ns:x}-{size:x}"'
+
+        response = get_conditional_response(request, etag=etag, last_modified=last_modified)
+        if response is None:
+            response = self.get_file_response(request, full_path, size, etag, last_modified, content_type)
+
+        response['Accept-Ranges'] = 'bytes'
+        response['ETag'] = etag
+        response['Last-Modified'] = http_date(last_modified)
+        return response
+
+    def get_file_response(self, request, full_path, size, etag, last_modified, content_type):
+        byte_range = None
+        if if_range_passes(request.META.get('HTTP_IF_RANGE'), etag, last_modified):
+            try:
+                byte_range = parse_range_header(request.META.get('HTTP_RANGE'), size)
+            except RangeNotSatisfiable:
+                response = HttpResponse(status=status.HTTP_416_REQUESTED_RANGE_NOT_SATISFIABLE)
+                response['Content-Range'] = f'bytes */{size}'
+                return response
+
+        if byte_range is None:
+            # Whole file, the WSGI server can use sendfile for it
+            return FileResponse(open(full_path, 'rb'), content_type=content_type)
+
+        start, end = byte_range
+        response = StreamingHttpResponse(file_range_iterator(full_path, start, end - start + 1),
+                                         status=status.HTTP_206_PARTIAL_CONTENT, content_type=content_type)
+        response['Content-Length'] = str(end - start + 1)
+        response['Content-Range'] = f'bytes {start}-{end}/{size}'
+        return response
+
+
+class UploadSessions(APIView):
+    """
+    View to start a resumable upload of a large source video.
+
+    The file is then sent in one or more PATCH requests to the upload URL
+    (Content-Type: application/offset+octet-stream, Upload-Offset: bytes sent so far).
+    After a dropped connection, HEAD returns the offset to resume from.
+    Once all bytes are received, POST to the finalize URL creates the video.
+    """
+
+    authentication_classes = [CachedTokenAuthentication]
+    permission_classes = [IsAuthenticated]
+
+    def post(self, request, format=None):
+        serializer = UploadSessionSerializer(data=request.data)
+        if not serializer.is_valid():
+            return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
+        session = serializer.save(user=request.user)
+        url = reverse('upload-session', args=[session.pk])
+        return Response(serializer.data, status=status.HTTP_201_CREATED,
+                        headers=upload_headers(session, Location=request.build_absolute_uri(url)))
+
+
+class UploadSessionDetail(APIView):
+    """ View to query the offset of, send bytes to or abort a resumable upload """
+
+    authentication_classes = [CachedTokenAuthentication]
+    permission_classes = [IsAuthenticated]
+
+    def get(self, request, upload_id, format=None):
+        session = get_object_or_404(UploadSession, pk=upload_id, user=request.user)
+        return Response(UploadSessionSerializer(session).data, headers=upload_headers(session))
+
+    def patch(self, request, upload_id, format=None):
+        session = get_object_or_404(UploadSession, pk=upload_id, user=request.user)
+        if request.content_type != 'application/offset+octet-stream':
+            return Response({"error": "The Content-Type must be application/offset+octet-stream."},
+                            status=status.HTTP_415_UNSUPPORTED_MEDIA_TYPE)
+        try:
+            offset = int(request.headers['Upload-Offset'])
+        except (KeyError, ValueError):
+            return Response({"error": "The Upload-Offset header is required."}, status=status.HTTP_400_BAD_REQUEST)
+
+        try:
+            # Read the body as a stream, it must never be loaded into memory at once
+            write_chunk(session, request.stream or io.BytesIO(), offset)
+        except UploadLocked:
+            return Response({"error": "The upload is in use by another request."}, status=status.HTTP_423_LOCKED)
+        except UploadOffsetMismatch:
+            return Response({"error": "Upload-Offset does not match the received bytes."},
+                            status=status.HTTP_409_CONFLICT, headers=upload_headers(session))
+        except UploadTooLarge:
+            return Response({"error": "More bytes than announced were sent."},
+                            status=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE, headers=upload_headers(session))
+        return Response(status=status.HTTP_204_NO_CONTENT, headers=upload_headers(session))
+
+    def delete(self, request, upload_id, format=None):
+        session = get_object_or_404(UploadSession, pk=upload_id, user=request.user)
+        session.delete()
+        return Response(status=status.HTTP_204_NO_CONTENT)
+
+
+class UploadSessionFinalize(APIView):
+    """ View to create the video of a completely received upload, which starts its transcoding """
+
+    authentication_classes = [CachedTokenAuthentication]
+    permission_classes = [IsAuthenticated]
+
+    def post(self, request, upload_id, format=None):
+        session = get_object_or_404(UploadSession, pk=upload_id, user=request.user)
+        try:
+            video = finalize_upload(session)
+        except UploadLocked:
+            return Response({"error": "The upload is in use by another request."}, status=status.HTTP_423_LOCKED)
+        except UploadOffsetMismatch:
+            return Response({"error": "The upload is not complete."},
+                            status=status.HTTP_409_CONFLICT, headers=upload_headers(session))
+        return Response(VideoItemSerializer(video).data, status=status.HTTP_201_CREATED)
+
+
+def upload_headers(session, **headers):
+    # Resumable upload state, in the headers of the tus protocol
+    return {'Upload-Offset': str(session.offset), 'Upload-Length': str(session.length),
+            'Cache-Control': 'no-store', **headers}
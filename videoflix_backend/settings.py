@@ -25,7 +25,7 @@ BASE_DIR = Path(__file__).resolve().parent.parent
 SECRET_KEY = config('DJANGO_SECRET')
 
 # SECURITY WARNING: don't run with debug turned on in production!
-DEBUG = True
+DEBUG = config('DJANGO_DEBUG', default=True, cast=bool)
 
 ALLOWED_HOSTS = ['127.0.0.1', 'localhost', '35.246.145.159', 'videoflix-backend.christian-hansen.dev']
 CORS_ALLOW_ALL_ORIGINS = ['127.0.0.1', 'localhost', '35.246.145.159', 'videoflix-backend.christian-hansen.dev']
@@ -42,7 +42,6 @@ INSTALLED_APPS = [
     'django.contrib.messages',
     'django.contrib.staticfiles',
     'videoflix.apps.VideoflixConfig',
-    'debug_toolbar',
     'django_rq',
     'import_export',
     'users',
@@ -53,7 +52,8 @@ INSTALLED_APPS = [
 AUTH_USER_MODEL = 'users.CustomUser'
 
 MIDDLEWARE = [
-    'debug_toolbar.middleware.DebugToolbarMiddleware',
+    # First, so the measured wall time includes the other middleware
+    'videoflix.middleware.PerformanceMiddleware',
     'corsheaders.middleware.CorsMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
@@ -64,6 +64,15 @@ MIDDLEWARE = [
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
 ]
 
+# The debug toolbar records every query and template, so it is for development only
+if DEBUG:
+    INSTALLED_APPS.append('debug_toolbar')
+    MIDDLEWARE.insert(0, 'debug_toolbar.middleware.DebugToolbarMiddleware')
+
+# Share of the requests measured by the PerformanceMiddleware (Server-Timing header
+# and the histograms of /api/v1/metrics/), 0 to 1
+PERFORMANCE_SAMPLE_RATE = 0.1
+
 ROOT_URLCONF = 'videoflix_backend.urls'
 
 TEMPLATES = [
@@ -153,6 +162,19 @@ DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'
 MEDIA_ROOT = os.path.join(BASE_DIR, 'media')
 MEDIA_URL = '/media/'
 
+# Received bytes of resumable uploads, best on the same filesystem as MEDIA_ROOT
+UPLOAD_SESSION_DIR = os.path.join(BASE_DIR, 'uploads')
+
+# Compute the SHA-256 of uploads while they are streamed in, used to deduplicate video files
+FILE_UPLOAD_HANDLERS = [
+    'videoflix.uploadhandlers.HashingMemoryFileUploadHandler',
+    'videoflix.uploadhandlers.HashingTemporaryFileUploadHandler',
+]
+
+# Let nginx serve the bytes of /api/v1/media/ after the authentication, e.g. '/protected-media/'
+# (an internal nginx location aliasing MEDIA_ROOT). None streams the files from Django.
+MEDIA_X_ACCEL_REDIRECT_PREFIX = None
+
 CACHES = {
     "default": {
         "BACKEND": "django_redis.cache.RedisCache",
@@ -165,17 +187,42 @@ CACHES = {
         }
     }
 
+RQ_CONNECTION = {
+    'HOST': 'localhost',
+    'PORT': 6379,
+    'DB': 0,
+    # 'USERNAME': 'some-user',
+    'PASSWORD': config('RQ_PASSWORD'),
+}
+
+# Workers should listen to the queues in priority order, e.g.:
+# python manage.py rqworker transcode-high transcode-bulk light default --with-scheduler
+# (the scheduler runs the delayed retries of failed jobs)
 RQ_QUEUES = {
     'default': {
-        'HOST': 'localhost',
-        'PORT': 6379,
-        'DB': 0,
-        # 'USERNAME': 'some-user',
-        'PASSWORD': config('RQ_PASSWORD'),
+        **RQ_CONNECTION,
         'DEFAULT_TIMEOUT': 6000
-    }
+    },
+    # Short clips and the first (360p) rendition of longer videos
+    'transcode-high': {
+        **RQ_CONNECTION,
+        'DEFAULT_TIMEOUT': 3600
+    },
+    # Remaining renditions of longer videos
+    'transcode-bulk': {
+        **RQ_CONNECTION,
+        'DEFAULT_TIMEOUT': 6 * 3600
+    },
+    # Emails, exports and other short tasks
+    'light': {
+        **RQ_CONNECTION,
+        'DEFAULT_TIMEOUT': 300
+    },
 }
 
+# Number of ffmpeg runs allowed at the same time per host (None: CPU count / 4)
+TRANSCODE_CONCURRENCY = None
+
 CORS_ALLOW_CREDENTIALS = True
 CORS_ALLOWED_ORIGINS = [
     "http://localhost:4200", "videoflix.christian-hansen.dev"
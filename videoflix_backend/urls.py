@@ -17,9 +17,10 @@ from django.contrib import admin
 from django.urls import path, include
 from django.conf import settings
 from django.conf.urls.static import static
-from debug_toolbar.toolbar import debug_toolbar_urls
-from users.views import ListUsers, LoginView, RegisterView, SetNewPasswordView, PasswordResetRequestView, ActivateAccountView, UsernameRequestView
-from videoflix.views import ListVideos, ListGenres
+from users.views import ListUsers, AuthCacheStatsView, LoginView, AsyncLoginView, RegisterView, SetNewPasswordView, PasswordResetRequestView, ActivateAccountView, UsernameRequestView
+from videoflix.views import (ListVideos, ListGenres, ListGenresWithVideos, SearchVideos, StreamMedia, VideoStatus,
+                             UploadSessions, UploadSessionDetail, UploadSessionFinalize, PerformanceMetricsView)
+from videoflix.async_views import AsyncListVideos, AsyncListGenres, AsyncListGenresWithVideos, AsyncSearchVideos
 
 urlpatterns = [
     path('admin/', admin.site.urls),
@@ -27,11 +28,32 @@ urlpatterns = [
     path('api/v1/register/', RegisterView.as_view(), name='register'),
     path('api/v1/activate/<uidb64>/<token>/', ActivateAccountView.as_view(), name='activate-account'),
     path('api/v1/users/', ListUsers.as_view()),
+    path('api/v1/auth-cache-stats/', AuthCacheStatsView.as_view(), name='auth-cache-stats'),
+    path('api/v1/metrics/', PerformanceMetricsView.as_view(), name='performance-metrics'),  # For Prometheus
     path('api/v1/videos/', ListVideos.as_view(), name='list-videos'),  # For listing all videos
+    path('api/v1/videos/search/', SearchVideos.as_view(), name='search-videos'),  # For the full-text search
     path('api/v1/videos/<int:video_id>/', ListVideos.as_view(), name='get-video'),  # For getting a single video
+    path('api/v1/videos/<int:video_id>/status/', VideoStatus.as_view(), name='video-status'),  # For the transcoding status
+    path('api/v1/uploads/', UploadSessions.as_view(), name='upload-sessions'),  # For resumable uploads of large videos
+    path('api/v1/uploads/<uuid:upload_id>/', UploadSessionDetail.as_view(), name='upload-session'),
+    path('api/v1/uploads/<uuid:upload_id>/finalize/', UploadSessionFinalize.as_view(), name='upload-session-finalize'),
     path('api/v1/genres/', ListGenres.as_view(), name='genre-list'),
+    path('api/v1/genres/with-videos/', ListGenresWithVideos.as_view(), name='genre-list-with-videos'),  # For the newest videos per genre
+    path('api/v1/media/<path:path>', StreamMedia.as_view(), name='stream-media'),  # For streaming with byte ranges
     path('api/v1/password-reset/', PasswordResetRequestView.as_view(), name='password-reset'),
     path('api/v1/username-reminder/', UsernameRequestView.as_view(), name='username-reminder'),
     path('api/v1/reset-password/<uidb64>/<token>/', SetNewPasswordView.as_view(), name='reset-password'),
+    # Async variants of the login and catalog endpoints, for ASGI servers (see asgi.py)
+    path('api/v1/async/login/', AsyncLoginView.as_view(), name='async-login'),
+    path('api/v1/async/videos/', AsyncListVideos.as_view(), name='async-list-videos'),
+    path('api/v1/async/videos/search/', AsyncSearchVideos.as_view(), name='async-search-videos'),
+    path('api/v1/async/videos/<int:video_id>/', AsyncListVideos.as_view(), name='async-get-video'),
+    path('api/v1/async/genres/', AsyncListGenres.as_view(), name='async-genre-list'),
+    path('api/v1/async/genres/with-videos/', AsyncListGenresWithVideos.as_view(), name='async-genre-list-with-videos'),
     path('django-rq/', include('django_rq.urls')),
-] + static(settings.MEDIA_URL, document_root=settings.MEDIA_ROOT) + debug_toolbar_urls() + static(settings.STATIC_URL, document_root=settings.STATIC_ROOT)
+] + static(settings.MEDIA_URL, document_root=settings.MEDIA_ROOT) + static(settings.STATIC_URL, document_root=settings.STATIC_ROOT)
+
+# The debug toolbar is only installed in development, see settings.py
+if 'debug_toolbar' in settings.INSTALLED_APPS:
+    from debug_toolbar.toolbar import debug_toolbar_urls
+    urlpatterns += debug_toolbar_urls()